@@ -0,0 +1,314 @@
+# coding=utf-8
+'''
+Benchmarks of the hot paths of copper: time and peak memory (tracemalloc)
+of each case for each set of parameters.
+
+    python benchmarks/bench.py --output results.json
+    python benchmarks/bench.py --compare results.json --threshold 0.2
+    python benchmarks/bench.py --quick --filter fillna
+
+With --compare the results are compared against a stored baseline and the
+cases slower (or using more memory) than threshold, the cases that fail now
+and the cases of the baseline that are missing are reported as regressions,
+the exit status is 1 if there is any. Compare runs with the same --quick.
+'''
+from __future__ import division
+import os
+import gc
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import platform
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault('MPLBACKEND', 'Agg')
+
+import copper
+import numpy as np
+import pandas as pd
+from data import make_frame, make_dataset
+
+CASES = []
+
+def case(name, params, quick=None):
+    '''
+    Registers a benchmark. The decorated function receives the parameters,
+    does the setup and returns the function to measure.
+    '''
+    def register(setup):
+        CASES.append((name, setup, params, quick or params[:1]))
+        return setup
+    return register
+
+SIZES = [dict(rows=10000, numbers=10, categories=2, cardinality=10, missing=0.1),
+         dict(rows=100000, numbers=50, categories=5, cardinality=100, missing=0.1),
+         dict(rows=100000, numbers=500, categories=0, cardinality=10, missing=0.0),
+         dict(rows=100000, numbers=5, categories=5, cardinality=10000, missing=0.2)]
+
+ML_SIZES = [dict(rows=5000, numbers=10, categories=2, cardinality=10),
+            dict(rows=50000, numbers=20, categories=3, cardinality=20)]
+
+def _ml(params, clfs=None):
+    from sklearn.naive_bayes import GaussianNB
+    from sklearn.tree import DecisionTreeClassifier
+    ds = make_dataset(**params)
+    ds.fillna(method='mean')
+    ml = copper.MachineLearning()
+    inputs = copper.transform.inputs2ml(ds)
+    ml._set_layout(ds, inputs)
+    half = len(ds) // 2
+    X, y = inputs.values, copper.transform.target2ml(ds).values
+    ml.X_train, ml.y_train, ml.X_test, ml.y_test = X[:half], y[:half], X[half:], y[half:]
+    if clfs is None:
+        clfs = {'GNB': GaussianNB(), 'DT': DecisionTreeClassifier(max_depth=6)}
+    for name, clf in clfs.items():
+        ml.add_clf(clf, name)
+    return ml, ds
+
+# -----------------------------------------------------------------------------
+#                                   DATASET
+# -----------------------------------------------------------------------------
+
+@case('Dataset.set_frame', SIZES)
+def bench_set_frame(params):
+    frame = make_frame(**params)
+    return lambda: copper.Dataset().set_frame(frame)
+
+@case('Dataset.filter', SIZES)
+def bench_filter(params):
+    ds = make_dataset(**params)
+    return lambda: ds.filter(role=ds.INPUT, type=ds.NUMBER)
+
+@case('Dataset.filter(ret_ds)', SIZES)
+def bench_filter_ds(params):
+    ds = make_dataset(**params)
+    return lambda: ds.filter(role=ds.INPUT, ret_ds=True)
+
+@case('Dataset.fillna', SIZES)
+def bench_fillna(params):
+    frame = make_frame(**params)
+    def run():
+        ds = copper.Dataset(frame.copy())
+        ds.fillna(method='mean')
+    return run
+
+@case('Dataset.fillna(by)', SIZES[:2])
+def bench_fillna_by(params):
+    frame = make_frame(**params)
+    def run():
+        ds = copper.Dataset(frame.copy())
+        ds.fillna(method='mean', by='Cat.0')
+    return run
+
+@case('Dataset.fillna(knn)', [dict(rows=10000, numbers=10, categories=1, missing=0.05)])
+def bench_fillna_knn(params):
+    frame = make_frame(**params)
+    def run():
+        ds = copper.Dataset(frame.copy())
+        ds.fillna(method='knn', n_jobs=-1)
+    return run
+
+@case('transform.inputs2ml', SIZES)
+def bench_inputs2ml(params):
+    ds = make_dataset(**params)
+    ds.fillna(method='mean')
+    return lambda: copper.transform.inputs2ml(ds)
+
+@case('transform.category2ml', [dict(rows=100000, numbers=0, categories=1, cardinality=10),
+                                dict(rows=100000, numbers=0, categories=1, cardinality=1000)])
+def bench_category2ml(params):
+    series = make_frame(**params)['Cat.0']
+    return lambda: copper.transform.category2ml(series)
+
+# -----------------------------------------------------------------------------
+#                                MACHINE LEARNING
+# -----------------------------------------------------------------------------
+
+@case('MachineLearning.fit', ML_SIZES)
+def bench_fit(params):
+    ml, ds = _ml(params)
+    return ml.fit
+
+@case('MachineLearning.predict', ML_SIZES)
+def bench_predict(params):
+    ml, ds = _ml(params)
+    ml.fit()
+    return ml.predict
+
+@case('MachineLearning.predict_proba', ML_SIZES)
+def bench_predict_proba(params):
+    ml, ds = _ml(params)
+    ml.fit()
+    return ml.predict_proba
+
+@case('MachineLearning.metrics', ML_SIZES)
+def bench_metrics(params):
+    ml, ds = _ml(params)
+    ml.fit()
+    def run():
+        ml._cache = {}
+        ml.accuracy()
+        ml.auc()
+        ml.mse()
+        ml.cm_table()
+        ml.profit()
+        ml.oportunity_cost()
+    return run
+
+@case('Bagging.predict', ML_SIZES)
+def bench_bagging(params):
+    ml, ds = _ml(params)
+    ml.fit()
+    bag = copper.utils.ml.Bagging(ml.clfs)
+    return lambda: bag.predict(ml.X_test)
+
+@case('utils.ml.bootstrap', ML_SIZES[:1])
+def bench_bootstrap(params):
+    from sklearn.tree import DecisionTreeClassifier
+    ds = make_dataset(**params)
+    ds.fillna(method='mean')
+    return lambda: copper.utils.ml.bootstrap(DecisionTreeClassifier, 5, ds, max_depth=6)
+
+# -----------------------------------------------------------------------------
+#                                     IO
+# -----------------------------------------------------------------------------
+
+@case('copper.save/load(Dataset)', SIZES[:2])
+def bench_save_load(params):
+    ds = make_dataset(**params)
+    def run():
+        copper.save(ds, 'bench')
+        copper.load('bench')
+    return run
+
+@case('copper.save/load(MachineLearning)', ML_SIZES)
+def bench_save_load_ml(params):
+    from sklearn.ensemble import RandomForestClassifier
+    ml, ds = _ml(params, clfs={'RF': RandomForestClassifier(50)})
+    ml.fit()
+    def run():
+        copper.save(ml, 'bench')
+        copper.load('bench.ml')
+    return run
+
+# -----------------------------------------------------------------------------
+#                                   RUNNER
+# -----------------------------------------------------------------------------
+
+def measure(fnc, repeat=3):
+    '''
+    Returns
+    -------
+        (best seconds, peak bytes allocated during one call)
+    '''
+    times = []
+    for i in range(repeat):
+        gc.collect()
+        start = time.time()
+        fnc()
+        times.append(time.time() - start)
+
+    gc.collect()
+    tracemalloc.start()
+    fnc()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return min(times), peak
+
+def run(quick=False, pattern=None, repeat=3):
+    results = []
+    for name, setup, params, quick_params in CASES:
+        if pattern is not None and pattern not in name:
+            continue
+        for p in (quick_params if quick else params):
+            key = '%s %s' % (name, json.dumps(p, sort_keys=True))
+            try:
+                seconds, peak = measure(setup(p), repeat=repeat)
+                result = {'name': name, 'params': p, 'key': key,
+                          'seconds': seconds, 'peak_bytes': peak}
+                print('%-70s %9.4fs %10.1fMB' % (key[:70], seconds, peak / 2 ** 20))
+            except Exception as e:
+                result = {'name': name, 'params': p, 'key': key, 'error': repr(e)}
+                print('%-70s ERROR %r' % (key[:70], e))
+            results.append(result)
+            sys.stdout.flush()
+    return results
+
+def compare(results, baseline, threshold=0.2, pattern=None):
+    '''
+    Compares the results with a baseline. Cases that fail now and did not
+    fail on the baseline, and cases of the baseline that were not run (only
+    the cases with pattern in the name if given) are regressions too.
+
+    Returns
+    -------
+        pandas.DataFrame with the ratios, the Status and a Regression column
+    '''
+    base = dict((r['key'], r) for r in baseline)
+    keys = set(r['key'] for r in results)
+    rows = []
+    for r in results:
+        b = base.get(r['key'])
+        if 'error' in r:
+            status = 'error' if b is not None and 'error' in b else 'new error'
+            seconds = np.nan if b is None else b.get('seconds', np.nan)
+            rows.append([r['key'], seconds, np.nan, np.nan, np.nan, status,
+                         status == 'new error'])
+        elif b is None or 'error' in b:
+            rows.append([r['key'], np.nan, r['seconds'], np.nan, np.nan,
+                         'new', False])
+        else:
+            time_ratio = r['seconds'] / b['seconds']
+            memory_ratio = r['peak_bytes'] / max(b['peak_bytes'], 1)
+            regression = time_ratio > 1 + threshold or memory_ratio > 1 + threshold
+            rows.append([r['key'], b['seconds'], r['seconds'], time_ratio,
+                         memory_ratio, 'ok', regression])
+    for b in baseline:
+        if b['key'] not in keys and (pattern is None or pattern in b['name']):
+            rows.append([b['key'], b.get('seconds', np.nan), np.nan, np.nan,
+                         np.nan, 'missing', True])
+    cols = ['Benchmark', 'Baseline seconds', 'Seconds', 'Time ratio',
+            'Memory ratio', 'Status', 'Regression']
+    return pd.DataFrame(rows, columns=cols).set_index('Benchmark')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__,
+                                formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--output', help='json file to save the results')
+    parser.add_argument('--compare', help='json file with the baseline results')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='allowed slowdown / memory increase, default 0.2')
+    parser.add_argument('--quick', action='store_true', help='only the small sizes')
+    parser.add_argument('--filter', help='only the cases with this in the name')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    project = tempfile.mkdtemp()
+    copper.project.path = project
+    try:
+        results = run(quick=args.quick, pattern=args.filter, repeat=args.repeat)
+    finally:
+        shutil.rmtree(project)
+
+    if args.output:
+        info = {'python': platform.python_version(), 'numpy': np.__version__,
+                'pandas': pd.__version__, 'machine': platform.machine(),
+                'date': time.strftime('%Y-%m-%d %H:%M:%S')}
+        with open(args.output, 'w') as output:
+            json.dump({'info': info, 'results': results}, output, indent=2)
+
+    if args.compare:
+        with open(args.compare) as baseline:
+            baseline = json.load(baseline)['results']
+        comparison = compare(results, baseline, threshold=args.threshold,
+                                                        pattern=args.filter)
+        pd.set_option('display.width', 200)
+        print(comparison)
+        if comparison['Regression'].any():
+            print('Regressions: %d' % comparison['Regression'].sum())
+            sys.exit(1)
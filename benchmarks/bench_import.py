@@ -0,0 +1,66 @@
+# coding=utf-8
+'''
+Import time of copper and of its lazily loaded modules.
+Each statement runs on a new python process.
+
+    python benchmarks/bench_import.py --repeat 10
+'''
+from __future__ import division
+import os
+import sys
+import json
+import argparse
+import subprocess
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+STATEMENTS = [
+    'import copper',
+    'import copper; copper.Dataset',
+    'import copper; copper.transform',
+    'import copper; copper.MachineLearning',
+    'import copper; copper.plot',
+]
+
+HEAVY = ['sklearn', 'matplotlib', 'matplotlib.pyplot', 'scipy', 'rpy2', 'tornado']
+
+CODE = '''
+import sys, time, json
+start = time.time()
+%s
+elapsed = time.time() - start
+print(json.dumps([elapsed, [m for m in %r if m in sys.modules]]))
+'''
+
+def time_statement(statement, repeat=5):
+    '''
+    Returns
+    -------
+        (list of seconds, list of heavy modules loaded)
+    '''
+    env = dict(os.environ, PYTHONPATH=ROOT, MPLBACKEND='Agg')
+    times = []
+    for i in range(repeat):
+        out = subprocess.check_output([sys.executable, '-c', CODE % (statement, HEAVY)], env=env)
+        elapsed, loaded = json.loads(out.decode('utf-8').strip().splitlines()[-1])
+        times.append(elapsed)
+    return times, loaded
+
+def run(repeat=5):
+    ans = []
+    for statement in STATEMENTS:
+        times, loaded = time_statement(statement, repeat=repeat)
+        ans.append({'name': statement, 'median': float(np.median(times)),
+                    'min': float(np.min(times)), 'loaded': loaded})
+    return ans
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    for result in run(repeat=args.repeat):
+        print('%-40s %8.3fs  %s' % (result['name'], result['median'],
+                                    ', '.join(result['loaded']) or '-'))
@@ -0,0 +1,58 @@
+# coding=utf-8
+from __future__ import division
+import copper
+import numpy as np
+import pandas as pd
+
+'''
+Synthetic data generators for the benchmarks
+'''
+
+
+def make_frame(rows=10000, numbers=10, categories=2, cardinality=10,
+               missing=0.0, seed=0):
+    '''
+    Generates a frame with numerical and categorical columns and a binary
+    Target that depends on some of the columns
+
+    Parameters
+    ----------
+        rows: int, number of rows
+        numbers: int, number of numerical columns
+        categories: int, number of categorical (object) columns
+        cardinality: int, number of levels of each categorical column
+        missing: float, percent of missing values on every column but Target
+        seed: int, random seed
+
+    Returns
+    -------
+        pandas.DataFrame
+    '''
+    rng = np.random.RandomState(seed)
+    frame = pd.DataFrame(index=range(rows))
+    score = np.zeros(rows)
+    for i in range(numbers):
+        values = rng.randn(rows)
+        score += values * rng.randn()
+        frame['Num.%d' % i] = values
+    levels = np.array(['L%d' % i for i in range(cardinality)], dtype=object)
+    for i in range(categories):
+        codes = rng.randint(cardinality, size=rows)
+        score += (codes % 2) * rng.randn()
+        frame['Cat.%d' % i] = levels.take(codes)
+
+    if missing > 0:
+        for col in frame.columns:
+            frame.loc[rng.rand(rows) < missing, col] = np.nan
+    frame['Target'] = (score + rng.randn(rows) > 0).astype(int)
+    return frame
+
+def make_dataset(**args):
+    '''
+    Same as make_frame but returns a copper.Dataset
+
+    Returns
+    -------
+        copper.Dataset
+    '''
+    return copper.Dataset(make_frame(**args))
@@ -1,14 +1,54 @@
 import os
+import sys
+import types
+import importlib
 from copper.core.io import *
 from copper.core.set import *
-from copper.core.ml import *
-import copper.core.r as r
-
-import copper.viz.base as plot
-
-import copper.utils.transforms as transform
-import copper.utils.frame
-import copper.utils.ml
+from copper.core.pipeline import Pipeline
+from copper.core.chunked import ChunkedDataset, to_chunks
 
 from copper.core.config import Project
 project = Project()
+
+# Modules that import scikit-learn, matplotlib, scipy or rpy2 are loaded on
+# first access so `import copper` only costs pandas
+_lazy = {
+    'MachineLearning': ('copper.core.ml', 'MachineLearning'),
+    'r': ('copper.core.r', None),
+    'plot': ('copper.viz.base', None),
+    'transform': ('copper.utils.transforms', None),
+    'utils': ('copper.utils', None),
+    'instrument': ('copper.utils.instrument', None),
+}
+
+def _load(name):
+    if name not in _lazy:
+        raise AttributeError("module 'copper' has no attribute '%s'" % name)
+    module, attr = _lazy[name]
+    value = importlib.import_module(module)
+    if attr is not None:
+        value = getattr(value, attr)
+    globals()[name] = value
+    return value
+
+def _dir():
+    return sorted(list(globals().keys()) + list(_lazy.keys()))
+
+# Module attributes on python >= 3.7 (PEP 562)
+__getattr__ = _load
+__dir__ = _dir
+
+class _LazyModule(types.ModuleType):
+    '''
+    Module with the lazy names for python < 3.7, that does not call the
+    module __getattr__ and __dir__ (PEP 562)
+    '''
+
+    def __getattr__(self, name):
+        return _load(name)
+
+    def __dir__(self):
+        return _dir()
+
+if sys.version_info < (3, 7):
+    sys.modules[__name__].__class__ = _LazyModule
@@ -0,0 +1,509 @@
+# coding=utf-8
+from __future__ import division
+import os
+import json
+import shutil
+import copper
+import numpy as np
+import pandas as pd
+from copper.core.set import Dataset
+from copper.core.pipeline import FillNA, Metadata
+from copper.utils.instrument import timed
+
+'''
+Out-of-core Dataset: the columns are stored by chunks of rows as .npy files on
+the project cache directory and only one chunk is in memory at a time.
+
+    ds = copper.to_chunks('big.csv', 'big', chunksize=100000)
+    ds.percent_missing()
+    ds.fillna(method='mean')
+    for X in ds.inputs2ml():
+        ...
+    small = ds.filter(role=ds.INPUT, ret_ds=True).materialize()
+
+Layout of the store: meta.json with the columns, rows of each chunk and
+metadata; c<j>/<i>.npy with the values of column j on chunk i.
+'''
+
+
+def _folder(name):
+    return name if os.path.isabs(name) else os.path.join(copper.project.cache, name)
+
+def _save(path, values):
+    '''
+    Writes an array to a .npy file replacing the file atomically, so arrays
+    memory-mapped from the old file stay valid
+    '''
+    values = np.asarray(values)
+    tmp = path + '.tmp.npy'
+    np.save(tmp, values, allow_pickle=values.dtype == object)
+    os.rename(tmp, path)
+
+def _source_chunks(source, chunksize):
+    if isinstance(source, Dataset):
+        source = source.frame
+    if isinstance(source, pd.DataFrame):
+        for start in range(0, len(source), chunksize):
+            yield source[start:start + chunksize]
+    else:
+        filepath = os.path.join(copper.project.data, source)
+        for frame in pd.read_csv(filepath, chunksize=chunksize):
+            yield frame
+
+@timed('copper.to_chunks')
+def to_chunks(source, name, chunksize=100000):
+    '''
+    Creates a ChunkedDataset from a csv file, a DataFrame or a Dataset
+
+    Parameters
+    ----------
+        source: str (path of a csv file on the project data directory),
+                pandas.DataFrame or copper.Dataset
+        name: str, name of the store on the project cache directory, an
+                   existing store with the same name is replaced. The column
+                   names are converted to str
+        chunksize: int, number of rows of each chunk
+
+    Returns
+    -------
+        copper.ChunkedDataset, the metadata is generated like on
+        Dataset.set_frame or taken from the source Dataset
+    '''
+    folder = _folder(name)
+    if os.access(folder, os.F_OK):
+        shutil.rmtree(folder)
+    os.makedirs(folder)
+
+    columns, rows, counts, numeric = None, [], None, None
+    for i, frame in enumerate(_source_chunks(source, chunksize)):
+        # Column names are saved as json
+        frame = frame.rename(columns=str)
+        if columns is None:
+            columns = frame.columns.tolist()
+            counts = pd.Series(0, index=columns)
+            numeric = pd.Series(True, index=columns)
+            for j in range(len(columns)):
+                os.makedirs(os.path.join(folder, 'c%d' % j))
+        frame = frame.reindex(columns=columns)
+        for j, col in enumerate(columns):
+            values = frame[col]
+            numeric[col] = numeric[col] and values.dtype.kind in 'biuf'
+            _save(os.path.join(folder, 'c%d' % j, '%d.npy' % i), values.values)
+        counts += frame.count()
+        rows.append(len(frame))
+
+    if isinstance(source, Dataset):
+        role, type_ = source.role.rename(str), source.type.rename(str)
+    else:
+        missing = 1 - counts / max(sum(rows), 1)
+        numbers = [c for c in columns if numeric[c]]
+        role, type_ = Dataset()._infer_metadata(columns, missing, numbers)
+
+    meta = {'columns': columns, 'rows': rows,
+            'numeric': [c for c in columns if numeric[c]],
+            'role': dict(role), 'type': dict(type_)}
+    with open(os.path.join(folder, 'meta.json'), 'w') as output:
+        json.dump(meta, output)
+    return ChunkedDataset(folder)
+
+
+class ChunkedDataset(Dataset):
+    '''
+    Dataset with the columns on disk by chunks of rows, see to_chunks.
+
+    Has the same metadata API as Dataset (role, type, filter, metadata) and
+    the statistics run one chunk at a time. The frame is never loaded, use
+    materialize to get a Dataset in memory.
+    '''
+
+    def __init__(self, name, cols=None):
+        '''
+        Opens a store created by to_chunks
+
+        Parameters
+        ----------
+            name: str, name of the store on the project cache or path
+            cols: list, use only this columns
+        '''
+        dict.__init__(self)
+        self.folder = _folder(name)
+        with open(os.path.join(self.folder, 'meta.json')) as input:
+            meta = json.load(input)
+        self._all = meta['columns']
+        self._position = dict((col, j) for j, col in enumerate(self._all))
+        self._rows = meta['rows']
+        self._numeric = set(meta['numeric'])
+        cols = self._all if cols is None else list(cols)
+        self.columns = np.array(cols, dtype=object)
+        self.role = pd.Series(meta['role'], name='Role').reindex(cols)
+        self.type = pd.Series(meta['type'], name='Type').reindex(cols)
+        self.pipeline = None
+        self.hashing = {}
+        self.encoding = {}
+
+    def save_metadata(self):
+        '''
+        Saves the role and type on the store
+        '''
+        path = os.path.join(self.folder, 'meta.json')
+        with open(path) as input:
+            meta = json.load(input)
+        meta['columns'], meta['rows'] = self._all, self._rows
+        meta['numeric'] = [c for c in self._all if c in self._numeric]
+        meta['role'].update(dict(self.role))
+        meta['type'].update(dict(self.type))
+        with open(path, 'w') as output:
+            json.dump(meta, output)
+
+    def _dtype(self, col):
+        '''
+        dtype of a column on memory, read from the headers of the chunks
+        '''
+        dtypes = []
+        for i in range(len(self._rows)):
+            with open(self._path(col, i), 'rb') as input:
+                version = np.lib.format.read_magic(input)
+                if version == (1, 0):
+                    header = np.lib.format.read_array_header_1_0(input)
+                else:
+                    header = np.lib.format.read_array_header_2_0(input)
+                dtypes.append(header[2])
+        return np.result_type(*dtypes)
+
+    def _set_metadata(self, attr, cols, value):
+        step = Metadata(attr, [cols] if type(cols) == str else cols, value)
+        cols = [col for col in step.outputs if col in self.columns]
+        getattr(self, attr)[cols] = value
+        self.save_metadata()
+        self._record(step)
+
+    def set_role(self, cols, role):
+        '''
+        Sets the role of columns and saves it on the store, see
+        Dataset.set_role
+        '''
+        self._set_metadata('role', cols, role)
+
+    def set_type(self, cols, type_):
+        '''
+        Sets the type of columns and saves it on the store, see
+        Dataset.set_type. The values on disk are not converted.
+        '''
+        self._set_metadata('type', cols, type_)
+
+    def get_metadata(self):
+        '''
+        Returns
+        -------
+            pandas.DataFrame with the role and type of each column
+        '''
+        metadata = pd.DataFrame(index=self.columns)
+        metadata['Role'] = self.role
+        metadata['Type'] = self.type
+        metadata['dtype'] = [self._dtype(col) for col in self.columns]
+        return metadata
+
+    metadata = property(get_metadata)
+
+    def _get_frame(self):
+        raise ValueError('A ChunkedDataset has no frame in memory, use chunks() '
+                         'or materialize()')
+
+    frame = property(_get_frame)
+
+    # --------------------------------------------------------------------------
+    #                                 CHUNKS
+    # --------------------------------------------------------------------------
+
+    def _path(self, col, i):
+        return os.path.join(self.folder, 'c%d' % self._position[col], '%d.npy' % i)
+
+    def _load(self, col, i):
+        path = self._path(col, i)
+        try:
+            return np.load(path, mmap_mode='r')
+        except ValueError:
+            # Python objects can not be memory-mapped
+            return np.load(path, allow_pickle=True)
+
+    def _write(self, col, i, values):
+        _save(self._path(col, i), values)
+
+    def chunks(self, cols=None):
+        '''
+        Iterates the rows by chunks
+
+        Parameters
+        ----------
+            cols: list, columns of the chunks, default all
+
+        Returns
+        -------
+            generator of pandas.DataFrame
+        '''
+        for i in range(len(self._rows)):
+            yield self._chunk(i, cols)
+
+    def _chunk(self, i, cols=None):
+        cols = self.columns if cols is None else cols
+        start = sum(self._rows[:i])
+        index = pd.Index(np.arange(start, start + self._rows[i]))
+        data = dict((col, self._load(col, i)) for col in cols)
+        return pd.DataFrame(data, index=index, columns=cols)
+
+    def _datasets(self, cols=None):
+        '''
+        Iterates the chunks as Datasets with the metadata of this Dataset
+        '''
+        cols = self.columns if cols is None else cols
+        for frame in self.chunks(cols):
+            ds = Dataset()
+            ds.set_frame(frame, metadata=False)
+            ds.role, ds.type = self.role[cols], self.type[cols]
+            ds.hashing = self.hashing
+            yield ds
+
+    def materialize(self, cols=None):
+        '''
+        Loads the data
+
+        Returns
+        -------
+            copper.Dataset
+        '''
+        cols = self.columns if cols is None else cols
+        ans = Dataset()
+        ans.set_frame(pd.concat(list(self.chunks(cols))), metadata=False)
+        ans.role = self.role[cols].copy()
+        ans.type = self.type[cols].copy()
+        ans.hashing = dict(self.hashing)
+        return ans
+
+    def filter(self, role=None, type=None, ret_cols=False, ret_ds=False):
+        '''
+        Filter the columns of the Dataset by Role and Type, see Dataset.filter
+
+        Returns
+        -------
+            list of columns if ret_cols, ChunkedDataset with the same storage
+            if ret_ds, if not generator of pandas.DataFrame (chunks)
+        '''
+        cols = Dataset.filter(self, role=role, type=type, ret_cols=True)
+        if ret_cols:
+            return cols
+        elif ret_ds:
+            ans = ChunkedDataset(self.folder, cols)
+            ans.role, ans.type = self.role[cols].copy(), self.type[cols].copy()
+            ans.hashing = dict(self.hashing)
+            return ans
+        else:
+            return self.chunks(cols)
+
+    # --------------------------------------------------------------------------
+    #                                    STATS
+    # --------------------------------------------------------------------------
+
+    def _uniques(self, cols):
+        '''
+        Returns
+        -------
+            dict, column: set of unique values (excludes NA)
+        '''
+        ans = dict((col, set()) for col in cols)
+        for frame in self.chunks(cols):
+            for col in cols:
+                ans[col].update(frame[col].dropna().unique())
+        return ans
+
+    @timed('ChunkedDataset.unique_values', data=lambda args, ans: None)
+    def unique_values(self, ascending=False):
+        '''
+        Generetas a Series with the number of unique values of each column.
+        Note: Excludes NA
+        '''
+        uniques = self._uniques(self.columns)
+        ans = pd.Series([len(uniques[c]) for c in self.columns], index=self.columns)
+        return ans.order(ascending=ascending)
+
+    @timed('ChunkedDataset.percent_missing', data=lambda args, ans: None)
+    def percent_missing(self, ascending=False):
+        '''
+        Generetas a Series with the percent of missing values of each column
+        '''
+        counts = pd.Series(0, index=self.columns)
+        for frame in self.chunks():
+            counts += frame.count()
+        return (1 - counts / max(len(self), 1)).order(ascending=ascending)
+
+    def _number_cols(self):
+        return [c for c in self.columns if c in self._numeric]
+
+    @timed('ChunkedDataset.corr', data=lambda args, ans: None)
+    def corr(self, cols=None, ascending=False):
+        '''
+        Correlation between inputs and target, see Dataset.corr. The pairwise
+        sums are accumulated one chunk at a time.
+        '''
+        numbers = self._number_cols()
+        k = len(numbers)
+        N, Sx, Sxx, Sxy = [np.zeros((k, k)) for i in range(4)]
+        shift = None
+        for frame in self.chunks(numbers):
+            X = frame.values.astype(float)
+            if shift is None:
+                # Shifting the values does not change the correlation and
+                # makes the sums more stable
+                shift = np.nan_to_num(np.nanmean(X, axis=0)) if len(X) else np.zeros(k)
+            X = X - shift
+            M = (~np.isnan(X)).astype(float)
+            X = np.where(M > 0, X, 0)
+            N += M.T.dot(M)
+            Sx += X.T.dot(M)
+            Sxx += (X * X).T.dot(M)
+            Sxy += X.T.dot(X)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            cov = N * Sxy - Sx * Sx.T
+            var = (N * Sxx - Sx * Sx) * (N * Sxx.T - Sx.T * Sx.T)
+            corrs = pd.DataFrame(cov / np.sqrt(var), index=numbers, columns=numbers)
+
+        if cols is None:
+            targets = self.role[self.role == self.TARGET].index
+            cols = targets[0] if len(targets) > 0 else numbers
+        elif cols == 'all':
+            cols = numbers
+        corrs = corrs[cols]
+        if type(corrs) is pd.Series:
+            corrs = corrs[corrs.index != cols]
+            return corrs.order(ascending=ascending)
+        else:
+            return corrs
+
+    @timed('ChunkedDataset.fillna', data=lambda args, ans: None)
+    def fillna(self, cols=None, method='mean', value=None, by=None, **args):
+        '''
+        Fill missing values, see Dataset.fillna. The statistics are computed
+        one chunk at a time (median loads one column at a time) and the chunks
+        are rewritten. knn and by are not supported.
+        '''
+        if by is not None or method == 'knn':
+            raise ValueError('knn and by are not supported on a ChunkedDataset')
+        if cols is None:
+            cols = self.columns
+        if type(cols) == str:
+            cols = [cols]
+        cols = [col for col in cols if self.role[col] != self.REJECTED]
+
+        learned = {}
+        if method in ('mean', 'mode', 'median'):
+            numbers = [c for c in cols if self.type[c] == self.NUMBER
+                                                        and c in self._numeric]
+            categories = [c for c in cols if self.type[c] == self.CATEGORY]
+            if method == 'median':
+                for col in numbers:
+                    learned[col] = self[col].median()
+            elif len(numbers) > 0:
+                sums = pd.Series(0.0, index=numbers)
+                counts = pd.Series(0, index=numbers)
+                for frame in self.chunks(numbers):
+                    sums += frame.sum()
+                    counts += frame.count()
+                learned.update(dict(sums / counts))
+            if len(categories) > 0:
+                modes = dict((col, pd.Series(dtype=float)) for col in categories)
+                for frame in self.chunks(categories):
+                    for col in categories:
+                        modes[col] = modes[col].add(frame[col].value_counts(), fill_value=0)
+                for col in categories:
+                    if len(modes[col]) > 0:
+                        learned[col] = modes[col].idxmax()
+        elif value is not None:
+            learned = dict((col, value) for col in cols)
+
+        for i, frame in enumerate(self.chunks(list(learned.keys()))):
+            for col, fill in learned.items():
+                if frame[col].isnull().any():
+                    self._write(col, i, frame[col].fillna(value=fill).values)
+        self._record(FillNA(learned.keys(), values=learned))
+
+    # --------------------------------------------------------------------------
+    #                                MACHINE LEARNING
+    # --------------------------------------------------------------------------
+
+    def set_encoding(self, cols, method='target'):
+        raise ValueError('encoding is not supported on a ChunkedDataset, see set_hashing')
+
+    def inputs2ml(self):
+        '''
+        Converts the inputs for machine learning one chunk at a time, see
+        copper.transform.inputs2ml. All the chunks have the same columns: the
+        categories are taken from the whole Dataset, except for the columns
+        converted with the hashing trick (see Dataset.set_hashing).
+
+        Returns
+        -------
+            generator of pandas.DataFrame
+        '''
+        inputs = self.filter(role=self.INPUT, ret_cols=True)
+        categories = [c for c in inputs if self.type[c] == self.CATEGORY and
+                                                    c not in self.hashing]
+        levels = self._uniques(categories)
+        levels = dict((col, sorted(levels[col])) for col in categories)
+        for ds in self._datasets(inputs):
+            yield copper.transform.inputs2ml(ds, categories=levels,
+                                                    hashing=self.hashing)
+
+    # --------------------------------------------------------------------------
+    #                    SPECIAL METHODS / PANDAS API
+    # --------------------------------------------------------------------------
+
+    def __getitem__(self, name):
+        '''
+        Loads one column
+        '''
+        return pd.concat([frame[name] for frame in self.chunks([name])])
+
+    def __setitem__(self, name, values):
+        '''
+        Writes one column, a new column gets role Input and the type of its
+        values
+        '''
+        values = pd.Series(values)
+        if len(values) != len(self):
+            raise ValueError('Expected %d values, got %d' % (len(self), len(values)))
+        if name not in self._position:
+            self._position[name] = len(self._all)
+            self._all.append(name)
+            os.makedirs(os.path.join(self.folder, 'c%d' % self._position[name]))
+        if name not in self.columns:
+            self.columns = np.append(self.columns, name).astype(object)
+            kind = values.dtype.kind
+            self.role[name] = self.INPUT
+            self.type[name] = self.NUMBER if kind in 'biuf' else self.CATEGORY
+        if values.dtype.kind in 'biuf':
+            self._numeric.add(name)
+        else:
+            self._numeric.discard(name)
+
+        start = 0
+        for i, rows in enumerate(self._rows):
+            self._write(name, i, values.values[start:start + rows])
+            start += rows
+        self.save_metadata()
+
+    def __len__(self):
+        return sum(self._rows)
+
+    def head(self, n=5):
+        return next(self.chunks()).head(n)
+
+    def tail(self, n=5):
+        return self._chunk(len(self._rows) - 1).tail(n)
+
+    def __reduce_ex__(self, protocol):
+        # Only the reference to the store is pickled
+        return (ChunkedDataset, (self.folder, list(self.columns)),
+                {'role': self.role, 'type': self.type, 'hashing': self.hashing})
+
+    def __setstate__(self, state):
+        self.role, self.type = state['role'], state['type']
+        self.hashing = state.get('hashing', {})
@@ -45,6 +45,6 @@ class Project(object):
     path = property(get_path, set_path)
     data = property(get_data)
     exported = property(get_exported)
-    cache = property(get_data)
+    cache = property(get_cache)
     graphs = property(get_graphs)
     logs = property(get_logs)
@@ -2,19 +2,99 @@
 from __future__ import division
 import os
 import io
+import sys
+import copy
 import json
 import pickle
 
 import copper
+import numpy as np
 import pandas as pd
 
 
-def load(filepath):
-    ''' Loads a pickled dataset
+class _ArrayPickler(pickle.Pickler):
+    '''
+    Pickler that saves the big numerical arrays to separate .npy files
+    '''
+
+    def __init__(self, file, folder, min_bytes):
+        pickle.Pickler.__init__(self, file, protocol=2)
+        self.folder = folder
+        self.min_bytes = min_bytes
+        self.saved = {}
+
+    def persistent_id(self, obj):
+        # np.memmap too: a loaded MachineLearning saved again
+        if not isinstance(obj, np.ndarray) or obj.dtype.hasobject or \
+                                            obj.nbytes < self.min_bytes:
+            return None
+        if id(obj) not in self.saved:
+            name = 'array_%d.npy' % len(self.saved)
+            np.save(os.path.join(self.folder, name), np.asarray(obj))
+            self.saved[id(obj)] = (name, obj) # keep obj alive: ids are unique
+        return self.saved[id(obj)][0]
+
+class _ArrayUnpickler(pickle.Unpickler):
+    '''
+    Unpickler that loads the arrays saved by _ArrayPickler memory-mapped
+    '''
+
+    def __init__(self, file, folder, mmap_mode):
+        pickle.Unpickler.__init__(self, file)
+        self.folder = folder
+        self.mmap_mode = mmap_mode
+
+    def persistent_load(self, name):
+        return np.load(os.path.join(self.folder, name), mmap_mode=self.mmap_mode)
+
+def _save_ml(ml, folder, min_bytes=65536, keep_data=True):
+    '''
+    Saves a MachineLearning to a folder: the big arrays (training data and the
+    arrays of the models) are saved as raw .npy files and the rest is pickled
+
+    Only the arrays that the models keep as they are unpickled stay
+    memory-mapped: the training and testing data and the arrays of linear
+    models, SVMs and naive Bayes (e.g. support vectors, coefficients).
+
+    Tree based models (DecisionTree, RandomForest, ExtraTrees,
+    GradientBoosting, ...) are NOT shared: the scikit-learn trees keep their
+    nodes on their own memory and copy them from the saved arrays when they
+    are unpickled, so each process that loads an ensemble has its own copy.
+    Saving and loading them works, it only does not save memory.
+    '''
+    if not keep_data:
+        # A model used only to score new data does not need the matrices
+        ml = copy.copy(ml)
+        ml.X_train, ml.y_train, ml.X_test, ml.y_test = None, None, None, None
+    if not (os.access(folder, os.F_OK)):
+        os.makedirs(folder)
+    for name in os.listdir(folder):
+        if name.startswith('array_') and name.endswith('.npy'):
+            os.remove(os.path.join(folder, name))
+    with open(os.path.join(folder, 'ml.pkl'), 'wb') as output:
+        _ArrayPickler(output, folder, min_bytes).dump(ml)
+
+def _load_ml(folder, mmap_mode='r'):
+    '''
+    Loads a MachineLearning saved with _save_ml, the arrays are memory-mapped
+    so several processes loading the same files share one copy on memory
+    (except the arrays of tree based models, see _save_ml)
+    '''
+    with open(os.path.join(folder, 'ml.pkl'), 'rb') as input:
+        return _ArrayUnpickler(input, folder, mmap_mode).load()
+
+def load(filepath, mmap_mode='r'):
+    ''' Loads a pickled dataset or a saved MachineLearning (.ml)
+
+    Parameters
+    ----------
+        mmap_mode: str, mode to memory-map the arrays of a MachineLearning,
+                        None to load them into memory. The arrays of tree
+                        based models are always loaded into memory
 
     Returns
     -------
-        copper.Dataset
+        copper.Dataset or copper.MachineLearning
     '''
     if len(filepath.split('.')) == 1:
         filepath = filepath + '.dataset'
@@ -23,20 +103,36 @@ def load(filepath):
         f = os.path.join(copper.project.data, filepath)
         pkl_file = open(f, 'rb')
         return pickle.load(pkl_file)
+    elif filepath.endswith('.ml'):
+        return _load_ml(os.path.join(copper.project.data, filepath), mmap_mode)
 
-def save(data, name, format=None, to=''):
-    ''' Saves a picke Dataset or a csv file
+def save(data, name, format=None, to='', keep_data=True):
+    ''' Saves a picke Dataset, a MachineLearning or a csv file
+
+    A MachineLearning is saved on the folder name.ml, with the big arrays of
+    the data and the fitted models on separate files that copper.load
+    memory-maps. The arrays of tree based models are copied on load, they
+    are not shared between processes (see _save_ml)
 
     Parameters
     ----------
         to: str, folder to save the file
+        keep_data: boolean, False to not save the training and testing arrays
+                            of a MachineLearning, e.g. to only score new data
     '''
     fp = os.path.join(copper.project.data, to)
     if not (os.access(fp, os.F_OK)):
             os.makedirs(fp)
 
-    if format is None and type(data) is copper.Dataset:
-        # Save pickled version
+    # data cannot be a MachineLearning if copper.core.ml was never imported,
+    # checking it first avoids importing scikit-learn
+    is_ml = 'copper.core.ml' in sys.modules and \
+                                isinstance(data, copper.MachineLearning)
+
+    if format is None and is_ml:
+        _save_ml(data, os.path.join(fp, name + '.ml'), keep_data=keep_data)
+    elif format is None and isinstance(data, copper.Dataset):
+        # Save pickled version, a ChunkedDataset only pickles its store path
         f = os.path.join(fp, name + '.dataset')
         output = open(f, 'wb')
         pickle.dump(data, output)
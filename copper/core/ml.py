@@ -1,5 +1,7 @@
 # coding=utf-8
 from __future__ import division
+import os
+import time
 import copper
 import numpy as np
 import pandas as pd
@@ -7,8 +9,14 @@ import matplotlib.pyplot as plt
 
 from sklearn.metrics import auc
 from sklearn.metrics import roc_curve
-from sklearn.metrics import confusion_matrix
 from sklearn.metrics import mean_squared_error
+from copper.utils.instrument import timed
+
+def _train_data(args, ans):
+    return args[0].X_train
+
+def _test_data(args, ans):
+    return args[0].X_test
 
 
 class MachineLearning():
@@ -25,23 +33,74 @@ class MachineLearning():
         self.y_train = None
         self.X_test  = None
         self.y_test = None
+        self._cache = {}
+        self._cache_X = None
+        self._columns = None
+        self._roles = None
+        self._types = None
+        self._hashing = None
+        self._encoding = None
+        self.pipeline = None
+
+    def __getstate__(self):
+        '''
+        The cached predictions are not pickled
+        '''
+        state = self.__dict__.copy()
+        state['_cache'] = {}
+        state['_cache_X'] = None
+        return state
 
     # --------------------------------------------------------------------------
     #                               PROPERTIES
     # --------------------------------------------------------------------------
 
+    def _set_layout(self, ds, inputs):
+        '''
+        Saves the metadata and the encoded columns of the training Dataset,
+        used to encode new data with the same columns. If the transformations
+        of the Dataset were recorded (Dataset.record) they are replayed on the
+        new raw data.
+        '''
+        self._columns = inputs.columns
+        self._roles = ds.role.copy()
+        self._types = ds.type.copy()
+        self._hashing = dict(getattr(ds, 'hashing', None) or {})
+        self._encoding = copper.transform.learn_encodings(ds)
+        pipeline = getattr(ds, 'pipeline', None)
+        self.pipeline = None if pipeline is None else pipeline.copy()
+
+    def _encode(self, ds):
+        '''
+        Encodes the inputs of a Dataset with the same columns used on training,
+        category levels not seen on training are ignored
+
+        Returns
+        -------
+            np.array
+        '''
+        inputs = copper.transform.inputs2ml(ds, hashing=getattr(self, '_hashing', None),
+                                        encoding=getattr(self, '_encoding', None))
+        if self._columns is not None:
+            inputs = inputs.reindex(columns=self._columns, fill_value=0)
+        return inputs.values
+
     def set_train(self, ds):
         '''
         Uses a Dataset to set the values of inputs and targets for training
         '''
-        self.X_train = copper.transform.inputs2ml(ds).values
+        inputs = copper.transform.inputs2ml(ds)
+        self._set_layout(ds, inputs)
+        self.X_train = inputs.values
         self.y_train = copper.transform.target2ml(ds).values
 
     def set_test(self, ds):
         '''
         Uses a Dataset to set the values of inputs and targets for testing
         '''
-        self.X_test = copper.transform.inputs2ml(ds).values
+        inputs = copper.transform.inputs2ml(ds, hashing=getattr(self, '_hashing', None),
+                                        encoding=getattr(self, '_encoding', None))
+        self.X_test = inputs.values
         self.y_test = copper.transform.target2ml(ds).values
 
     train = property(None, set_train)
@@ -52,6 +111,7 @@ class MachineLearning():
         Adds a new classifier
         '''
         self._clfs[name] = clf
+        self._cache = {}
 
     def add_clfs(self, clfs, prefix):
         '''
@@ -65,12 +125,14 @@ class MachineLearning():
         Removes a classifier
         '''
         del self._clfs[name]
+        self._cache = {}
 
     def clear_clfs(self):
         '''
         Removes all classifiers
         '''
         self._clfs = {}
+        self._cache = {}
 
     def list_clfs(self):
         '''
@@ -92,14 +154,262 @@ class MachineLearning():
     #                            Scikit-learn API
     # --------------------------------------------------------------------------
 
+    @timed('MachineLearning.fit', data=_train_data)
     def fit(self):
         '''
         Fit all the classifiers
         '''
         for clf_name in self.clfs.index:
             self._clfs[clf_name].fit(self.X_train, self.y_train)
+        self._cache = {}
+
+    def _stream_layout(self, source, chunksize):
+        '''
+        Pass over the data to fix the encoded columns (all the categories of
+        the categorical inputs not hashed or encoded) and the classes of the
+        target
+
+        Returns
+        -------
+            list, labels of a categorical target or None for a numerical target
+            np.array, classes for partial_fit
+        '''
+        hashing = getattr(source, 'hashing', None) or self._hashing or {}
+        encoding = self._encoding or {}
+        if isinstance(source, copper.Dataset) and getattr(source, 'encoding', None):
+            # Learned on all the source, the chunks are too small to learn it
+            encoding = copper.transform.learn_encodings(source)
+        first, levels, targets = None, {}, set()
+        for ds in self._chunks(source, chunksize):
+            if first is None:
+                first = ds
+                if self._roles is None:
+                    # Metadata of the first chunk of a csv for the others
+                    self._roles, self._types = ds.role.copy(), ds.type.copy()
+            for col in ds.filter(role=ds.INPUT, type=ds.CATEGORY, ret_cols=True):
+                if col not in hashing and col not in encoding:
+                    levels.setdefault(col, set()).update(ds.frame[col].dropna().unique())
+            target = ds.filter(role=ds.TARGET, ret_cols=True)[0]
+            targets.update(ds.frame[target].dropna().unique())
+
+        levels = dict((col, sorted(values)) for col, values in levels.items())
+        first.hashing, first.encoding = hashing, encoding
+        inputs = copper.transform.inputs2ml(first, categories=levels)
+        pipeline = self.pipeline
+        self._set_layout(first, inputs)
+        self.pipeline = pipeline
+
+        targets = sorted(targets)
+        if first.type[target] == first.CATEGORY:
+            return targets, np.arange(len(targets))
+        return None, np.array(targets)
+
+    def _stream_oof(self, source):
+        '''
+        Out of fold target encoding (see category2target) of the training
+        Dataset. The training chunks use it instead of the encodings learned
+        on all the rows, that include the target of the row being encoded.
+
+        Returns
+        -------
+            dict, position of the encoded column: np.array with the values of
+            all the rows
+        '''
+        ans = {}
+        if isinstance(source, copper.ChunkedDataset) or \
+                        not isinstance(source, copper.Dataset):
+            return ans
+        encoding = getattr(source, 'encoding', None) or {}
+        target = None
+        for col, method in encoding.items():
+            if method == 'target' and source.role[col] == source.INPUT:
+                if target is None:
+                    target = copper.transform.target2ml(source).values
+                new_cols = copper.transform.category2target(source.frame[col], target)
+                position = self._columns.tolist().index(new_cols.columns[0])
+                ans[position] = new_cols.values[:, 0]
+        return ans
+
+    def _stream_xy(self, source, chunksize, labels, oof=None):
+        '''
+        Iterates the encoded inputs and target of the chunks, the rows with
+        missing target are skipped
+
+        Parameters
+        ----------
+            oof: dict, values of encoded columns of all the rows that replace
+                       the encoded values of each chunk, see _stream_oof
+        '''
+        start = 0
+        for ds in self._chunks(source, chunksize):
+            X = self._encode(ds)
+            if oof:
+                X = X.astype(float)
+                for position, values in oof.items():
+                    X[:, position] = values[start:start + len(X)]
+            start += len(X)
+            y = ds.frame[ds.filter(role=ds.TARGET, ret_cols=True)[0]].values
+            if labels is None:
+                valid = ~pd.isnull(y)
+            else:
+                y = pd.Index(labels).get_indexer(y)
+                valid = y >= 0
+            if not valid.all():
+                X, y = X[valid], y[valid]
+            if len(y) > 0:
+                yield X, y
+
+    @timed('MachineLearning.fit_stream')
+    def fit_stream(self, source, chunksize=100000, epochs=1, holdout=None,
+                   clfs=None, verbose=False):
+        '''
+        Fits the classifiers that have partial_fit (e.g. SGDClassifier,
+        naive Bayes, PassiveAggressiveClassifier) one chunk at a time, so the
+        memory used is bounded by chunksize.
+
+        A first pass over the data finds the categories of the inputs and the
+        classes of the target so every chunk is encoded with the same columns.
+        The target encoded inputs (see Dataset.set_encoding) of the training
+        chunks are computed out of fold on all the source, the encodings
+        learned on all the rows are used for the holdout and new data.
+        If the source is a csv file and there is no training layout the
+        metadata of the first chunk is used.
+
+        Parameters
+        ----------
+            source: copper.Dataset, copper.ChunkedDataset or str, path of a csv
+                        file on the project data directory
+            chunksize: int, number of rows of each chunk
+            epochs: int, number of passes over the data
+            holdout: same as source, data to evaluate after each epoch
+            clfs: list, of classifiers to fit, default all with partial_fit
+            verbose: boolean, True to print the progress after every epoch
 
-    def predict(self, ds=None, clfs=None, ):
+        Returns
+        -------
+            pandas.DataFrame with the rows, seconds and holdout accuracy of each
+            classifier on each epoch
+        '''
+        if clfs is None:
+            clfs = self.clfs.index
+        elif type(clfs) is str:
+            clfs = [clfs]
+        clfs = [c for c in clfs if hasattr(self._clfs[c], 'partial_fit')]
+        if len(clfs) == 0:
+            raise ValueError('There are no classifiers with partial_fit')
+
+        labels, classes = self._stream_layout(source, chunksize)
+        oof = self._stream_oof(source)
+        self._cache = {}
+
+        rows = []
+        for epoch in range(epochs):
+            n = dict((c, 0) for c in clfs)
+            seconds = dict((c, 0.0) for c in clfs)
+            for X, y in self._stream_xy(source, chunksize, labels, oof):
+                for clf_name in clfs:
+                    start = time.time()
+                    self._clfs[clf_name].partial_fit(X, y, classes=classes)
+                    seconds[clf_name] += time.time() - start
+                    n[clf_name] += len(y)
+
+            accuracy = dict((c, np.nan) for c in clfs)
+            if holdout is not None:
+                correct, total = dict((c, 0) for c in clfs), 0
+                for X, y in self._stream_xy(holdout, chunksize, labels):
+                    for clf_name in clfs:
+                        correct[clf_name] += np.sum(self._clfs[clf_name].predict(X) == y)
+                    total += len(y)
+                accuracy = dict((c, correct[c] / max(total, 1)) for c in clfs)
+
+            for clf_name in clfs:
+                rows.append([epoch, clf_name, n[clf_name], seconds[clf_name],
+                             accuracy[clf_name]])
+                if verbose:
+                    print('Epoch %d: %s %d rows, %.1f seconds, holdout accuracy %.4f' %
+                          (epoch, clf_name, n[clf_name], seconds[clf_name], accuracy[clf_name]))
+        cols = ['Epoch', 'Classifier', 'Rows', 'Seconds', 'Holdout accuracy']
+        return pd.DataFrame(rows, columns=cols)
+
+    def _cached(self, method, clf_name):
+        '''
+        Cached output of a method (predict or predict_proba) of a classifier
+        on self.X_test. The cache is cleared when the classifiers change and
+        when self.X_test is replaced.
+        '''
+        if self._cache_X is not self.X_test:
+            self._cache = {}
+            self._cache_X = self.X_test
+        key = (method, clf_name)
+        if key not in self._cache:
+            self._cache[key] = getattr(self._clfs[clf_name], method)(self.X_test)
+        return self._cache[key]
+
+    def _scores(self, X, clfs, proba=False, n_jobs=1):
+        '''
+        Predictions (or probabilities of every class) of the classifiers.
+        The results are written straight into one preallocated matrix and the
+        classifiers are scored concurrently on a pool of threads (most
+        scikit-learn predictors release the GIL). The rows are split among
+        the workers so the rows scored at once by all the threads (and the
+        memory of the predictors) are bounded by len(X). The predictions keep
+        the dtype of the labels (e.g. str labels give an object matrix).
+
+        Returns
+        -------
+            pandas.DataFrame, with columns "clf [class]" for probabilities
+        '''
+        if not proba:
+            cols = list(clfs)
+            blocks = [(clf_name, i, i + 1) for i, clf_name in enumerate(clfs)]
+        else:
+            cols, blocks = [], []
+            for clf_name in clfs:
+                classes = getattr(self._clfs[clf_name], 'classes_', None)
+                if classes is None:
+                    classes = np.unique(self.y_train) if self.y_train is not None else [0, 1]
+                blocks.append((clf_name, len(cols), len(cols) + len(classes)))
+                cols.extend(['%s [%s]' % (clf_name, value) for value in classes])
+
+        dtype = float if proba else self._predict_dtype(X, clfs)
+        ans = np.empty((len(X), len(cols)), dtype=dtype)
+        def run(task):
+            (clf_name, start, end), rows = task
+            clf = self._clfs[clf_name]
+            if proba:
+                ans[rows, start:end] = clf.predict_proba(X[rows])
+            else:
+                ans[rows, start] = clf.predict(X[rows])
+
+        workers = copper.utils.parallel.n_workers(n_jobs)
+        size = max(1, int(np.ceil(len(X) / workers)))
+        slices = [slice(i, i + size) for i in range(0, len(X), size)]
+        tasks = [(block, rows) for block in blocks for rows in slices]
+        copper.utils.parallel.pmap(run, tasks, n_jobs=n_jobs)
+        return pd.DataFrame(ans, columns=cols)
+
+    def _predict_dtype(self, X, clfs):
+        '''
+        dtype of the predictions of the classifiers: the dtype of the classes
+        or of the prediction of the first row, object if they are not all
+        numbers
+        '''
+        dtypes = []
+        for clf_name in clfs:
+            clf = self._clfs[clf_name]
+            classes = getattr(clf, 'classes_', None)
+            if classes is not None:
+                dtypes.append(np.asarray(classes).dtype)
+            elif len(X) > 0:
+                dtypes.append(np.asarray(clf.predict(X[:1])).dtype)
+        if len(dtypes) == 0:
+            return float
+        if all(dtype.kind in 'biuf' for dtype in dtypes):
+            return np.result_type(*dtypes)
+        return object
+
+    @timed('MachineLearning.predict')
+    def predict(self, ds=None, clfs=None, n_jobs=1):
         '''
         Make the classifiers predict the testing inputs
 
@@ -107,6 +417,7 @@ class MachineLearning():
         ----------
             ds: copper.Dataset, dataset fot the prediction, default is self.test
             clfs: list, of classifiers to make prediction, default all
+            n_jobs: int, number of threads, -1 to use all the cpus
 
         Returns
         -------
@@ -115,42 +426,131 @@ class MachineLearning():
         if clfs is None:
             clfs = self.clfs.index
         if ds is not None:
-            X_test = copper.transform.inputs2ml(ds).values
+            X_test = self._encode(ds)
         else:
             X_test = self.X_test
+        return self._scores(X_test, clfs, n_jobs=n_jobs)
 
-        ans = pd.DataFrame(np.zeros((len(X_test), len(clfs))), columns=clfs, index=range(len(X_test)))
-        for clf_name in clfs:
-            clf = self._clfs[clf_name]
-            scores = clf.predict(X_test)
-            ans[clf_name][:] = pd.Series(scores)
-        return ans
-
-    def predict_proba(self, ds=None, clfs=None, ):
+    @timed('MachineLearning.predict_proba')
+    def predict_proba(self, ds=None, clfs=None, n_jobs=1):
         '''
         Make the classifiers predict probabilities of inputs
         Parameters
         ----------
             ds: copper.Dataset, dataset fot the prediction, default is self.test
             clfs: list, of classifiers to make prediction, default all
+            n_jobs: int, number of threads, -1 to use all the cpus
 
         Returns
         -------
-            pandas.DataFrame with the predicted probabilities
+            pandas.DataFrame with the predicted probabilities of every class,
+            one column "classifier [class]" for each classifier and class
         '''
         if clfs is None:
             clfs = self.clfs.index
         if ds is not None:
-            X_test = copper.transform.inputs2ml(ds).values
+            X_test = self._encode(ds)
         else:
             X_test = self.X_test
+        return self._scores(X_test, clfs, proba=True, n_jobs=n_jobs)
 
-        ans = pd.DataFrame(np.zeros((len(X_test), len(clfs))), columns=clfs, index=range(len(X_test)))
-        for clf_name in clfs:
-            clf = self._clfs[clf_name]
-            scores = clf.predict_proba(X_test)[:,0]
-            ans[clf_name][:] = pd.Series(scores)
-        return ans
+    def _dataset(self, frame, roles=None, types=None):
+        '''
+        Creates a Dataset of a frame with the given metadata, default the
+        metadata of the training Dataset (columns not used on training are
+        rejected). If there is no metadata it is generated.
+        '''
+        if roles is None:
+            roles, types = self._roles, self._types
+        if roles is None:
+            return copper.Dataset(frame)
+        ds = copper.Dataset()
+        ds.set_frame(frame, metadata=False)
+        ds.role = roles.reindex(ds.columns).fillna(ds.REJECTED)
+        ds.type = types.reindex(ds.columns).fillna(ds.CATEGORY)
+        return ds
+
+    def _prepare(self, frame):
+        '''
+        Creates a Dataset of new raw data: replays the pipeline recorded on the
+        training Dataset, if there is no pipeline see _dataset
+        '''
+        if getattr(self, 'pipeline', None) is None:
+            return self._dataset(frame)
+        return self.pipeline.replay(frame, cache=False)
+
+    def _chunks(self, source, chunksize):
+        '''
+        Iterates a Dataset or a csv file (on the project data directory) by
+        chunks of rows, or a ChunkedDataset by its chunks. The chunks are
+        Datasets with the metadata of the source Dataset or of the training
+        Dataset for csv files (see _prepare).
+        '''
+        if isinstance(source, copper.ChunkedDataset):
+            for ds in source._datasets():
+                yield ds
+        elif isinstance(source, copper.Dataset):
+            for start in range(0, len(source), chunksize):
+                yield self._dataset(source.frame[start:start + chunksize],
+                                                    source.role, source.type)
+        else:
+            filepath = os.path.join(copper.project.data, source)
+            for frame in pd.read_csv(filepath, chunksize=chunksize):
+                yield self._prepare(frame)
+
+    @timed('MachineLearning.predict_to_file')
+    def predict_to_file(self, source, name, chunksize=100000, clfs=None,
+                            proba=False, to='', verbose=False, n_jobs=-1):
+        '''
+        Makes the classifiers predict a Dataset or a csv file one chunk at a
+        time and appends the predictions to a csv file on the project data
+        directory, so the memory used is bounded by chunksize.
+        If the data has a column with role=ID it is used as index.
+
+        Parameters
+        ----------
+            source: copper.Dataset or str, path of a csv file on the project
+                            data directory
+            name: str, name of the predictions file (name.csv)
+            chunksize: int, number of rows predicted at once
+            clfs: list, of classifiers to make prediction, default all
+            proba: boolean, True to save probabilities instead of predictions
+            to: str, folder (on the data directory) to save the file
+            verbose: boolean, True to print the progress after every chunk
+            n_jobs: int, number of threads, -1 to use all the cpus
+
+        Returns
+        -------
+            pandas.Series with the rows, chunks, seconds and rows per second
+        '''
+        if clfs is None:
+            clfs = self.clfs.index
+        folder = os.path.join(copper.project.data, to)
+        if not (os.access(folder, os.F_OK)):
+            os.makedirs(folder)
+        filepath = os.path.join(folder, name + '.csv')
+
+        rows, chunks, start = 0, 0, time.time()
+        with open(filepath, 'w') as output:
+            for chunk in self._chunks(source, chunksize):
+                X = self._encode(chunk)
+                ans = self._scores(X, clfs, proba=proba, n_jobs=n_jobs)
+                ans.index = chunk.frame.index
+                ids = chunk.filter(role=chunk.ID, ret_cols=True)
+                if len(ids) > 0:
+                    ans.index = chunk.frame[ids[0]].values
+                    ans.index.name = ids[0]
+                ans.to_csv(output, header=(chunks == 0))
+
+                rows, chunks = rows + len(X), chunks + 1
+                if verbose:
+                    elapsed = time.time() - start
+                    print('%d rows in %d chunks: %.1f seconds, %.0f rows/second' %
+                                        (rows, chunks, elapsed, rows / elapsed))
+
+        elapsed = time.time() - start
+        return pd.Series([rows, chunks, elapsed, rows / elapsed], name=filepath,
+                        index=['Rows', 'Chunks', 'Seconds', 'Rows per second'])
 
     # ----------------------------------------------------------------------------------------
     #                                            METRICS
@@ -166,6 +566,7 @@ class MachineLearning():
             ans[clf_name] = fnc(clf, X_test=self.X_test, y_test=self.y_test)
         return ans.order(ascending=ascending)
 
+    @timed('MachineLearning.accuracy', data=_test_data)
     def accuracy(self, **args):
         '''
         Calculates the accuracy of inputs
@@ -183,25 +584,35 @@ class MachineLearning():
 
         return self._metric_wrapper(fnc, name='Accuracy', **args)
 
-    def auc(self, **args):
+    @timed('MachineLearning.auc', data=_test_data)
+    def auc(self, bins=None, chunksize=100000, n_jobs=1, **args):
         '''
         Calculates the Area Under the ROC Curve
 
         Parameters
         ----------
             ascending: boolean, sort the Series on this direction
+            bins: int, if given the area is approximated with histograms of
+                       bins bins of the probabilities, see
+                       copper.utils.ml.BinnedROC. Useful for big test sets.
+            chunksize: int, rows predicted at once when using bins
+            n_jobs: int, number of workers when using bins
 
         Returns
         -------
             pandas.Series with the Area under the Curve
         '''
         def fnc (clf, X_test=None, y_test=None):
+            if bins is not None:
+                return copper.utils.ml.binned_roc(clf, X_test, y_test, bins=bins,
+                                    chunksize=chunksize, n_jobs=n_jobs).auc()
             probas = clf.predict_proba(X_test)
             fpr, tpr, thresholds = roc_curve(y_test, probas[:, 1])
             return auc(fpr, tpr)
 
         return self._metric_wrapper(fnc, name='Area Under the Curve', **args)
 
+    @timed('MachineLearning.mse', data=_test_data)
     def mse(self, **args):
         '''
         Calculates the Mean Squared Error
@@ -239,7 +650,9 @@ class MachineLearning():
             nothing, self.X_train, self.y_train, self.X_test, self.y_test are set
         '''
         from sklearn import cross_validation
-        inputs = copper.transform.inputs2ml(ds).values
+        inputs = copper.transform.inputs2ml(ds)
+        self._set_layout(ds, inputs)
+        inputs = inputs.values
         target = copper.transform.target2ml(ds).values
 
         X_train, X_test, y_train, y_test = cross_validation.train_test_split(
@@ -250,10 +663,194 @@ class MachineLearning():
         self.y_train = y_train
         self.y_test = y_test
 
+    @timed('MachineLearning.cross_validate', data=_train_data)
+    def cross_validate(self, k=5, ds=None, stratified=True, n_jobs=1, clfs=None,
+                                                            random_state=0):
+        '''
+        k-fold cross validation of the classifiers.
+        The data is encoded once and every classifier x fold is fitted on a
+        copy of the classifier on a pool of workers that share the matrices,
+        each task only receives the indexes of its fold.
+
+        Parameters
+        ----------
+            k: int, number of folds
+            ds: copper.Dataset, dataset to use, default self.X_train, self.y_train
+            stratified: boolean, True to keep the proportion of each target
+                                 value on every fold
+            n_jobs: int, number of workers, -1 to use all the cpus
+            clfs: list, of classifiers to validate, default all
+            random_state: int, seed of the folds
+
+        Returns
+        -------
+            pandas.DataFrame with one row per classifier and fold, the Area
+            Under the Curve is NaN for targets with more than two classes
+        '''
+        if ds is not None:
+            X = copper.transform.inputs2ml(ds).values
+            y = copper.transform.target2ml(ds).values
+        else:
+            X, y = self.X_train, self.y_train
+        if clfs is None:
+            clfs = self.clfs.index
+        elif type(clfs) is str:
+            clfs = [clfs]
+
+        folds = copper.utils.ml.kfold(y, k=k, stratified=stratified,
+                                                random_state=random_state)
+        binary = len(np.unique(y)) == 2
+
+        def run(task):
+            clf_name, fold = task
+            train_index, test_index = folds[fold]
+            clf = copper.utils.ml.clone_clf(self._clfs[clf_name])
+
+            start = time.time()
+            clf.fit(X[train_index], y[train_index])
+            fit_time = time.time() - start
+
+            start = time.time()
+            y_pred = clf.predict(X[test_index])
+            predict_time = time.time() - start
+
+            y_test = y[test_index]
+            area = np.nan # Only for binary targets and models with predict_proba
+            if binary and hasattr(clf, 'predict_proba'):
+                probas = clf.predict_proba(X[test_index])
+                try:
+                    fpr, tpr, thresholds = roc_curve(y_test, probas[:, 1])
+                    area = auc(fpr, tpr)
+                except ValueError:
+                    pass # e.g. only one class on the fold
+            return [clf_name, fold, np.mean(y_pred == y_test), area,
+                    mean_squared_error(y_test, y_pred), fit_time, predict_time]
+
+        tasks = [(clf_name, fold) for clf_name in clfs for fold in range(k)]
+        rows = copper.utils.parallel.pmap(run, tasks, n_jobs=n_jobs)
+        cols = ['Classifier', 'Fold', 'Accuracy', 'Area Under the Curve',
+                'Mean Squared Error', 'Fit time', 'Predict time']
+        return pd.DataFrame(rows, columns=cols)
+
+    @timed('MachineLearning.search', data=_train_data)
+    def search(self, clf, params, prefix, n_iter=None, keep=1, factor=3,
+               min_samples=None, validation=0.25, n_jobs=1, random_state=0):
+        '''
+        Hyperparameter search using successive halving.
+        All the candidates are fitted on a small sample of the training data,
+        only the best 1/factor are fitted again on a sample factor times
+        bigger, and so on until only keep candidates are left. The survivors
+        are fitted on all the training data and added to the classifiers as
+        prefix_0, prefix_1, ...
+
+        Parameters
+        ----------
+            clf: scikit-learn classifier, base estimator
+            params: dict, parameter name -> list of values or distribution,
+                          see copper.utils.ml.param_candidates
+            prefix: str, prefix for the name of the classifiers
+            n_iter: int, number of random candidates, default all the grid
+            keep: int, number of classifiers to add
+            factor: int, 1/factor candidates survive each round
+            min_samples: int, samples used on the first round
+            validation: float, percent of the training data used to score
+                               the candidates
+            n_jobs: int, number of workers, -1 to use all the cpus
+            random_state: int, seed for the samples and the candidates
+
+        Returns
+        -------
+            pandas.DataFrame with the score of each candidate on each round,
+            -inf and the error if the fit raised a ValueError (other errors
+            are raised)
+        '''
+        candidates = copper.utils.ml.param_candidates(params, n_iter=n_iter,
+                                                      random_state=random_state)
+        rng = np.random.RandomState(random_state)
+        index = rng.permutation(len(self.X_train))
+        n_validation = int(len(index) * validation)
+        X_val = self.X_train[index[:n_validation]]
+        y_val = self.y_train[index[:n_validation]]
+        train_index = index[n_validation:]
+
+        n_rounds = 0
+        while len(candidates) > keep * factor ** n_rounds:
+            n_rounds += 1
+        if min_samples is None:
+            min_samples = int(len(train_index) / factor ** n_rounds)
+
+        def run(task):
+            i, n_samples = task
+            sample = train_index[:n_samples]
+            model = copper.utils.ml.clone_clf(clf)
+            model.set_params(**candidates[i])
+            try:
+                model.fit(self.X_train[sample], self.y_train[sample])
+                return model.score(X_val, y_val), None
+            except ValueError as e:
+                # e.g. a value out of range or one target value on the sample
+                return -np.inf, '%s: %s' % (type(e).__name__, e)
+
+        history = []
+        alive = list(range(len(candidates)))
+        for rnd in range(n_rounds + 1):
+            n_samples = min(len(train_index), min_samples * factor ** rnd)
+            results = copper.utils.parallel.pmap(run, [(i, n_samples) for i in alive],
+                                                 n_jobs=n_jobs)
+            scores = [score for score, error in results]
+            for i, (score, error) in zip(alive, results):
+                history.append([rnd, n_samples, i, str(candidates[i]), score, error])
+            n_alive = max(keep, int(np.ceil(len(alive) / factor)))
+            alive = [alive[i] for i in np.argsort(scores)[::-1][:n_alive]]
+            if len(alive) <= keep:
+                break
+
+        def refit(i):
+            model = copper.utils.ml.clone_clf(clf)
+            model.set_params(**candidates[i])
+            model.fit(self.X_train, self.y_train)
+            return model
+
+        best = copper.utils.parallel.pmap(refit, alive[:keep], n_jobs=n_jobs)
+        self.add_clfs(best, prefix)
+
+        cols = ['Round', 'Samples', 'Candidate', 'Params', 'Score', 'Error']
+        return pd.DataFrame(history, columns=cols)
+
     # --------------------------------------------------------------------------
     #                            CONFUSION MATRIX
     # --------------------------------------------------------------------------
 
+    @timed('MachineLearning.cm', data=_test_data)
+    def _cm_tensor(self, clfs=None):
+        '''
+        Calculates the confusion matrixes of the classifiers as one array
+        of shape (classifiers, classes, classes) using a single bincount
+        over the cached predictions
+
+        Parameters
+        ----------
+            clfs: list or str, of the classifiers to calculate the cm
+
+        Returns
+        -------
+            (list of classifiers, np.array of classes, np.array)
+        '''
+        if clfs is None:
+            clfs = list(self._clfs.keys())
+        elif type(clfs) is str:
+            clfs = [clfs]
+
+        y_pred = np.vstack([self._cached('predict', clf_name) for clf_name in clfs])
+        classes = np.unique(np.concatenate((np.unique(self.y_test), np.unique(y_pred))))
+        n = len(classes)
+        actual = np.searchsorted(classes, self.y_test)
+        predicted = np.searchsorted(classes, y_pred)
+
+        flat = (np.arange(len(clfs))[:, np.newaxis] * n + actual) * n + predicted
+        tensor = np.bincount(flat.ravel(), minlength=len(clfs) * n * n)
+        return clfs, classes, tensor.reshape((len(clfs), n, n))
+
     def _cm(self, clfs=None):
         '''
         Calculates the confusion matrixes of the classifiers
@@ -266,18 +863,8 @@ class MachineLearning():
         -------
             python dictionary
         '''
-        if clfs is None:
-            clfs = self._clfs.keys()
-        else :
-            if type(clfs) is str:
-                clfs = [clfs]
-
-        ans = {}
-        for clf_name in clfs:
-            clf = self._clfs[clf_name]
-            y_pred = clf.predict(self.X_test)
-            ans[clf_name] = confusion_matrix(self.y_test, y_pred)
-        return ans
+        clfs, classes, tensor = self._cm_tensor(clfs=clfs)
+        return dict(zip(clfs, tensor))
 
     def cm(self, clf):
         '''
@@ -287,9 +874,8 @@ class MachineLearning():
         ----------
             clf: str, classifier identifier
         '''
-        cm = self._cm(clfs=clf)[clf]
-        values = set(self.y_test)
-        return pd.DataFrame(cm, index=values, columns=values)
+        clfs, classes, tensor = self._cm_tensor(clfs=clf)
+        return pd.DataFrame(tensor[0], index=classes, columns=classes)
 
     def cm_table(self, values=None, ascending=False):
         '''
@@ -305,25 +891,20 @@ class MachineLearning():
         -------
             pandas.DataFrame
         '''
+        clfs, classes, tensor = self._cm_tensor()
         if values is None:
-            values = set(self.y_test)
+            values = classes
         elif type(values) is int:
             values = [values]
 
-        cm_s = self._cm()
-        ans = pd.DataFrame(index=cm_s.keys())
-        zeros = np.zeros((len(ans), 3))
-
+        ans = pd.DataFrame(index=clfs)
         for value in values:
-            cols = ['Predicted %d\'s' % value, 'Correct %d\'s' % value,
-                                    'Rate %d\'s' % value]
-            n_ans = pd.DataFrame(zeros ,index=cm_s.keys(), columns=cols)
-            for clf_name in cm_s.keys():
-                cm = cm_s[clf_name]
-                n_ans['Predicted %d\'s' % value][clf_name] = cm[:,value].sum()
-                n_ans['Correct %d\'s' % value][clf_name] = cm[value,value].sum()
-                n_ans['Rate %d\'s' % value][clf_name] = cm[value,value].sum() / cm[:,value].sum()
-            ans = ans.join(n_ans)
+            i = np.searchsorted(classes, value)
+            predicted = tensor[:, :, i].sum(axis=1).astype(float)
+            correct = tensor[:, i, i].astype(float)
+            ans['Predicted %d\'s' % value] = predicted
+            ans['Correct %d\'s' % value] = correct
+            ans['Rate %d\'s' % value] = correct / predicted
         return ans.sort_index(by='Rate %d\'s' % value, ascending=ascending)
 
     def cm_falses(self):
@@ -334,6 +915,18 @@ class MachineLearning():
     #                                 COSTS
     # --------------------------------------------------------------------------
 
+    def _costs(self, n):
+        '''
+        self.costs as a (n, n) array: costs[i, j] is the value of a row of the
+        class i predicted as the class j. The first class is the negative
+        class, every other class is a positive class.
+        '''
+        costs = np.asarray(self.costs, dtype=float)
+        if costs.shape != (n, n):
+            raise ValueError('costs should be a %dx%d matrix' % (n, n))
+        return costs
+
+    @timed('MachineLearning.profit', data=_test_data)
     def profit(self, by='Profit', ascending=False):
         '''
         Calculates the Revenue of using the classifiers.
@@ -348,19 +941,21 @@ class MachineLearning():
         -------
             pandas.DataFrame
         '''
-        cm_s = self._cm()
-        cols = ['Loss from False Positive', 'Revenue', 'Profit']
-        ans = pd.DataFrame(np.zeros((len(cm_s.keys()), 3)), index=cm_s.keys(), columns=cols)
+        clfs, classes, tensor = self._cm_tensor()
+        n = len(classes)
+        costs = self._costs(n)
+        diagonal = np.eye(n, dtype=bool)
+        positive = np.arange(n) > 0
 
-        for clf in ans.index:
-            cm = cm_s[clf]
-            ans['Loss from False Positive'][clf] = cm[0,1] * self.costs[0][1]
-            ans['Revenue'][clf] = cm[1,1] * self.costs[1][1]
-            ans['Profit'][clf] = ans['Revenue'][clf] - \
-                                        ans['Loss from False Positive'][clf]
+        loss = (tensor * (costs * (~diagonal & positive))).sum(axis=2).sum(axis=1)
+        revenue = (tensor * (costs * (diagonal & positive))).sum(axis=2).sum(axis=1)
 
+        cols = ['Loss from False Positive', 'Revenue', 'Profit']
+        values = np.column_stack((loss, revenue, revenue - loss))
+        ans = pd.DataFrame(values, index=clfs, columns=cols)
         return ans.sort_index(by=by, ascending=ascending)
 
+    @timed('MachineLearning.oportunity_cost', data=_test_data)
     def oportunity_cost(self, ascending=False):
         '''
         Calculates the Oportuniy Cost of the classifiers.
@@ -374,12 +969,11 @@ class MachineLearning():
         -------
             pandas.DataFrame
         '''
-        cm_s = self._cm()
-        ans = pd.Series(index=cm_s.keys(), name='Oportuniy cost')
-
-        for clf in ans.index:
-            cm = cm_s[clf]
-            ans[clf] = cm[1,0] * self.costs[1][0] + cm[0,1] * self.costs[0][1]
+        clfs, classes, tensor = self._cm_tensor()
+        n = len(classes)
+        errors = self._costs(n) * ~np.eye(n, dtype=bool)
+        values = (tensor * errors).sum(axis=2).sum(axis=1)
+        ans = pd.Series(values, index=clfs, name='Oportuniy cost')
         return ans.order(ascending=ascending)
 
     def cost_no_ml(self, ascending=False):
@@ -395,25 +989,146 @@ class MachineLearning():
         -------
             pandas.Series
         '''
+        classes = np.unique(self.y_test)
+        counts = np.bincount(np.searchsorted(classes, self.y_test))
+        costs = self._costs(len(classes))
+
+        expense = counts[0] * costs[1, 0]
+        revenue = (counts[1:] * np.diag(costs)[1:]).sum()
         cols = ['Expense', 'Revenue', 'Net revenue']
-        ans = pd.Series(index=cols, name='Costs of not using ML')
+        ans = pd.Series([expense, revenue, revenue - expense], index=cols,
+                                            name='Costs of not using ML')
+        return ans.order(ascending=ascending)
 
-        # TODO: replace for bincount
-        # counts = np.bincount(self.y_test)
-        counts = []
-        counts.append(len(self.y_test[self.y_test == 0]))
-        counts.append(len(self.y_test[self.y_test == 1]))
-        ans['Expense'] = counts[0] * self.costs[1][0]
-        ans['Revenue'] = counts[1] * self.costs[1][1]
-        ans['Net revenue'] = ans['Revenue'] - ans['Expense']
+    @timed('MachineLearning.threshold_sweep', data=_test_data)
+    def _threshold_sweep(self, clfs=None, value=1):
+        '''
+        Cumulative true and false positives of the classifiers for every
+        threshold on the predicted probability of value: a row is predicted
+        as value if its probability is >= threshold.
+        The probabilities of each classifier are sorted only once and all the
+        classifiers are processed at the same time.
 
-        return ans.order(ascending=ascending)
+        Parameters
+        ----------
+            clfs: list, of classifiers, default all with predict_proba
+            value: target value considered positive
+
+        Returns
+        -------
+            (list of classifiers, thresholds, true positives, false positives,
+             valid) where valid is False on thresholds that split equal
+             probabilities. The first threshold (inf) predicts no positives.
+        '''
+        if clfs is None:
+            clfs = list(self._clfs.keys())
+        elif type(clfs) is str:
+            clfs = [clfs]
+
+        names, scores = [], []
+        for clf_name in clfs:
+            try:
+                probas = self._cached('predict_proba', clf_name)
+            except:
+                continue # Is OK, some models do not have predict_proba
+            classes = getattr(self._clfs[clf_name], 'classes_', None)
+            column = value if classes is None else np.searchsorted(classes, value)
+            names.append(clf_name)
+            scores.append(probas[:, column])
+
+        if len(names) == 0:
+            raise ValueError('There are no classifiers with predict_proba')
+        scores = np.vstack(scores)
+        order = np.argsort(-scores, axis=1, kind='mergesort')
+        rows = np.arange(len(names))[:, np.newaxis]
+        thresholds = scores[rows, order]
+        positive = (self.y_test == value)[order]
+
+        zeros = np.zeros((len(names), 1))
+        thresholds = np.hstack((zeros + np.inf, thresholds))
+        tp = np.hstack((zeros, positive.cumsum(axis=1)))
+        fp = np.hstack((zeros, (~positive).cumsum(axis=1)))
+        valid = np.ones(thresholds.shape, dtype=bool)
+        valid[:, :-1] = thresholds[:, :-1] != thresholds[:, 1:]
+        return names, thresholds, tp, fp, valid
+
+    def _best_threshold(self, values, names, thresholds, valid, name,
+                                            minimize=False, key=None):
+        '''
+        Threshold with the best values of each classifier, key are the values
+        used to choose it if they are not the reported values
+        '''
+        key = values if key is None else key
+        if minimize:
+            best = np.where(valid, key, np.inf).argmin(axis=1)
+        else:
+            best = np.where(valid, key, -np.inf).argmax(axis=1)
+        rows = np.arange(len(names))
+        ans = pd.DataFrame(index=names)
+        ans['Threshold'] = thresholds[rows, best]
+        ans[name] = values[rows, best]
+        return ans
+
+    def profit_curve(self, clfs=None, value=1, ascending=False):
+        '''
+        Finds the threshold on the predicted probability that maximizes the
+        profit of each classifier. The profit of every possible threshold is
+        calculated from one sort of the probabilities.
+        Uses the same costs as profit: self.costs[1][1] for each true positive
+        and self.costs[0][1] for each false positive.
+
+        Parameters
+        ----------
+            clfs: list, of classifiers, default all with predict_proba
+            value: target value considered positive
+            ascending: boolean, Sort the DataFrame by direction
+
+        Returns
+        -------
+            pandas.DataFrame with the best threshold and profit
+        '''
+        names, thresholds, tp, fp, valid = self._threshold_sweep(clfs, value)
+        costs = np.asarray(self.costs, dtype=float)
+        profit = tp * costs[1, 1] - fp * costs[0, 1]
+        ans = self._best_threshold(profit, names, thresholds, valid, 'Profit')
+        return ans.sort_index(by='Profit', ascending=ascending)
+
+    def cost_curve(self, clfs=None, value=1, ascending=True):
+        '''
+        Finds the threshold on the predicted probability with the lowest
+        oportunity cost of each classifier. The cost of every possible
+        threshold is calculated from one sort of the probabilities.
+        Uses the same costs as oportunity_cost: self.costs[1][0] for each
+        false negative and self.costs[0][1] for each false positive. The costs
+        can be positive or negative (as the default costs, losses), the best
+        threshold is the one with the smallest loss.
+
+        Parameters
+        ----------
+            clfs: list, of classifiers, default all with predict_proba
+            value: target value considered positive
+            ascending: boolean, Sort the DataFrame by direction
+
+        Returns
+        -------
+            pandas.DataFrame with the best threshold and oportunity cost
+        '''
+        names, thresholds, tp, fp, valid = self._threshold_sweep(clfs, value)
+        costs = np.asarray(self.costs, dtype=float)
+        fn = tp[:, -1:] - tp
+        cost = fn * costs[1, 0] + fp * costs[0, 1]
+        loss = fn * abs(costs[1, 0]) + fp * abs(costs[0, 1])
+        ans = self._best_threshold(cost, names, thresholds, valid,
+                                    'Oportuniy cost', minimize=True, key=loss)
+        return ans.sort_index(by='Oportuniy cost', ascending=ascending)
 
     # --------------------------------------------------------------------------
     #                                 PLOTS
     # --------------------------------------------------------------------------
 
-    def roc(self, ascending=False, legend=True, ret_list=False):
+    @timed('MachineLearning.roc', data=_test_data)
+    def roc(self, ascending=False, legend=True, ret_list=False, bins=None,
+                                                chunksize=100000, n_jobs=1):
         '''
         Plots the ROC chart
 
@@ -423,21 +1138,42 @@ class MachineLearning():
             ret_list: boolean, True if want the method to return a list with the
                             areas under the curve
             ascending: boolean, legend and list sorting direction
+            bins: int, if given the curves are approximated with histograms
+                       and have at most bins + 1 points, see auc
+            chunksize: int, rows predicted at once when using bins
+            n_jobs: int, number of workers when using bins
 
         Returns
         -------
             nothing, the plot is ready to be shown
         '''
-        aucs = self.auc(ascending=ascending)
-        for clf_name in aucs.index:
+        # The probabilities (or histograms) of each classifier are computed
+        # once for the curve and the area
+        curves = {}
+        aucs = pd.Series(index=self._clfs, name='Area Under the Curve', dtype=float)
+        for clf_name in self._clfs:
             clf = self._clfs[clf_name]
             try:
-                probas_ = clf.predict_proba(self.X_test)
-                fpr, tpr, thresholds = roc_curve(self.y_test, probas_[:, 1])
-                plt.plot(fpr, tpr, label='%s (area = %0.2f)' % (clf_name, aucs[clf_name]))
+                if bins is None:
+                    probas_ = self._cached('predict_proba', clf_name)
+                    fpr, tpr, thresholds = roc_curve(self.y_test, probas_[:, 1])
+                    aucs[clf_name] = auc(fpr, tpr)
+                else:
+                    binned = copper.utils.ml.binned_roc(clf, self.X_test,
+                                    self.y_test, bins=bins,
+                                    chunksize=chunksize, n_jobs=n_jobs)
+                    fpr, tpr, thresholds = binned.curve()
+                    aucs[clf_name] = binned.auc()
+                curves[clf_name] = fpr, tpr
             except:
                 pass # Is OK, some models do not have predict_proba
 
+        aucs = aucs.order(ascending=ascending)
+        for clf_name in aucs.index:
+            if clf_name in curves:
+                fpr, tpr = curves[clf_name]
+                plt.plot(fpr, tpr, label='%s (area = %0.2f)' % (clf_name, aucs[clf_name]))
+
         plt.plot([0, 1], [0, 1], 'k--')
         plt.xlim([0.0, 1.0])
         plt.ylim([0.0, 1.0])
@@ -471,15 +1207,13 @@ if __name__ == '__main__':
     copper.project.path = '../tests/'
 
     train = copper.Dataset('ml/1/train.csv')
-    train.role['CustomerID'] = train.ID
-    train.role['Order'] = train.TARGET
+    pipeline = train.record()
+    train.set_role('CustomerID', train.ID)
+    train.set_role('Order', train.TARGET)
     fnc = lambda x: 12*(2007 - int(str(x)[0:4])) - int(str(x)[4:6]) + 2
-    train['LASD'] = train['LASD'].apply(fnc)
+    train.apply('LASD', fnc)
 
-    test = copper.Dataset('ml/1/test.csv')
-    test.role['CustomerID'] = test.ID
-    test.role['Order'] = test.TARGET
-    test['LASD'] = test['LASD'].apply(fnc)
+    test = pipeline.replay(copper.read_csv('ml/1/test.csv'))
 
     ml = copper.MachineLearning()
     ml.set_train(train)
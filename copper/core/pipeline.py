@@ -0,0 +1,327 @@
+# coding=utf-8
+from __future__ import division
+import os
+import weakref
+import copper
+import pandas as pd
+
+'''
+Recorded transformations of a Dataset that can be replayed on new data:
+
+    train = copper.Dataset('train.csv')
+    pipeline = train.record()
+    train.set_role('CustomerID', train.ID)
+    train.apply('LASD', fnc)
+    train.fillna(method='mean')
+
+    test = pipeline.replay(copper.read_csv('test.csv'))
+    for chunk in pipeline.replay_chunks('score.csv', chunksize=100000):
+        ...
+
+The values learned on the recorded Dataset (e.g. the means of fillna) are
+reused on replay, not learned again from the new data.
+
+The steps are pickled with the pipeline by copper.save, so the functions of
+apply should be defined on a module: lambdas and nested functions can be
+recorded and replayed but not saved.
+'''
+
+
+class Step(object):
+    '''
+    A recorded transformation
+
+    Attributes
+    ----------
+        name: str
+        inputs: list, columns read by the step, None for all the columns
+        outputs: list, columns (data or metadata) written by the step
+        cache: boolean, True if the outputs are cached between replays
+    '''
+    cache = True
+
+    def run(self, ds):
+        raise NotImplementedError("Should have implemented this")
+
+    def __repr__(self):
+        return self.name
+
+class Apply(Step):
+    '''
+    Applies a function to a column, see Dataset.apply
+    '''
+
+    def __init__(self, col, fnc, to=None, vectorized=False, name=None):
+        self.col = col
+        self.fnc = fnc
+        self.to = col if to is None else to
+        self.vectorized = vectorized
+        self.name = 'apply %s' % self.to if name is None else name
+        self.inputs = [col]
+        self.outputs = [self.to]
+
+    def run(self, ds):
+        series = ds.frame[self.col]
+        values = self.fnc(series) if self.vectorized else series.apply(self.fnc)
+        _set_column(ds, self.to, values)
+
+class FillNA(Step):
+    '''
+    Fills missing values with the values learned on the recorded Dataset
+    '''
+
+    def __init__(self, cols, values, name='fillna'):
+        self.values = values
+        self.name = name
+        self.inputs = list(cols)
+        self.outputs = list(cols)
+
+    def run(self, ds):
+        for col, value in self.values.items():
+            if col in ds.columns:
+                ds.frame[col] = ds.frame[col].fillna(value=value)
+
+class GroupFill(Step):
+    '''
+    Fills missing values with the statistics of each group learned on the
+    recorded Dataset, see copper.utils.frame.group_stats
+    '''
+
+    def __init__(self, by, stats, name='fillna by'):
+        self.by = [by] if type(by) is str else list(by)
+        self.stats = stats
+        self.name = name
+        self.inputs = self.by + list(stats)
+        self.outputs = list(stats)
+
+    def run(self, ds):
+        filled = copper.utils.frame.group_apply(ds.frame, self.by, self.stats)
+        for col in filled.columns:
+            ds.frame[col] = filled[col]
+
+class KNNFill(Step):
+    '''
+    Fills missing values with the nearest neighbors on the complete rows of
+    the recorded Dataset, see copper.utils.frame.knn_impute
+    '''
+
+    def __init__(self, cols, features, reference, name='fillna knn', **args):
+        self.features = list(features)
+        self.reference = reference
+        self.args = args
+        self.name = name
+        self.inputs = self.features + [col for col in cols if col not in features]
+        self.outputs = list(cols)
+
+    def run(self, ds):
+        cols = [col for col in self.outputs if col in ds.columns]
+        imputed = copper.utils.frame.knn_impute(ds.frame, cols=cols,
+                                features=self.features,
+                                reference=self.reference, **self.args)
+        for col in cols:
+            ds.frame[col] = imputed[col]
+
+class Metadata(Step):
+    '''
+    Sets the role or type of columns, see Dataset.set_role and set_type
+    '''
+    cache = False
+
+    def __init__(self, attr, cols, value, name=None):
+        self.attr = attr
+        self.value = value
+        self.name = 'set %s %s' % (attr, value) if name is None else name
+        self.inputs = []
+        self.outputs = list(cols)
+
+    def run(self, ds):
+        cols = [col for col in self.outputs if col in ds.columns]
+        getattr(ds, self.attr)[cols] = self.value
+        if self.attr == 'type':
+            ds.update()
+
+def _set_column(ds, col, values):
+    '''
+    Sets a column of a Dataset, a new column gets role Input and the type of
+    its values
+    '''
+    ds.frame[col] = values
+    if col not in ds.role.index:
+        ds.columns = ds.frame.columns.values
+        kind = ds.frame[col].dtype.kind
+        ds.role[col] = ds.INPUT
+        ds.type[col] = ds.NUMBER if kind in 'biuf' else ds.CATEGORY
+
+# -----------------------------------------------------------------------------
+#                                 PIPELINE
+# -----------------------------------------------------------------------------
+
+class Pipeline(object):
+    '''
+    List of steps recorded on a Dataset, see Dataset.record
+    '''
+
+    def __init__(self, ds=None):
+        self.steps = []
+        self._roles = None if ds is None else ds.role.copy()
+        self._types = None if ds is None else ds.type.copy()
+        self._changed = set()
+        self._source = None
+        self._outputs = {}
+
+    def add(self, step):
+        '''
+        Appends a step, a name already used gets the first free index
+        (e.g. "apply LASD 1")
+        '''
+        names = set(s.name for s in self.steps)
+        if step.name in names:
+            i = 1
+            while '%s %d' % (step.name, i) in names:
+                i += 1
+            step.name = '%s %d' % (step.name, i)
+        self.steps.append(step)
+
+    def clear_cache(self):
+        '''
+        Drops the outputs of the steps kept from the last replay
+        '''
+        self._source = None
+        self._outputs = {}
+        self._changed = set()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_source'] = None
+        state['_outputs'] = {}
+        return state
+
+    def copy(self):
+        '''
+        Returns
+        -------
+            copper.Pipeline with the same steps, without the cache
+        '''
+        ans = Pipeline()
+        ans.steps = list(self.steps)
+        ans._roles, ans._types = self._roles, self._types
+        return ans
+
+    def _index(self, step):
+        if type(step) is int:
+            return step
+        names = [s.name for s in self.steps]
+        if step not in names:
+            raise ValueError('Unknown step: %s' % step)
+        return names.index(step)
+
+    def change(self, step, **args):
+        '''
+        Changes the attributes of a step (e.g. fnc or values), the next replay
+        on the same data only recomputes the columns that depend on it
+
+        Parameters
+        ----------
+            step: int or str, index or name of the step
+            **args: new values of the attributes
+        '''
+        i = self._index(step)
+        for attr, value in args.items():
+            setattr(self.steps[i], attr, value)
+        self._changed.add(i)
+
+    def _dataset(self, data):
+        '''
+        Working copy of a Dataset or Dataset of a frame with the metadata of
+        the recorded Dataset before the first step
+        '''
+        ds = copper.Dataset()
+        if isinstance(data, copper.Dataset):
+            ds.set_frame(data.frame.copy(), metadata=False)
+            ds.role, ds.type = data.role.copy(), data.type.copy()
+        elif self._roles is None:
+            ds.set_frame(data.copy())
+        else:
+            ds.set_frame(data.copy(), metadata=False)
+            ds.role = self._roles.reindex(ds.columns).fillna(ds.REJECTED)
+            ds.type = self._types.reindex(ds.columns).fillna(ds.CATEGORY)
+        return ds
+
+    def replay(self, data, cache=True):
+        '''
+        Applies the steps to a Dataset or a DataFrame. The data is not
+        modified.
+
+        If the same data is replayed again the outputs of the steps that did
+        not change (see change) and do not depend on a changed step are
+        taken from the previous replay. Only a weak reference to the data is
+        kept, see clear_cache to drop the outputs.
+
+        Parameters
+        ----------
+            data: copper.Dataset or pandas.DataFrame
+            cache: boolean, False to not keep the outputs of the steps
+
+        Returns
+        -------
+            copper.Dataset
+        '''
+        source = None if self._source is None else self._source()
+        if not cache or data is not source:
+            self.clear_cache()
+        ds = self._dataset(data)
+
+        dirty = set()
+        for i, step in enumerate(self.steps):
+            depends = step.inputs is None and len(dirty) > 0 or \
+                        step.inputs is not None and len(dirty & set(step.inputs)) > 0
+            reuse = i in self._outputs and i not in self._changed and not depends
+            if reuse and step.cache:
+                for col, values in self._outputs[i].items():
+                    _set_column(ds, col, values)
+                continue
+
+            step.run(ds)
+            if not reuse:
+                dirty.update(step.outputs)
+            if cache:
+                self._outputs[i] = {} if not step.cache else \
+                        dict((col, ds.frame[col]) for col in step.outputs if col in ds.columns)
+
+        self._changed = set()
+        self._source = weakref.ref(data) if cache else None
+        return ds
+
+    def replay_chunks(self, source, chunksize=100000):
+        '''
+        Applies the steps to a Dataset or csv file one chunk of rows at a time
+
+        Parameters
+        ----------
+            source: copper.Dataset, pandas.DataFrame or str, path of a csv
+                    file on the project data directory
+            chunksize: int, number of rows of each chunk
+
+        Returns
+        -------
+            generator of copper.Dataset
+        '''
+        if isinstance(source, copper.Dataset):
+            for start in range(0, len(source), chunksize):
+                chunk = copper.Dataset()
+                chunk.set_frame(source.frame[start:start + chunksize], metadata=False)
+                chunk.role, chunk.type = source.role, source.type
+                yield self.replay(chunk, cache=False)
+        elif isinstance(source, pd.DataFrame):
+            for start in range(0, len(source), chunksize):
+                yield self.replay(source[start:start + chunksize], cache=False)
+        else:
+            filepath = os.path.join(copper.project.data, source)
+            for frame in pd.read_csv(filepath, chunksize=chunksize):
+                yield self.replay(frame, cache=False)
+
+    def __len__(self):
+        return len(self.steps)
+
+    def __repr__(self):
+        return '\n'.join('%d. %s' % (i, step.name) for i, step in enumerate(self.steps))
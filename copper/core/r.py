@@ -16,7 +16,7 @@ except:
 def install_packages():
     r('install.packages("imputation")')
 
-def impute(dataframe, method='knn'):
+def impute(dataframe, method='knn', **args):
     ''' Imputes data using R imputation package
     This requires the R package imputation to be installed:
         R: install.packages("imputation")
@@ -33,22 +33,27 @@ def impute(dataframe, method='knn'):
         pandas.Dataframe with the imputed data
     '''
     if method == 'knn':
-        return imputeKNN(dataframe)
+        return imputeKNN(dataframe, **args)
 
-def imputeKNN(dataframe):
-    if type(dataframe) == copper.Dataset:
-        dataframe = dataframe.frame
-
-    filename = 'impute.csv'
-    filepath = os.path.join('/tmp/', filename)
-    dataframe.to_csv(filepath)
+def imputeKNN(dataframe, **args):
+    ''' Imputes data using k nearest neighbors.
+    The R imputation package is not used anymore, the imputation is done
+    in-process by copper.utils.frame.knn_impute
 
-    # importr("imputation")
-    # r('data = read.csv("%s")' % filepath)
-    # r('data.imputed = kNNImpute(data, 2, verbose=F)')
-    # r('data.imputed = data.imputed[[1]]') # Not necessary
-    # print com.load_data('data.imputed') # NOTE: pandas api not working
-    # r('write.csv(data.imputed, "%s")' % filepath)
+    Parameters
+    ----------
+        dataframe: pandas.DataFrame or copper.Dataset
+        **args: arguments of copper.utils.frame.knn_impute
 
-    return pd.read_csv(filepath)
+    Returns
+    -------
+        pandas.Dataframe with the imputed data
+    '''
+    if type(dataframe) == copper.Dataset:
+        dataframe = dataframe.frame
 
+    ans = dataframe.copy()
+    imputed = copper.utils.frame.knn_impute(dataframe, **args)
+    for col in imputed.columns:
+        ans[col] = imputed[col]
+    return ans
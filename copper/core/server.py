@@ -0,0 +1,356 @@
+# coding=utf-8
+from __future__ import division
+import io
+import json
+import time
+import datetime
+import threading
+import collections
+from multiprocessing.pool import ThreadPool
+
+import copper
+import numpy as np
+import pandas as pd
+
+import tornado.gen
+import tornado.web
+import tornado.ioloop
+from tornado.concurrent import Future
+
+'''
+HTTP scoring service for a saved MachineLearning.
+
+The rows of concurrent requests are gathered into micro-batches (up to
+max_batch rows or max_latency seconds) that are encoded and scored at once.
+
+Usage:
+    python -m copper.core.server model.ml --port 8888
+    python -m copper.core.server --bench http://localhost:8888 --rows 10
+'''
+
+
+class Stats(object):
+    '''
+    Counters and latencies of the service
+    '''
+
+    def __init__(self, size=10000):
+        self.start = time.time()
+        self.requests = 0
+        self.rows = 0
+        self.batches = 0
+        self.errors = 0
+        self.latencies = collections.deque(maxlen=size)
+        self.lock = threading.Lock()
+
+    def add_request(self, rows, latency):
+        with self.lock:
+            self.requests += 1
+            self.rows += rows
+            self.latencies.append(latency)
+
+    def add_batch(self):
+        with self.lock:
+            self.batches += 1
+
+    def add_error(self):
+        with self.lock:
+            self.errors += 1
+
+    def summary(self):
+        '''
+        Returns
+        -------
+            dict with the counters, throughput and latency percentiles (ms)
+        '''
+        with self.lock:
+            latencies = np.array(self.latencies) * 1000
+            elapsed = time.time() - self.start
+            ans = {'requests': self.requests, 'rows': self.rows,
+                   'batches': self.batches, 'errors': self.errors,
+                   'seconds': elapsed,
+                   'requests_per_second': self.requests / elapsed,
+                   'rows_per_second': self.rows / elapsed,
+                   'rows_per_batch': self.rows / max(self.batches, 1)}
+        for p in (50, 90, 99):
+            ans['latency_p%d' % p] = np.percentile(latencies, p) if len(latencies) else None
+        return ans
+
+class Batcher(object):
+    '''
+    Gathers the rows of the requests for the same classifiers and scores them
+    on a pool of threads when there are max_batch rows or max_latency seconds
+    passed since the first request of the batch.
+    '''
+
+    def __init__(self, ml, stats, max_batch=512, max_latency=0.005, threads=2):
+        self.ml = ml
+        self.stats = stats
+        self.max_batch = max_batch
+        self.max_latency = max_latency
+        self.pool = ThreadPool(threads)
+        self.pending = {}
+        self.timers = {}
+
+    def submit(self, frame, clfs):
+        '''
+        Adds the rows of a request to the batch of its classifiers
+
+        Returns
+        -------
+            tornado Future with the (predictions, probabilities) DataFrames
+        '''
+        loop = tornado.ioloop.IOLoop.current()
+        future = Future()
+        key = tuple(clfs)
+        self.pending.setdefault(key, []).append((frame, future))
+
+        if sum(len(f) for f, _ in self.pending[key]) >= self.max_batch:
+            self.flush(key)
+        elif key not in self.timers:
+            delay = datetime.timedelta(seconds=self.max_latency)
+            self.timers[key] = loop.add_timeout(delay, lambda: self.flush(key))
+        return future
+
+    def flush(self, key):
+        loop = tornado.ioloop.IOLoop.current()
+        if key in self.timers:
+            loop.remove_timeout(self.timers.pop(key))
+        batch = self.pending.pop(key, [])
+        if len(batch) == 0:
+            return
+
+        def done(result):
+            loop.add_callback(self.resolve, batch, result)
+
+        def failed(error):
+            # score isolates the errors of each request, this is a bug of
+            # the service: fail the batch instead of never answering
+            loop.add_callback(self.resolve, batch, [error] * len(batch))
+
+        self.stats.add_batch()
+        self.pool.apply_async(self.score, (list(key), [f for f, _ in batch]),
+                              callback=done, error_callback=failed)
+
+    def _score(self, clfs, X):
+        predictions = self.ml._scores(X, clfs, n_jobs=1)
+        with_proba = [c for c in clfs if hasattr(self.ml._clfs[c], 'predict_proba')]
+        probas = self.ml._scores(X, with_proba, proba=True, n_jobs=1)
+        return predictions, probas
+
+    def score(self, clfs, frames):
+        '''
+        Scores the frames of a batch. Each frame is encoded on its own so a
+        bad request only fails itself, and if scoring the batch fails the
+        frames are scored one by one.
+
+        Returns
+        -------
+            list with the (predictions, probabilities) DataFrames or the
+            exception of each frame
+        '''
+        ans, encoded = [], []
+        for frame in frames:
+            try:
+                encoded.append(self.ml._encode(self.ml._prepare(frame)))
+                ans.append(None)
+            except Exception as e:
+                ans.append(e)
+        good = [i for i, result in enumerate(ans) if result is None]
+        if len(good) == 0:
+            return ans
+
+        try:
+            predictions, probas = self._score(clfs, np.vstack(encoded))
+            start = 0
+            for i, X in zip(good, encoded):
+                end = start + len(X)
+                ans[i] = (predictions[start:end], probas[start:end])
+                start = end
+        except Exception:
+            for i, X in zip(good, encoded):
+                try:
+                    ans[i] = self._score(clfs, X)
+                except Exception as e:
+                    ans[i] = e
+        return ans
+
+    def resolve(self, batch, results):
+        for (frame, future), result in zip(batch, results):
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+# -----------------------------------------------------------------------------
+#                                 HANDLERS
+# -----------------------------------------------------------------------------
+
+def _read_frame(request):
+    '''
+    Reads the rows of a request: csv or json, either a list of records or
+    {"columns": [...], "data": [[...], ...]}
+    '''
+    content_type = request.headers.get('Content-Type', '')
+    if 'csv' in content_type:
+        return pd.read_csv(io.BytesIO(request.body))
+    data = json.loads(request.body.decode('utf-8'))
+    if type(data) is dict:
+        return pd.DataFrame(data['data'], columns=data['columns'])
+    return pd.DataFrame(data)
+
+class PredictHandler(tornado.web.RequestHandler):
+    def initialize(self, batcher, stats):
+        self.batcher = batcher
+        self.stats = stats
+
+    @tornado.gen.coroutine
+    def post(self):
+        start = time.time()
+        try:
+            frame = _read_frame(self.request)
+            clfs = self.get_argument('clfs', None)
+            clfs = self.batcher.ml.clfs.index.tolist() if clfs is None else clfs.split(',')
+            unknown = [c for c in clfs if c not in self.batcher.ml._clfs]
+            if len(unknown) > 0:
+                raise ValueError('Unknown classifiers: %s' % ', '.join(unknown))
+            predictions, probas = yield self.batcher.submit(frame, clfs)
+        except Exception as e:
+            self.stats.add_error()
+            self.set_status(400)
+            self.write(json.dumps({'error': str(e)}))
+            return
+
+        ans = {'predictions': dict((c, predictions[c].tolist()) for c in predictions.columns),
+               'probabilities': dict((c, probas[c].tolist()) for c in probas.columns)}
+        self.set_header('Content-Type', 'application/json')
+        self.write(json.dumps(ans))
+        self.stats.add_request(len(frame), time.time() - start)
+
+class StatsHandler(tornado.web.RequestHandler):
+    def initialize(self, stats):
+        self.stats = stats
+
+    def get(self):
+        self.set_header('Content-Type', 'application/json')
+        self.write(json.dumps(self.stats.summary()))
+
+class ClassifiersHandler(tornado.web.RequestHandler):
+    def initialize(self, ml):
+        self.ml = ml
+
+    def get(self):
+        self.set_header('Content-Type', 'application/json')
+        self.write(json.dumps(self.ml.clfs.index.tolist()))
+
+def application(ml, max_batch=512, max_latency=0.005, threads=2):
+    '''
+    Creates the tornado application for a MachineLearning
+
+    Parameters
+    ----------
+        ml: copper.MachineLearning or str, name of a saved MachineLearning
+                                    (copper.save) on the project data directory,
+                                    it can be saved with keep_data=False
+        max_batch: int, maximum number of rows of a micro-batch
+        max_latency: float, maximum seconds a request waits for its batch
+        threads: int, number of threads scoring the batches
+
+    Returns
+    -------
+        tornado.web.Application
+    '''
+    if not isinstance(ml, copper.MachineLearning):
+        ml = copper.load(ml)
+    stats = Stats()
+    batcher = Batcher(ml, stats, max_batch=max_batch, max_latency=max_latency,
+                      threads=threads)
+    return tornado.web.Application([
+        (r"/predict", PredictHandler, dict(batcher=batcher, stats=stats)),
+        (r"/stats", StatsHandler, dict(stats=stats)),
+        (r"/clfs", ClassifiersHandler, dict(ml=ml)),
+    ])
+
+def serve(ml, port=8888, **args):
+    '''
+    Starts the scoring service, see application for the arguments
+    '''
+    application(ml, **args).listen(port)
+    tornado.ioloop.IOLoop.current().start()
+
+# -----------------------------------------------------------------------------
+#                                 BENCHMARK
+# -----------------------------------------------------------------------------
+
+def benchmark(url, frame, requests=1000, concurrency=16, clfs=None):
+    '''
+    Local load generator: posts the rows of frame to the service from
+    concurrency threads.
+
+    Parameters
+    ----------
+        url: str, base url of the service, e.g. http://localhost:8888
+        frame: pandas.DataFrame, rows sent on every request
+        requests: int, total number of requests
+        concurrency: int, number of concurrent clients
+        clfs: list, of classifiers, default all
+
+    Returns
+    -------
+        pandas.Series with the throughput and client latency percentiles (ms)
+    '''
+    try:
+        from urllib.request import Request, urlopen
+    except ImportError:
+        from urllib2 import Request, urlopen
+
+    endpoint = url + '/predict'
+    if clfs is not None:
+        endpoint += '?clfs=' + ','.join(clfs)
+    body = json.dumps({'columns': frame.columns.tolist(),
+                       'data': frame.values.tolist()}).encode('utf-8')
+
+    def run(i):
+        start = time.time()
+        request = Request(endpoint, body, {'Content-Type': 'application/json'})
+        urlopen(request).read()
+        return time.time() - start
+
+    start = time.time()
+    pool = ThreadPool(concurrency)
+    latencies = np.array(pool.map(run, range(requests))) * 1000
+    pool.close()
+    elapsed = time.time() - start
+
+    index = ['Requests', 'Rows', 'Seconds', 'Requests per second',
+             'Rows per second', 'Latency p50', 'Latency p90', 'Latency p99']
+    values = [requests, requests * len(frame), elapsed, requests / elapsed,
+              requests * len(frame) / elapsed, np.percentile(latencies, 50),
+              np.percentile(latencies, 90), np.percentile(latencies, 99)]
+    return pd.Series(values, index=index, name='Benchmark')
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='copper scoring service')
+    parser.add_argument('model', nargs='?', help='saved MachineLearning (.ml)')
+    parser.add_argument('--path', default='.', help='copper project path')
+    parser.add_argument('--port', type=int, default=8888)
+    parser.add_argument('--max-batch', type=int, default=512)
+    parser.add_argument('--max-latency', type=float, default=0.005)
+    parser.add_argument('--threads', type=int, default=2)
+    parser.add_argument('--bench', help='url of a running service to benchmark')
+    parser.add_argument('--data', help='csv file with the rows for the benchmark')
+    parser.add_argument('--rows', type=int, default=10, help='rows per request')
+    parser.add_argument('--requests', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=16)
+    args = parser.parse_args()
+
+    copper.project.path = args.path
+    if args.bench:
+        frame = copper.read_csv(args.data).head(args.rows)
+        print(benchmark(args.bench, frame, requests=args.requests,
+                        concurrency=args.concurrency))
+    else:
+        serve(args.model, port=args.port, max_batch=args.max_batch,
+              max_latency=args.max_latency, threads=args.threads)
@@ -6,6 +6,8 @@ import json
 import copper
 import numpy as np
 import pandas as pd
+from copper.utils.instrument import timed
+from copper.core.pipeline import Pipeline, Apply, FillNA, GroupFill, KNNFill, Metadata
 
 class Dataset(dict):
     '''
@@ -23,23 +25,30 @@ class Dataset(dict):
     REJECT = 'Reject'
     REJECTED = 'Reject'
 
-    def __init__(self, data=None):
+    def __init__(self, data=None, compact=False):
         '''
         Creates a new Dataset
 
         Parameters
         ----------
             data: str with the path of the data. Or pandas.DataFrame.
+            compact: boolean, True to compact the frame after generating the
+                              metadata, see compact
         '''
         self.frame = None
         self.role = None
         self.type = None
+        self.pipeline = None
+        self.hashing = {}
+        self.encoding = {}
 
         if data is not None:
             if type(data) is pd.DataFrame:
                 self.set_frame(data)
+                if compact:
+                    self.compact()
             elif type(data) is str:
-                self.load(data)
+                self.load(data, compact=compact)
 
     # --------------------------------------------------------------------------
     #                                 LOAD
@@ -57,48 +66,80 @@ class Dataset(dict):
         '''
         return col_name.lower() in ['target']
 
-    def load(self, file_path):
+    def load(self, file_path, compact=False):
         ''' Loads a csv file from the project data directory.
 
         Parameters
         ----------
             file_path: str
+            compact: boolean, True to compact the frame, see compact
         '''
         filepath = os.path.join(copper.project.data, file_path)
         self.set_frame(pd.read_csv(filepath))
+        if compact:
+            self.compact()
 
+    def _number_cols(self):
+        '''
+        Columns with a numerical dtype: any width of int, uint, float and bool
+        '''
+        dtypes = self.frame.dtypes.values
+        return [c for c, dtype in zip(self.columns, dtypes) if dtype.kind in 'biuf']
+
+    @timed('Dataset.set_frame')
     def set_frame(self, frame, metadata=True):
         ''' Sets the frame of the Dataset and Generates metadata for the frame
 
         Parameters
         ----------
             frame: pandas.DataFrame
+            metadata: boolean, False to not generate the metadata, role and
+                               type have to be set after
         '''
         self.frame = frame
         self.columns = self.frame.columns.values
-        self.role = pd.Series(index=self.columns, name='Role', dtype=str)
-        self.type = pd.Series(index=self.columns, name='Type', dtype=str)
+        if not metadata:
+            return
+        self.role, self.type = self._infer_metadata(self.columns,
+                                        self.percent_missing(), self._number_cols())
+
+    def _infer_metadata(self, columns, missing, numbers):
+        '''
+        Generates the role and type of columns, used by set_frame and
+        copper.to_chunks
+
+        Parameters
+        ----------
+            columns: list
+            missing: pandas.Series, percent of missing values of each column
+            numbers: list, columns with a numerical dtype
+
+        Returns
+        -------
+            (pandas.Series, pandas.Series) with the role and type
+        '''
+        role = pd.Series(index=columns, name='Role', dtype=str)
+        type_ = pd.Series(index=columns, name='Type', dtype=str)
 
         # Roles
-        id_cols = [c for c in self.columns if self._id_identifier(c)]
+        id_cols = [c for c in columns if self._id_identifier(c)]
         if len(id_cols) > 0:
-            self.role[id_cols] = 'ID'
+            role[id_cols] = 'ID'
 
-        target_cols = [c for c in self.columns if self._target_identifier(c)]
+        target_cols = [c for c in columns if self._target_identifier(c)]
         if len(target_cols) > 0:
             # Set only variable to be target
-            self.role[target_cols[0]] = self.TARGET
-            self.role[target_cols[1:]] = self.REJECTED
+            role[target_cols[0]] = self.TARGET
+            role[target_cols[1:]] = self.REJECTED
 
-        rejected = self.percent_missing()[self.percent_missing() > 0.5].index
-        self.role[rejected] = self.REJECTED
-        self.role = self.role.fillna(value=self.INPUT) # Missing cols are Input
+        rejected = missing[missing > 0.5].index
+        role[rejected] = self.REJECTED
+        role = role.fillna(value=self.INPUT) # Missing cols are Input
 
         # Types
-        number_cols = [c for c in self.columns
-                              if self.frame.dtypes[c] in (np.int64, np.float64)]
-        self.type[number_cols] = self.NUMBER
-        self.type = self.type.fillna(value=self.CATEGORY)
+        type_[numbers] = self.NUMBER
+        type_ = type_.fillna(value=self.CATEGORY)
+        return role, type_
 
     # --------------------------------------------------------------------------
     #                                PROPERTIES
@@ -171,6 +212,7 @@ class Dataset(dict):
                                         self.frame[col].dtype == object:
                 self.frame[col] = self.frame[col].apply(copper.transform.to_number)
 
+    @timed('Dataset.filter')
     def filter(self, role=None, type=None, ret_cols=False, ret_ds=False):
         ''' Filter the columns of the Dataset by Role and Type
 
@@ -178,7 +220,9 @@ class Dataset(dict):
         ----------
             role: Role constant
             type: Type constant
-            columns: boolean, True if want only the column names
+            ret_cols: boolean, True if want only the column names
+            ret_ds: boolean, True if want a Dataset, a DatasetView that shares
+                             the columns and metadata with this Dataset
 
         Returns
         -------
@@ -198,17 +242,15 @@ class Dataset(dict):
         elif _type(type) == str:
             type = [type]
 
-        cols = [col for col in self.columns.tolist() 
-                        if self.role[col] in role and self.type[col] in type]
+        columns = pd.Index(self.columns)
+        mask = self.role.reindex(columns).isin(role).values & \
+                                    self.type.reindex(columns).isin(type).values
+        cols = columns[mask].tolist()
         
         if ret_cols:
             return cols
         elif ret_ds:
-            ds = Dataset(self.frame[cols])
-            for col in ds.columns:
-                ds.role[col] = self.role[col]
-                ds.type[col] = self.type[col]
-            return ds
+            return DatasetView(self, cols)
         else:
             return self.frame[cols]
 
@@ -217,7 +259,8 @@ class Dataset(dict):
     #                                    STATS
     # --------------------------------------------------------------------------
 
-    def unique_values(self, ascending=False):
+    @timed('Dataset.unique_values', data=lambda args, ans: args[0])
+    def unique_values(self, ascending=False, n_jobs=None):
         '''
         Generetas a Series with the number of unique values of each column
         Note: Excludes NA
@@ -225,26 +268,31 @@ class Dataset(dict):
         Parameters
         ----------
             ascending: boolean, sort the returned Series on this direction
+            n_jobs: int, number of processes, see copper.utils.frame.unique_values
 
         Returns
         -------
             pandas.Series
         '''
-        return copper.utils.frame.unique_values(self.frame, ascending=ascending)
+        return copper.utils.frame.unique_values(self.frame, ascending=ascending,
+                                                n_jobs=n_jobs)
 
-    def percent_missing(self, ascending=False):
+    @timed('Dataset.percent_missing', data=lambda args, ans: args[0])
+    def percent_missing(self, ascending=False, n_jobs=None):
         '''
         Generetas a Series with the percent of missing values of each column
 
         Parameters
         ----------
             ascending: boolean, sort the returned Series on this direction
+            n_jobs: int, number of processes, see copper.utils.frame.percent_missing
 
         Returns
         -------
             pandas.Series
         '''
-        return copper.utils.frame.percent_missing(self.frame, ascending=ascending)
+        return copper.utils.frame.percent_missing(self.frame, ascending=ascending,
+                                                  n_jobs=n_jobs)
 
     def variance_explained(self, cols=None, plot=False):
         '''
@@ -276,6 +324,7 @@ class Dataset(dict):
             plt.ylabel("Variance Explained")
         return variance
 
+    @timed('Dataset.corr', data=lambda args, ans: args[0])
     def corr(self, cols=None, ascending=False):
         ''' Correlation between inputs and target
         If a column has a role of target only values for that column are returned.
@@ -297,13 +346,11 @@ class Dataset(dict):
                 # If there is a target column use that
                 cols = self.role[self.role == self.TARGET].index[0]
             except:
-                cols = [c for c in self.columns
-                              if self.frame.dtypes[c] in (np.int64, np.float64)]
+                cols = self._number_cols()
         elif cols == 'all':
-            cols = [c for c in self.columns
-                              if self.frame.dtypes[c] in (np.int64, np.float64)]
+            cols = self._number_cols()
 
-        corrs = self.frame.corr()
+        corrs = self.frame[self._number_cols()].corr()
         corrs = corrs[cols]
         if type(corrs) is pd.Series:
             corrs = corrs[corrs.index != cols]
@@ -311,7 +358,8 @@ class Dataset(dict):
         else:
             return corrs
 
-    def fillna(self, cols=None, method='mean', value=None):
+    @timed('Dataset.fillna')
+    def fillna(self, cols=None, method='mean', value=None, by=None, **args):
         '''
         Fill missing values
 
@@ -321,37 +369,66 @@ class Dataset(dict):
             method: str, method to use to fill missing values
                 * mean(numerical,money)/mode(categorical): use the mean or most
                   repeted value of the column
-                * knn
+                * median(numerical)/mode(categorical): use the median or most
+                  repeted value of the column
+                * knn: use the k nearest neighbors on the numerical inputs,
+                  all the columns are imputed at once
+            by: str or list, columns that define groups, if given the
+                        mean/median/mode is calculated on each group
+
+        The statistics (of each group) and the neighbors of knn are learned
+        on this Dataset and reused when the recorded pipeline is replayed.
+            **args: arguments for the knn imputation, see
+                    copper.utils.frame.knn_impute: k, chunksize, n_jobs
         '''
         if cols is None:
             cols = self.columns
         if type(cols) == str:
             cols = [cols]
 
-        if method == 'mean' or method == 'mode':
+        if by is not None and method in ('mean', 'mode', 'median'):
+            keys = [by] if type(by) == str else by
+            cols = [col for col in cols
+                        if self.role[col] != self.REJECTED and col not in keys]
+            stats = copper.utils.frame.group_stats(self.frame, keys, cols,
+                                                   method=method)
+            step = GroupFill(keys, stats)
+            step.run(self)
+            self._record(step)
+        elif method in ('mean', 'mode', 'median'):
+            learned = {}
             for col in cols:
                 if self.role[col] != self.REJECTED:
                     if self.type[col] == self.NUMBER:
-                        if method == 'mean' or method == 'mode':
+                        if method == 'median':
+                            value = self[col].median()
+                        else:
                             value = self[col].mean()
                     if self.type[col] == self.CATEGORY:
-                        if method == 'mean' or method == 'mode':
-                            value = self[col].value_counts().index[0]
+                        value = self[col].value_counts().index[0]
                     self[col] = self[col].fillna(value=value)
+                    learned[col] = value
+            self._record(FillNA(learned.keys(), values=learned))
         elif method == 'knn':
-            # TODO: FIX
-            for col in cols:
-                imputed = copper.r.imputeKNN(self.frame)
-                self.frame[col] = imputed[col]
+            cols = [col for col in cols if self.role[col] != self.REJECTED]
+            features = self.filter(role=self.INPUT, type=self.NUMBER, ret_cols=True)
+            reference = copper.utils.frame.knn_reference(self.frame, cols, features)
+            step = KNNFill(cols, features, reference, **args)
+            step.run(self)
+            self._record(step)
         elif value is not None:
+            learned = {}
             for col in cols:
                 if self.role[col] != self.REJECTED:
                     if type(value) is str:
                         if self.role[col] != self.CATEGORY:
                             self[col] = self[col].fillna(value=value)
+                            learned[col] = value
                     elif type(value) is int or type(value) is float:
                         if self.role[col] != self.NUMBER:
                             self[col] = self[col].fillna(value=value)
+                            learned[col] = value
+            self._record(FillNA(learned.keys(), values=learned))
 
     def fix_names(self):
         ''' 
@@ -369,6 +446,136 @@ class Dataset(dict):
         self.role.index = new_cols
         self.type.index = new_cols
 
+    @timed('Dataset.compact', data=lambda args, ans: args[0])
+    def compact(self, cols=None, max_unique=0.5, lossy=False, unsigned=False):
+        '''
+        Reduces the memory of the frame: downcasts the numbers to the smallest
+        dtype that holds their values and stores the object columns with few
+        unique values as categorical. Role and type are kept.
+
+        Parameters
+        ----------
+            cols: list, columns to compact, default all
+            max_unique: float, maximum ratio of unique values to rows to store
+                               an object column as categorical
+            lossy: boolean, True to convert every float64 to float32 even if
+                            some values change
+            unsigned: boolean, True to use unsigned integers for non-negative
+                               columns, see copper.utils.frame.compact_series
+
+        Returns
+        -------
+            pandas.DataFrame with the dtype and bytes before and after of each
+            column
+        '''
+        return copper.utils.frame.compact_frame(self.frame, cols=cols,
+                                        max_unique=max_unique, lossy=lossy,
+                                        unsigned=unsigned)
+
+    # --------------------------------------------------------------------------
+    #                                  PIPELINE
+    # --------------------------------------------------------------------------
+
+    def record(self):
+        '''
+        Starts recording the transformations (apply, fillna, set_role,
+        set_type) made to the Dataset, they can be replayed on new data
+
+        Returns
+        -------
+            copper.Pipeline
+        '''
+        self.pipeline = Pipeline(self)
+        return self.pipeline
+
+    def _record(self, step):
+        if getattr(self, 'pipeline', None) is not None:
+            self.pipeline.add(step)
+
+    def apply(self, col, fnc, to=None, vectorized=False, name=None):
+        '''
+        Applies a function to the values of a column
+
+        Parameters
+        ----------
+            col: str, column name
+            fnc: function, of one value or of the Series if vectorized.
+                 Define it on a module to save a recorded pipeline, lambdas
+                 can not be pickled
+            to: str, column to save the result, default col
+            vectorized: boolean, True if fnc takes and returns the whole Series
+            name: str, name of the recorded step
+        '''
+        step = Apply(col, fnc, to=to, vectorized=vectorized, name=name)
+        step.run(self)
+        self._record(step)
+
+    def set_role(self, cols, role):
+        '''
+        Sets the role of columns, recorded if recording
+
+        Parameters
+        ----------
+            cols: str or list
+            role: Role constant
+        '''
+        step = Metadata('role', [cols] if type(cols) == str else cols, role)
+        step.run(self)
+        self._record(step)
+
+    def set_type(self, cols, type_):
+        '''
+        Sets the type of columns and updates the frame, recorded if recording
+
+        Parameters
+        ----------
+            cols: str or list
+            type_: Type constant
+        '''
+        step = Metadata('type', [cols] if type(cols) == str else cols, type_)
+        step.run(self)
+        self._record(step)
+
+    def set_hashing(self, cols, buckets=64):
+        '''
+        Converts categorical inputs for machine learning with a fixed number
+        of columns using the hashing trick instead of one column per category,
+        see copper.transform.category2hash. Useful for columns with many
+        categories (ids, urls, ...).
+
+        Parameters
+        ----------
+            cols: str or list
+            buckets: int, number of columns, None to use one column per
+                          category again
+        '''
+        for col in [cols] if type(cols) == str else cols:
+            if buckets is None:
+                self.hashing.pop(col, None)
+            else:
+                self.hashing[col] = buckets
+
+    def set_encoding(self, cols, method='target'):
+        '''
+        Converts categorical inputs for machine learning to one column of
+        numbers instead of one column per category
+
+        Parameters
+        ----------
+            cols: str or list
+            method: str, 'target' for the mean of the target of the category
+                         (out of fold, see copper.transform.category2target),
+                         'frequency' for the frequency of the category, None
+                         to use one column per category again
+        '''
+        if method not in ('target', 'frequency', None):
+            raise ValueError('Unknown encoding: %s' % method)
+        for col in [cols] if type(cols) == str else cols:
+            if method is None:
+                self.encoding.pop(col, None)
+            else:
+                self.encoding[col] = method
+
     # --------------------------------------------------------------------------
     #                                    CHARTS
     # --------------------------------------------------------------------------
@@ -423,21 +630,182 @@ class Dataset(dict):
 
     values = property(get_values)
 
-def join(ds1, ds2, others=[], how='outer'):
-    others.insert(0, ds2)
-    others.insert(0, ds1)
+class DatasetView(Dataset):
+    '''
+    Dataset with some of the columns of another Dataset, returned by
+    Dataset.filter(ret_ds=True).
+
+    Nothing is copied: single columns are read from the parent, the frame
+    shares the values of the parent (read only) and assigned columns are
+    kept on the view (copy on write), the parent is never modified. Role and
+    type are taken from the parent when first used.
+    '''
+
+    def __init__(self, parent, cols):
+        dict.__init__(self)
+        self._parent = parent
+        self._cols = list(cols)
+        self._own = {}
+        self._frame = None
+        self._role = None
+        self._type = None
+        self.columns = np.array(self._cols, dtype=object)
+        self.hashing = dict(getattr(parent, 'hashing', {}))
+        self.encoding = dict(getattr(parent, 'encoding', {}))
+
+    def _get_frame(self):
+        if self._frame is None:
+            # The columns of the parent are not copied, their values are read
+            # only so writing on them in place fails instead of modifying
+            # the parent, assigned columns replace them (copy on write)
+            parent = self._parent.frame
+            columns = {}
+            for col in self._cols:
+                if col in self._own:
+                    columns[col] = self._own[col]
+                elif isinstance(parent[col].values, np.ndarray):
+                    values = parent[col].values.view()
+                    values.flags.writeable = False
+                    columns[col] = pd.Series(values, index=parent.index, name=col,
+                                                                    copy=False)
+                else:
+                    # Categoricals (e.g. after compact) have no flags, they
+                    # are shared as they are
+                    columns[col] = parent[col]
+            self._frame = pd.DataFrame(columns, columns=self._cols, copy=False)
+            self._own = {}
+        return self._frame
+
+    def _set_frame(self, frame):
+        self._frame = frame
+        self._own = {}
+
+    frame = property(_get_frame, _set_frame)
+
+    def _get_role(self):
+        if self._role is None:
+            self._role = self._parent.role[self._cols]
+        return self._role
+
+    def _set_role(self, role):
+        self._role = role
+
+    role = property(_get_role, _set_role)
+
+    def _get_type(self):
+        if self._type is None:
+            self._type = self._parent.type[self._cols]
+        return self._type
+
+    def _set_type(self, type_):
+        self._type = type_
+
+    type = property(_get_type, _set_type)
+
+    def materialize(self):
+        '''
+        Returns
+        -------
+            copper.Dataset, a copy of the view that does not depend on the parent
+        '''
+        ans = Dataset()
+        ans.set_frame(self.frame.copy(), metadata=False)
+        ans.role = self.role.copy()
+        ans.type = self.type.copy()
+        ans.hashing = dict(self.hashing)
+        ans.encoding = dict(self.encoding)
+        return ans
+
+    def __reduce_ex__(self, protocol):
+        # Pickle (copper.save) the data of the view, not the parent
+        return (Dataset, (), self.materialize().__dict__)
+
+    def __getitem__(self, name):
+        if self._frame is not None:
+            return self._frame[name]
+        if name in self._own:
+            return self._own[name]
+        if name in self._cols:
+            return self._parent[name]
+        raise KeyError(name)
 
-    df = None
-    for ds in others:
-        if df is not None:
-            df = df.join(ds.frame, how=how)
+    def __setitem__(self, name, value):
+        if self._frame is not None or name not in self._cols:
+            self.frame[name] = value
         else:
-            df = ds.frame
+            self._own[name] = pd.Series(value, index=self._parent.frame.index, name=name)
+
+    def __len__(self):
+        if self._frame is not None:
+            return len(self._frame)
+        return len(self._parent)
 
-    ans = Dataset(df)
-    for ds in others:
-        for index, row in ds.metadata.iterrows():
-            ans.role[index] = row['Role']
-            ans.type[index] = row['Type']
+def _join_key(ds, on):
+    '''
+    Column used to join a Dataset: on if given else the column with role ID
+    '''
+    if on is not None:
+        return on if on in ds.columns else None
+    ids = ds.role[ds.role == ds.ID].index
+    return ids[0] if len(ids) > 0 else None
 
-    return ans
\ No newline at end of file
+@timed('copper.join')
+def join(ds1, ds2, others=None, how='outer', on=None):
+    '''
+    Joins two or more Datasets in one pass. If every Dataset has an ID column
+    (or the column on) the rows are aligned by that column, if not by the
+    index of the frames.
+
+    Columns with the same name on different Datasets are renamed with the
+    number of the Dataset: col_1, col_2, ...
+
+    Parameters
+    ----------
+        ds1, ds2: copper.Dataset
+        others: list, more Datasets to join
+        how: str, 'outer', 'inner' or 'left' (the rows of ds1)
+        on: str, name of the column to join on, default the ID column
+
+    Returns
+    -------
+        copper.Dataset, with the metadata of the joined Datasets
+    '''
+    datasets = [ds1, ds2] + list(others or [])
+    keys = [_join_key(ds, on) for ds in datasets]
+    by_key = all(key is not None for key in keys)
+
+    names = [[c for c in ds.columns if not (by_key and c == key)]
+                                            for ds, key in zip(datasets, keys)]
+    counts = pd.Series([c for cols in names for c in cols]).value_counts()
+    duplicated = set(counts[counts > 1].index)
+    if by_key:
+        duplicated.add(keys[0])
+
+    frames, roles, types = [], [], []
+    for i, (ds, key, cols) in enumerate(zip(datasets, keys, names)):
+        renames = dict((c, '%s_%d' % (c, i + 1)) for c in cols if c in duplicated)
+        frame = ds.frame.set_index(key) if by_key else ds.frame
+        if by_key and not frame.index.is_unique:
+            raise ValueError('Dataset %d has duplicated values on %s' % (i + 1, key))
+        frames.append(frame.rename(columns=renames))
+        roles.append(ds.role[cols].rename(renames))
+        types.append(ds.type[cols].rename(renames))
+
+    if how == 'left':
+        frame = pd.concat(frames, axis=1, join='outer').reindex(frames[0].index)
+    else:
+        frame = pd.concat(frames, axis=1, join=how)
+    role = pd.concat(roles)
+    type_ = pd.concat(types)
+
+    if by_key:
+        frame.index.name = keys[0]
+        frame = frame.reset_index()
+        role = pd.concat([datasets[0].role[[keys[0]]], role])
+        type_ = pd.concat([datasets[0].type[[keys[0]]], type_])
+
+    ans = Dataset()
+    ans.set_frame(frame, metadata=False)
+    ans.role = role.reindex(ans.columns).rename('Role')
+    ans.type = type_.reindex(ans.columns).rename('Type')
+    return ans
@@ -0,0 +1,138 @@
+import os
+import shutil
+import tempfile
+import copper
+import numpy as np
+import pandas as pd
+
+import unittest
+from copper.tests.CopperTest import CopperTest
+
+class Chunked(CopperTest):
+
+    def suite(self):
+        suite = unittest.TestSuite()
+        suite.addTest(Chunked('test_stats'))
+        suite.addTest(Chunked('test_fillna'))
+        suite.addTest(Chunked('test_inputs2ml'))
+        suite.addTest(Chunked('test_metadata'))
+        return suite
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def frame(self):
+        rng = np.random.RandomState(0)
+        df = pd.DataFrame({ 'ID': np.arange(1000),
+                            'A': rng.randn(1000),
+                            'B': rng.randn(1000),
+                            'Cat': rng.choice(['x', 'y', 'z'], 1000),
+                            'Target': rng.randint(2, size=1000),
+                            })
+        df['B'] = df['B'] + df['A']
+        df.loc[rng.rand(1000) < 0.1, 'A'] = np.nan
+        df.loc[rng.rand(1000) < 0.2, 'Cat'] = np.nan
+        df.loc[rng.rand(1000) < 0.6, 'Empty'] = 1
+        return df[['ID', 'A', 'B', 'Cat', 'Empty', 'Target']]
+
+    def chunked(self, df):
+        return copper.to_chunks(df, os.path.join(self.folder, 'ds'), chunksize=300)
+
+    def test_stats(self):
+        '''
+        Tests that metadata and statistics are the same as in memory
+        '''
+        df = self.frame()
+        ds = copper.Dataset(df.copy())
+        chunked = self.chunked(df)
+
+        self.assertEqual(len(chunked), 1000)
+        self.assertEqual(chunked.metadata, ds.metadata)
+        self.assertEqual(chunked.percent_missing(), ds.percent_missing(), digits=8)
+        self.assertEqual(chunked.unique_values().sort_index(),
+                         ds.unique_values().sort_index())
+        self.assertEqual(chunked.corr(), ds.corr(), digits=8)
+        self.assertEqual(chunked.corr(cols='all'), ds.corr(cols='all'), digits=8)
+        self.assertEqual(chunked.filter(role=ds.INPUT, ret_cols=True),
+                         ds.filter(role=ds.INPUT, ret_cols=True))
+
+        inputs = chunked.filter(role=ds.INPUT, ret_ds=True)
+        self.assertEqual(inputs.materialize().frame, ds.filter(role=ds.INPUT))
+        self.assertEqual(pd.concat(chunked.filter(type=ds.NUMBER)),
+                         ds.filter(type=ds.NUMBER))
+        self.assertEqual(chunked['Cat'].fillna('-').values, df['Cat'].fillna('-').values)
+        self.assertRaises(ValueError, lambda: chunked.frame)
+
+        # Reopen the store
+        chunked.role['B'] = ds.REJECTED
+        chunked.save_metadata()
+        self.assertEqual(copper.ChunkedDataset(chunked.folder).role['B'], ds.REJECTED)
+
+    def test_fillna(self):
+        '''
+        Tests the fill of missing values one chunk at a time
+        '''
+        df = self.frame()
+        ds = copper.Dataset(df.copy())
+        chunked = self.chunked(df)
+        ds.fillna(method='mean')
+        chunked.fillna(method='mean')
+        self.assertEqual(chunked.materialize().frame, ds.frame)
+
+        chunked = self.chunked(df)
+        chunked.fillna(cols='A', method='median')
+        missing = df['A'].isnull().values.nonzero()[0][0]
+        self.assertEqual(chunked['A'][missing], df['A'].median(), digits=8)
+        self.assertEqual(chunked['A'].isnull().sum(), 0)
+        self.assertRaises(ValueError, chunked.fillna, method='knn')
+
+        chunked['New'] = np.arange(1000) * 2
+        self.assertEqual(chunked['New'].values, np.arange(1000) * 2)
+        self.assertEqual(chunked.type['New'], ds.NUMBER)
+
+    def test_inputs2ml(self):
+        '''
+        Tests that all the chunks are converted with the same columns
+        '''
+        df = self.frame()
+        df = df[df['Cat'].notnull()]
+        df.loc[df.index[:300], 'Cat'] = 'x'
+        ds = copper.Dataset(df.copy())
+        chunked = self.chunked(df)
+        chunks = list(chunked.inputs2ml())
+        self.assertEqual(len(chunks), int(np.ceil(len(df) / 300)))
+        self.assertEqual(chunks[0].columns.tolist(), chunks[-1].columns.tolist())
+        sol = copper.transform.inputs2ml(ds)
+        self.assertEqual(pd.concat(chunks).values, sol.values)
+
+    def test_metadata(self):
+        '''
+        Tests that the metadata is saved on the store and pickled
+        '''
+        self.setUpData()
+        chunked = self.chunked(self.frame())
+        self.assertEqual(chunked.encoding, {})
+        self.assertEqual(copper.transform.learn_encodings(chunked), {})
+        chunked.set_type('ID', chunked.CATEGORY)
+        chunked.set_role(['ID', 'B'], chunked.REJECTED)
+        self.assertEqual(chunked.type['ID'], chunked.CATEGORY)
+        self.assertEqual(chunked.role['B'], chunked.REJECTED)
+        reopened = copper.ChunkedDataset(chunked.folder)
+        self.assertEqual(reopened.type['ID'], chunked.CATEGORY)
+        self.assertEqual(reopened.role['B'], chunked.REJECTED)
+
+        chunked.set_hashing('Cat', buckets=8)
+        copper.save(chunked, 'chunked', to='tmp')
+        loaded = copper.load(os.path.join('tmp', 'chunked.dataset'))
+        self.assertEqual(loaded.hashing, {'Cat': 8})
+        self.assertEqual(loaded.role, chunked.role)
+        self.assertEqual(pd.concat(loaded.inputs2ml()), pd.concat(chunked.inputs2ml()))
+        os.remove(os.path.join(copper.project.data, 'tmp', 'chunked.dataset'))
+
+
+if __name__ == '__main__':
+    suite = Chunked().suite()
+    unittest.TextTestRunner(verbosity=2).run(suite)
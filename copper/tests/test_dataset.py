@@ -1,4 +1,5 @@
 import os
+import warnings
 import copper
 import numpy as np
 import pandas as pd
@@ -15,8 +16,13 @@ class Dataset_1(CopperTest):
         # suite.addTest(Dataset_1('test_cat2num'))
         # suite.addTest(Dataset_1('test_fillna'))
         # suite.addTest(Dataset_1('test_fillna_2'))
+        suite.addTest(Dataset_1('test_fillna_knn'))
+        suite.addTest(Dataset_1('test_fillna_by'))
+        suite.addTest(Dataset_1('test_compact'))
         # suite.addTest(Dataset_1('test_join'))
+        suite.addTest(Dataset_1('test_join_id'))
         suite.addTest(Dataset_1('test_filter'))
+        suite.addTest(Dataset_1('test_filter_view'))
         return suite
 
     def test_create(self):
@@ -144,6 +150,115 @@ class Dataset_1(CopperTest):
         ds.fillna(method='mean')
         self.assertEqual(ds.frame, sol)
 
+    def test_fillna_knn(self):
+        '''
+        Tests the fill of missing values using the k nearest neighbors
+        '''
+        df = pd.DataFrame({ 'x': [1, 2, 3, 10, 11, 12, 2.1, 10.9],
+                            'y': [1, 2, 3, 10, 11, 12, np.nan, 11],
+                            'z': ['a', 'a', 'a', 'b', 'b', 'b', 'a', np.nan],
+                            })
+        ds = copper.Dataset(df)
+        ds.fillna(method='knn', k=2, chunksize=1)
+
+        self.assertEqual(ds['y'][6], 2.5, digits=8)
+        self.assertEqual(ds['z'][7], 'b')
+        # Other values are not modified
+        self.assertEqual(ds['y'][0:6].values, df['y'][0:6].values)
+        self.assertEqual(ds['x'].values, df['x'].values)
+
+        # No row has all the columns: each column uses the rows where it is known
+        df = pd.DataFrame({ 'x': [1, 2, 3, 10, 11, 12],
+                            'y': [1, 2, np.nan, 10, 11, np.nan],
+                            'z': [np.nan, 'a', 'a', np.nan, 'b', 'b'],
+                            })
+        ds = copper.Dataset(df)
+        ds.type['x'] = ds.NUMBER
+        ds.fillna(method='knn', k=2)
+        self.assertEqual(ds['y'][2], 1.5, digits=8)
+        self.assertEqual(ds['y'][5], 10.5, digits=8)
+        self.assertEqual(ds['z'].tolist(), ['a', 'a', 'a', 'b', 'b', 'b'])
+
+        # Nothing to take the neighbors from
+        empty = pd.DataFrame({'x': [1.0, 2.0], 'y': [np.nan, np.nan]})
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            ans = copper.utils.frame.knn_impute(empty, cols=['y'], features=['x'])
+        self.assertEqual(len(caught), 1)
+        self.assertEqual(ans['y'].isnull().tolist(), [True, True])
+
+    def test_fillna_by(self):
+        '''
+        Tests the fill of missing values with statistics of each group
+        '''
+        df = pd.DataFrame({ 'Region': ['N', 'N', 'N', 'S', 'S', 'S', 'E'],
+                            'Sales': [1, 3, np.nan, 10, 20, np.nan, np.nan],
+                            'Product': ['a', 'a', np.nan, 'b', np.nan, 'b', np.nan],
+                            })
+        ds = copper.Dataset(df)
+        ds.fillna(method='median', by='Region')
+
+        self.assertEqual(ds['Sales'][2], 2, digits=8)
+        self.assertEqual(ds['Sales'][5], 15, digits=8)
+        self.assertEqual(ds['Product'][2], 'a')
+        self.assertEqual(ds['Product'][4], 'b')
+        # Empty group uses the statistic of the whole column
+        self.assertEqual(ds['Sales'][6], 6.5, digits=8)
+        self.assertEqual(ds['Region'].values, df['Region'].values)
+
+        # Nothing known: the column is not modified
+        empty = pd.DataFrame({'Region': ['N', 'S'], 'Product': [np.nan, np.nan]},
+                             dtype=object)
+        ans = copper.utils.frame.group_fill(empty, 'Region', ['Product'], method='mode')
+        self.assertEqual(ans['Product'].isnull().tolist(), [True, True])
+
+    def test_compact(self):
+        '''
+        Tests the downcast of the columns keeping the values and metadata
+        '''
+        df = pd.DataFrame({ 'ID': np.arange(1000) + 70000,
+                            'Small': np.arange(1000) % 100 - 50,
+                            'Half': np.arange(1000) / 2,
+                            'Precise': np.arange(1000) / 3,
+                            'Cat': ['a', 'b', 'c', 'd'] * 250,
+                            'Text': ['t%d' % i for i in range(1000)],
+                            'Target': np.arange(1000) % 2,
+                            })
+        ds = copper.Dataset(df.copy())
+        role, type_ = ds.role.copy(), ds.type.copy()
+        report = ds.compact()
+
+        self.assertEqual(ds['ID'].dtype, np.int32)
+        self.assertEqual(ds['Small'].dtype, np.int8)
+        self.assertEqual(ds['Target'].dtype, np.int8)
+        self.assertEqual((ds['Target'] - 1).min(), -1)
+        self.assertEqual(ds['Half'].dtype, np.float32)
+        self.assertEqual(ds['Precise'].dtype, np.float64)
+        self.assertEqual(ds['Cat'].dtype.name, 'category')
+        self.assertEqual(ds['Text'].dtype, object)
+        for col in df.columns:
+            self.assertEqual(ds[col].astype(df[col].dtype).values, df[col].values)
+        self.assertEqual(ds.role, role)
+        self.assertEqual(ds.type, type_)
+
+        self.assertEqual(report['Dtype before']['Small'], 'int64')
+        self.assertEqual(report['Dtype after']['Small'], 'int8')
+        self.assertTrue(report['Bytes after']['Cat'] < report['Bytes before']['Cat'])
+        self.assertEqual(report['Reduction']['Text'], 0, digits=8)
+
+        ds.compact(lossy=True)
+        self.assertEqual(ds['Precise'].dtype, np.float32)
+
+        # Unsigned only if asked, a signed column is never widened
+        ds = copper.Dataset(df.copy())
+        ds.compact(unsigned=True)
+        self.assertEqual(ds['ID'].dtype, np.uint32)
+        self.assertEqual(ds['Target'].dtype, np.uint8)
+        self.assertEqual(ds['Small'].dtype, np.int8)
+        ds = copper.Dataset(pd.DataFrame({'U': np.arange(200, dtype=np.uint8)}))
+        ds.compact()
+        self.assertEqual(ds['U'].dtype, np.uint8)
+
     def test_join(self):
         '''
         Tests join of different datasets
@@ -171,6 +286,42 @@ class Dataset_1(CopperTest):
         ds = copper.join(ds1, ds2, others=[ds3, ds4])
         self.assertEqual(ds, ds_all)
 
+    def test_join_id(self):
+        '''
+        Tests join of datasets by the ID column
+        '''
+        ds1 = copper.Dataset(pd.DataFrame({'ID': [1, 2, 3, 4],
+                                           'Sales': [10, 20, 30, 40],
+                                           'Target': [0, 1, 0, 1]}))
+        ds2 = copper.Dataset(pd.DataFrame({'ID': [4, 3, 1, 5],
+                                           'Region': ['N', 'S', 'E', 'W'],
+                                           'Sales': [1.5, 2.5, 3.5, 4.5]}))
+        ds3 = copper.Dataset(pd.DataFrame({'ID': [3, 1],
+                                           'Age': [33, 11]}))
+        ds3.type['Age'] = ds3.CATEGORY
+
+        ds = copper.join(ds1, ds2, others=[ds3])
+        self.assertEqual(ds.columns.tolist(),
+                         ['ID', 'Sales_1', 'Target', 'Region', 'Sales_2', 'Age'])
+        self.assertEqual(ds['ID'].tolist(), [1, 2, 3, 4, 5])
+        self.assertEqual(ds['Region'].tolist()[2:], ['S', 'N', 'W'])
+        self.assertEqual(ds['Sales_2'][0], 3.5, digits=8)
+        self.assertEqual(ds['Age'][2], 33, digits=8)
+        self.assertEqual(ds.role['ID'], ds.ID)
+        self.assertEqual(ds.role['Target'], ds.TARGET)
+        self.assertEqual(ds.type['Region'], ds.CATEGORY)
+        self.assertEqual(ds.type['Age'], ds.CATEGORY)
+
+        ds = copper.join(ds1, ds2, others=[ds3], how='inner')
+        self.assertEqual(ds['ID'].tolist(), [1, 3])
+        ds = copper.join(ds1, ds3, how='left')
+        self.assertEqual(ds['ID'].tolist(), [1, 2, 3, 4])
+        self.assertEqual(ds.columns.tolist(), ['ID', 'Sales', 'Target', 'Age'])
+
+        # The default list of others is not modified between calls
+        self.assertEqual(len(copper.join(ds1, ds3).columns), 4)
+        self.assertEqual(len(copper.join(ds1, ds3).columns), 4)
+
     def test_filter(self):
         '''
         Tests: filter
@@ -253,6 +404,65 @@ class Dataset_1(CopperTest):
         self.assertEqual(ds.filter(role=[ds.INPUT, ds.TARGET], type=[ds.NUMBER, ds.CATEGORY]), df)
         
         
+    def test_filter_view(self):
+        '''
+        Tests: filter(ret_ds=True) shares the data and copies on write
+        '''
+        df = pd.DataFrame({ 'ID': range(5),
+                            'A': np.arange(5) * 1.0,
+                            'B': ['a', 'b', 'a', 'b', 'c'],
+                            'C': np.ones(5),
+                            'Target': [0, 1, 0, 1, 0],
+                            })
+        ds = copper.Dataset(df)
+        ds.type['C'] = ds.CATEGORY
+        view = ds.filter(role=ds.INPUT, ret_ds=True)
+
+        self.assertEqual(view.columns.tolist(), ['A', 'B', 'C'])
+        self.assertIs(view['A'], ds['A'])
+        self.assertIs(view._frame, None)
+        self.assertEqual(len(view), 5)
+        self.assertEqual(view.type['C'], ds.CATEGORY)
+        self.assertEqual(view.role.tolist(), [ds.INPUT] * 3)
+
+        # Copy on write: data and metadata
+        view['A'] = view['A'] + 1
+        view.role['B'] = ds.REJECTED
+        self.assertEqual(view['A'].tolist(), [1, 2, 3, 4, 5])
+        self.assertEqual(ds['A'].tolist(), [0, 1, 2, 3, 4])
+        self.assertEqual(ds.role['B'], ds.INPUT)
+        self.assertEqual(view.frame, pd.DataFrame({'A': np.arange(5) + 1.0,
+                                                   'B': df['B'], 'C': df['C']}))
+        self.assertEqual(view.filter(role=ds.INPUT, ret_cols=True), ['A', 'C'])
+
+        # The frame shares the values of the parent, writing in place fails
+        self.assertTrue(np.shares_memory(view.frame['C'].values, ds.frame['C'].values))
+        self.assertTrue(np.shares_memory(view.frame['B'].values, ds.frame['B'].values))
+        self.assertFalse(np.shares_memory(view.frame['A'].values, ds.frame['A'].values))
+        def write():
+            view.frame['C'].values[0] = 5
+        self.assertRaises(ValueError, write)
+        self.assertEqual(ds['C'].tolist(), [1] * 5)
+
+        # Works with the Dataset methods
+        self.assertEqual(copper.transform.inputs2ml(view).columns.tolist(),
+                         ['A', 'C [1.0]'])
+        ds2 = view.materialize()
+        self.assertIs(type(ds2), copper.Dataset)
+        self.assertEqual(ds2.frame, view.frame)
+        self.assertEqual(ds2.metadata, view.metadata)
+
+        # Categorical columns of a compacted Dataset
+        ds = copper.Dataset(pd.DataFrame({'A': np.arange(10) * 1.0,
+                                          'B': ['a', 'b'] * 5}))
+        ds.compact()
+        self.assertEqual(ds.frame['B'].dtype.name, 'category')
+        view = ds.filter(role=ds.INPUT, ret_ds=True)
+        self.assertEqual(view.frame['B'].tolist(), ['a', 'b'] * 5)
+        self.assertEqual(copper.transform.inputs2ml(view).columns.tolist(),
+                         ['A', 'B [a]', 'B [b]'])
+
+
 if __name__ == '__main__':
     # unittest.main()
     suite = Dataset_1().suite()
@@ -0,0 +1,51 @@
+import os
+import sys
+import copper
+import subprocess
+
+import unittest
+from copper.tests.CopperTest import CopperTest
+
+class Import(CopperTest):
+
+    def suite(self):
+        suite = unittest.TestSuite()
+        suite.addTest(Import('test_lazy'))
+        return suite
+
+    def run_python(self, code):
+        root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        env = dict(os.environ, PYTHONPATH=root, MPLBACKEND='Agg')
+        out = subprocess.check_output([sys.executable, '-c', code], env=env)
+        return out.decode('utf-8').strip()
+
+    def test_lazy(self):
+        '''
+        Tests that import copper does not import the heavy packages and that
+        the public names are loaded on first access
+        '''
+        code = 'import sys, copper; print(%s in sys.modules)'
+        self.assertEqual(self.run_python(code % "'sklearn'"), 'False')
+        self.assertEqual(self.run_python(code % "'matplotlib.pyplot'"), 'False')
+
+        code = 'import sys, copper; copper.MachineLearning; print(%s in sys.modules)'
+        self.assertEqual(self.run_python(code % "'sklearn'"), 'True')
+
+        self.assertIs(copper.MachineLearning, copper.core.ml.MachineLearning)
+        self.assertIs(copper.transform, copper.utils.transforms)
+        self.assertIs(copper.plot, copper.viz.base)
+        self.assertIn('MachineLearning', dir(copper))
+
+        # Python < 3.7: the module class gives the lazy names
+        code = ('import sys, copper, copper.utils; '
+                'del copper.__getattr__, copper.utils.__getattr__; '
+                'copper.__class__ = copper._LazyModule; '
+                'copper.utils.__class__ = copper.utils._LazyModule; '
+                'print(copper.transform is copper.utils.transforms, '
+                '\'MachineLearning\' in dir(copper))')
+        self.assertEqual(self.run_python(code), 'True True')
+
+
+if __name__ == '__main__':
+    suite = Import().suite()
+    unittest.TextTestRunner(verbosity=2).run(suite)
@@ -0,0 +1,123 @@
+import os
+import copper
+import numpy as np
+import pandas as pd
+
+import unittest
+from copper.tests.CopperTest import CopperTest
+
+class Instrument(CopperTest):
+
+    def suite(self):
+        suite = unittest.TestSuite()
+        suite.addTest(Instrument('test_disabled'))
+        suite.addTest(Instrument('test_stats'))
+        suite.addTest(Instrument('test_threads'))
+        suite.addTest(Instrument('test_peak'))
+        return suite
+
+    def tearDown(self):
+        copper.instrument.disable()
+        copper.instrument.reset()
+
+    def frame(self):
+        return pd.DataFrame({'Num': [1, 2, None, 4], 'Cat': ['a', 'b', 'a', None],
+                             'Target': [0, 1, 0, 1]})
+
+    def test_disabled(self):
+        '''
+        Tests that nothing is recorded when disabled
+        '''
+        copper.instrument.reset()
+        ds = copper.Dataset(self.frame())
+        ds.fillna(method='mean')
+        self.assertEqual(len(copper.instrument.stats()), 0)
+
+    def test_stats(self):
+        '''
+        Tests the calls, rows, columns and bytes recorded
+        '''
+        copper.instrument.reset()
+        copper.instrument.enable(memory=True)
+        ds = copper.Dataset(self.frame())
+        ds.fillna(method='mean')
+        copper.transform.inputs2ml(ds)
+        copper.transform.inputs2ml(ds)
+        copper.transform.category2hash(ds['Cat'], buckets=4)
+        stats = copper.instrument.stats()
+
+        self.assertEqual(stats['Calls']['Dataset.set_frame'], 1)
+        self.assertEqual(stats['Rows']['Dataset.set_frame'], 4)
+        self.assertEqual(stats['Columns']['Dataset.set_frame'], 3)
+        self.assertEqual(stats['Calls']['transform.inputs2ml'], 2)
+        self.assertEqual(stats['Rows']['transform.inputs2ml'], 8)
+        self.assertEqual(stats['Calls']['transform.category2hash'], 1)
+        self.assertEqual(stats['Rows']['transform.category2hash'], 4)
+        self.assertTrue(stats['Calls']['Dataset.fillna'] >= 1)
+        self.assertTrue((stats['Seconds'] >= 0).all())
+        self.assertTrue(stats['Bytes']['Dataset.set_frame'] > 0)
+
+        copper.instrument.disable()
+        ds.fillna(method='mean')
+        self.assertEqual(copper.instrument.stats()['Calls']['transform.inputs2ml'], 2)
+
+    def test_threads(self):
+        '''
+        Tests that the calls running at the same time on different threads
+        keep their own memory peaks
+        '''
+        import threading
+        from copper.utils import instrument
+        copper.instrument.reset()
+        copper.instrument.enable(memory=True)
+        barrier = threading.Barrier(2)
+
+        @instrument.timed('test.depth')
+        def depth(i):
+            barrier.wait()
+            ans = len(instrument._stack())
+            barrier.wait()
+            return ans
+
+        ans = copper.utils.parallel.pmap(depth, range(2), n_jobs=2)
+        self.assertEqual(ans, [1, 1])
+        self.assertEqual(copper.instrument.stats()['Calls']['test.depth'], 2)
+        self.assertEqual(len(instrument._stack()), 0)
+
+    def test_peak(self):
+        '''
+        Tests that a call is not charged the peak of an earlier call, also
+        without tracemalloc.reset_peak (python < 3.9)
+        '''
+        import tracemalloc
+        from copper.utils import instrument
+
+        @instrument.timed('test.big')
+        def big():
+            return np.ones(10 ** 6).sum()
+
+        @instrument.timed('test.small')
+        def small():
+            return np.ones(10).sum()
+
+        reset_peak = getattr(tracemalloc, 'reset_peak', None)
+        for without in (False, True):
+            copper.instrument.reset()
+            copper.instrument.enable(memory=True)
+            if without and reset_peak is not None:
+                del tracemalloc.reset_peak
+            try:
+                big()
+                small()
+            finally:
+                if reset_peak is not None:
+                    tracemalloc.reset_peak = reset_peak
+                copper.instrument.disable()
+            stats = copper.instrument.stats()
+            self.assertTrue(stats['Bytes']['test.big'] >= 8 * 10 ** 6)
+            self.assertTrue(stats['Bytes']['test.small'] < 10 ** 5)
+
+
+if __name__ == '__main__':
+    suite = Instrument().suite()
+    unittest.TextTestRunner(verbosity=2).run(suite)
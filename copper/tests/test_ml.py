@@ -1,5 +1,6 @@
 import os
 import copper
+import numpy as np
 import pandas as pd
 
 import unittest
@@ -11,6 +12,7 @@ class ML_basic(CopperTest):
         suite = unittest.TestSuite()
         suite.addTest(ML_basic('test_models_list'))
         suite.addTest(ML_basic('test_transformations'))
+        suite.addTest(ML_basic('test_cm_multiclass'))
         return suite
         
     def test_models_list(self):
@@ -108,6 +110,37 @@ class ML_basic(CopperTest):
         self.assertEqual(ml.X_test, copper.transform.inputs2ml(ds).values)
         self.assertEqual(ml.y_test, copper.transform.target2ml(ds).values)
 
+    def test_cm_multiclass(self):
+        '''
+        Tests the confusion matrixes and costs with more than 2 classes
+        '''
+        from sklearn.naive_bayes import GaussianNB
+        from sklearn.metrics import confusion_matrix
+
+        rng = np.random.RandomState(0)
+        X = rng.randn(300, 3)
+        y = np.argmax(X + rng.randn(300, 3), axis=1)
+
+        ml = copper.MachineLearning()
+        ml.X_train, ml.y_train = X[:150], y[:150]
+        ml.X_test, ml.y_test = X[150:], y[150:]
+        ml.add_clf(GaussianNB(), 'GNB')
+        ml.fit()
+
+        cm = confusion_matrix(ml.y_test, ml._clfs['GNB'].predict(ml.X_test))
+        self.assertEqual(ml._cm()['GNB'], cm)
+        self.assertEqual(ml.cm_table()['Correct 2\'s']['GNB'], cm[2, 2])
+
+        ml.costs = [[0, -1, -2], [-3, 10, -4], [-5, -6, 20]]
+        costs = np.array(ml.costs)
+        profit = ml.profit()
+        self.assertEqual(profit['Revenue']['GNB'], cm[1, 1] * 10 + cm[2, 2] * 20)
+        loss = cm[0, 1] * -1 + cm[0, 2] * -2 + cm[1, 2] * -4 + cm[2, 1] * -6
+        self.assertEqual(profit['Loss from False Positive']['GNB'], loss)
+        errors = (cm * costs).sum() - (np.diag(cm) * np.diag(costs)).sum()
+        self.assertEqual(ml.oportunity_cost()['GNB'], errors)
+
+
 if __name__ == '__main__':
     suite = ML_basic().suite()
     unittest.TextTestRunner(verbosity=2).run(suite)
@@ -6,6 +6,18 @@ import pandas as pd
 import unittest
 from copper.tests.CopperTest import CopperTest
 
+class PartialFitRecorder(object):
+    '''
+    Classifier that keeps the inputs given to partial_fit
+    '''
+
+    def __init__(self):
+        self.X = []
+
+    def partial_fit(self, X, y, classes=None):
+        self.X.append(X.copy())
+        return self
+
 class ML_1(CopperTest):
     '''
     This tests covers an example using the catalog dataset
@@ -20,6 +32,14 @@ class ML_1(CopperTest):
         # suite.addTest(ML_1('test_costs'))
         # suite.addTest(ML_1('test_predict'))
         suite.addTest(ML_1('test_bag'))
+        suite.addTest(ML_1('test_cross_validate'))
+        suite.addTest(ML_1('test_search'))
+        suite.addTest(ML_1('test_profit_curve'))
+        suite.addTest(ML_1('test_binned_auc'))
+        suite.addTest(ML_1('test_predict_to_file'))
+        suite.addTest(ML_1('test_save_load'))
+        suite.addTest(ML_1('test_fit_stream'))
+        suite.addTest(ML_1('test_predict_labels'))
         return suite
 
     def setup(self):
@@ -74,9 +94,36 @@ class ML_1(CopperTest):
         self.assertEqual(self.ml.predict(ds=self.test), predict_test)
         self.assertEqual(self.ml.predict(self.train), predict_train)
 
-        self.assertEqual(self.ml.predict_proba(), predict_proba_test, digits=1)
-        self.assertEqual(self.ml.predict_proba(self.test), predict_proba_test, digits=1)
-        self.assertEqual(self.ml.predict_proba(ds=self.train), predict_proba_train, digits=1)
+        # predict_proba returns the probabilities of every class
+        cols = ['%s [0]' % clf_name for clf_name in predict_proba_test.columns]
+        self.assertEqual(self.ml.predict_proba()[cols].values, predict_proba_test.values, digits=1)
+        self.assertEqual(self.ml.predict_proba(self.test)[cols].values, predict_proba_test.values, digits=1)
+        self.assertEqual(self.ml.predict_proba(ds=self.train)[cols].values, predict_proba_train.values, digits=1)
+        self.assertEqual(self.ml.predict_proba().shape, (len(self.test), 8))
+        self.assertEqual(self.ml.predict_proba().sum(axis=1).values, np.ones(len(self.test)), digits=8)
+
+        # Same results scoring the classifiers one after the other
+        self.assertEqual(self.ml.predict(n_jobs=1), self.ml.predict())
+        self.assertEqual(self.ml.predict_proba(n_jobs=1), self.ml.predict_proba())
+
+    def test_predict_labels(self):
+        '''
+        Tests that the predictions keep the labels of the classifiers
+        '''
+        self.setup()
+        from sklearn.naive_bayes import GaussianNB
+        labels = np.array(['no', 'yes'])[self.ml.y_train.astype(int)]
+        clf = GaussianNB().fit(self.ml.X_train, labels)
+
+        ml = copper.MachineLearning()
+        ml.test = self.test
+        ml.add_clf(clf, 'GNB')
+        expected = np.array(['no', 'yes'])[self.ml.predict(clfs=['GNB'])['GNB'].values.astype(int)]
+        self.assertEqual(ml.predict()['GNB'].values, expected)
+        self.assertEqual(ml.predict(n_jobs=2)['GNB'].values, expected)
+
+        # Numeric labels keep a numeric dtype
+        self.assertEqual(self.ml.predict()['GNB'].dtype.kind in 'biuf', True)
 
     def test_metrics(self):
         '''
@@ -175,6 +222,283 @@ class ML_1(CopperTest):
         self.assertEqual(len(mse), 5)
         self.assertEqual(mse['bag'], 0.2810)
 
+    def test_cross_validate(self):
+        '''
+        Tests the k-fold cross validation
+        '''
+        self.setup()
+
+        cv = self.ml.cross_validate(k=3, n_jobs=2)
+        self.assertEqual(len(cv), 4 * 3)
+        self.assertEqual(set(cv['Classifier']), set(['SVM', 'DT', 'GNB', 'GB']))
+        self.assertEqual(set(cv['Fold']), set([0, 1, 2]))
+
+        # Each fold is used once as test and the folds keep the target proportion
+        folds = copper.utils.ml.kfold(self.ml.y_train, k=3)
+        tested = np.concatenate([test_index for train_index, test_index in folds])
+        self.assertEqual(np.sort(tested), np.arange(len(self.ml.y_train)))
+        rate = self.ml.y_train.mean()
+        for train_index, test_index in folds:
+            self.assertEqual(self.ml.y_train[test_index].mean(), rate, digits=2)
+
+        # The scores are of the folds of kfold
+        from sklearn.naive_bayes import GaussianNB
+        X, y = self.ml.X_train, self.ml.y_train
+        gnb = cv[cv['Classifier'] == 'GNB'].set_index('Fold')
+        for fold, (train_index, test_index) in enumerate(folds):
+            clf = GaussianNB().fit(X[train_index], y[train_index])
+            accuracy = np.mean(clf.predict(X[test_index]) == y[test_index])
+            self.assertEqual(gnb['Accuracy'][fold], accuracy, digits=10)
+        self.assertTrue(gnb['Area Under the Curve'].notnull().all())
+
+        # Same seed gives the same folds, other seed other folds
+        cv_serial = self.ml.cross_validate(k=3, clfs=['GNB'])
+        self.assertEqual(cv_serial['Accuracy'].values, gnb['Accuracy'].values)
+        cv_other = self.ml.cross_validate(k=3, clfs=['GNB'], random_state=1)
+        self.assertFalse(np.allclose(cv_other['Accuracy'].values, gnb['Accuracy'].values))
+
+        # No Area Under the Curve with more than two classes
+        rng = np.random.RandomState(0)
+        df = pd.DataFrame({'A': rng.randn(300), 'Target': rng.randint(3, size=300)})
+        ds = copper.Dataset(df)
+        ds.role['Target'] = ds.TARGET
+        cv = self.ml.cross_validate(k=3, ds=ds, clfs=['GNB'])
+        self.assertTrue(cv['Area Under the Curve'].isnull().all())
+        self.assertTrue(cv['Accuracy'].notnull().all())
+
+    def test_search(self):
+        '''
+        Tests the hyperparameter search with successive halving
+        '''
+        self.setup()
+
+        from sklearn import tree
+        params = {'max_depth': [1, 2, 4, 6, 8, 10, 12, 14, 16]}
+        history = self.ml.search(tree.DecisionTreeClassifier(), params, 'search',
+                                            keep=1, factor=3, n_jobs=2)
+        # 9 candidates -> 3 -> 1
+        self.assertEqual(history.groupby('Round').size().values, np.array([9, 3]))
+        self.assertEqual(len(self.ml.clfs), 5)
+        self.assertIn('search_0', self.ml.clfs.index)
+
+        self.ml.rm_clf('search_0')
+
+        # Invalid values are scored -inf with their error, coding errors raise
+        params = {'max_depth': [2, -1]}
+        history = self.ml.search(tree.DecisionTreeClassifier(), params, 'search',
+                                            keep=1, factor=2)
+        failed = history[history['Params'] == str({'max_depth': -1})]
+        self.assertEqual(failed['Score'].tolist(), [-np.inf])
+        self.assertIn('max_depth', failed['Error'].iloc[0])
+        self.assertTrue(history['Error'][history['Score'] > 0].isnull().all())
+        self.ml.rm_clf('search_0')
+        self.assertRaises(ValueError, self.ml.search, tree.DecisionTreeClassifier(),
+                          {'depth': [1, 2]}, 'search')
+
+    def test_profit_curve(self):
+        '''
+        Tests the threshold sweep of the profit and oportunity cost
+        '''
+        self.setup()
+        self.ml.costs = [[0, 4], [12, 16]]
+
+        # The best threshold is at least as good as the default one
+        profit = self.ml.profit()
+        curve = self.ml.profit_curve()
+        self.assertEqual(len(curve), 4)
+        for clf_name in curve.index:
+            self.assertTrue(curve['Profit'][clf_name] >= profit['Profit'][clf_name])
+
+        # Predicting with the best threshold gives the reported profit
+        probas = self.ml._clfs['GNB'].predict_proba(self.ml.X_test)[:, 1]
+        y_pred = probas >= curve['Threshold']['GNB']
+        tp = (y_pred & (self.ml.y_test == 1)).sum()
+        fp = (y_pred & (self.ml.y_test == 0)).sum()
+        self.assertEqual(curve['Profit']['GNB'], tp * 16 - fp * 4)
+
+        cost = self.ml.cost_curve()
+        oportunity_cost = self.ml.oportunity_cost()
+        for clf_name in cost.index:
+            self.assertTrue(cost['Oportuniy cost'][clf_name] <= oportunity_cost[clf_name])
+
+        # Default costs are negative: the best threshold has the smallest loss
+        self.ml.costs = [[1, -1], [-1, 1]]
+        cost = self.ml.cost_curve()
+        oportunity_cost = self.ml.oportunity_cost()
+        for clf_name in cost.index:
+            self.assertTrue(cost['Oportuniy cost'][clf_name] >= oportunity_cost[clf_name])
+            self.assertTrue(cost['Threshold'][clf_name] < np.inf)
+
+        self.assertRaises(ValueError, self.ml.cost_curve, clfs=[])
+        self.assertRaises(ValueError, self.ml.profit_curve, clfs=[])
+
+    def test_binned_auc(self):
+        '''
+        Tests the approximated Area Under the Curve using histograms
+        '''
+        self.setup()
+
+        auc = self.ml.auc()
+        binned = self.ml.auc(bins=1000, chunksize=300, n_jobs=2)
+        for clf_name in auc.index:
+            roc = copper.utils.ml.binned_roc(self.ml._clfs[clf_name],
+                                self.ml.X_test, self.ml.y_test, bins=1000)
+            self.assertEqual(roc.auc(), binned[clf_name], digits=8)
+            self.assertTrue(abs(binned[clf_name] - auc[clf_name]) <= roc.error() + 1e-8)
+            fpr, tpr, thresholds = roc.curve()
+            self.assertEqual(len(fpr), 1001)
+
+        # The chart reports the same areas
+        areas = self.ml.roc(bins=1000, chunksize=300, ret_list=True)
+        self.assertEqual(areas[binned.index].values, binned.values, digits=8)
+
+        # Merging the histograms of the chunks is the same as one histogram
+        probas = self.ml._clfs['GNB'].predict_proba(self.ml.X_test)[:, 1]
+        one = copper.utils.ml.BinnedROC(100).update(self.ml.y_test, probas)
+        merged = copper.utils.ml.BinnedROC(100)
+        merged.merge(copper.utils.ml.BinnedROC(100).update(self.ml.y_test[:500], probas[:500]))
+        merged.merge(copper.utils.ml.BinnedROC(100).update(self.ml.y_test[500:], probas[500:]))
+        self.assertEqual(one.positives, merged.positives)
+        self.assertEqual(one.negatives, merged.negatives)
+
+        # A shard with one class has no curve until it is merged
+        negatives = self.ml.y_test == 0
+        shard = copper.utils.ml.BinnedROC(100).update(self.ml.y_test[negatives],
+                                                      probas[negatives])
+        self.assertRaises(ValueError, shard.curve)
+        self.assertRaises(ValueError, shard.auc)
+        shard.merge(copper.utils.ml.BinnedROC(100).update(self.ml.y_test[~negatives],
+                                                          probas[~negatives]))
+        self.assertEqual(shard.auc(), one.auc(), digits=10)
+
+    def test_predict_to_file(self):
+        '''
+        Tests the prediction by chunks saved to a file
+        '''
+        self.setup()
+
+        report = self.ml.predict_to_file(self.test, 'predictions', chunksize=300,
+                                                                    to='tmp')
+        self.assertEqual(report['Rows'], len(self.test))
+        self.assertEqual(report['Chunks'], 7)
+
+        filepath = os.path.join(copper.project.data, 'tmp', 'predictions.csv')
+        ans = pd.read_csv(filepath).set_index('CustomerID')
+        self.assertEqual(ans.index.values, self.test['CustomerID'].values)
+        self.assertEqual(ans.values, self.ml.predict().values)
+
+        # From a csv file, using the training metadata
+        copper.save(self.test, 'test', format='csv', to='tmp')
+        self.ml.predict_to_file('tmp/test.csv', 'predictions', chunksize=1000,
+                                                        proba=True, to='tmp')
+        ans = pd.read_csv(filepath).set_index('CustomerID')
+        self.assertEqual(ans.values, self.ml.predict_proba().values, digits=4)
+        os.remove(filepath)
+        os.remove(os.path.join(copper.project.data, 'tmp', 'test.csv'))
+
+    def test_save_load(self):
+        '''
+        Tests save and load of a fitted MachineLearning
+        '''
+        self.setup()
+        import shutil
+
+        copper.save(self.ml, 'catalog', to='tmp')
+        folder = os.path.join(copper.project.data, 'tmp', 'catalog.ml')
+        self.assertTrue(os.path.isfile(os.path.join(folder, 'ml.pkl')))
+
+        ml = copper.load('tmp/catalog.ml')
+        self.assertIsInstance(ml.X_test, np.memmap)
+        self.assertEqual(set(ml.clfs.index), set(self.ml.clfs.index))
+        self.assertEqual(ml.predict(), self.ml.predict())
+        self.assertEqual(ml.predict_proba(), self.ml.predict_proba())
+        self.assertEqual(ml.accuracy(), self.ml.accuracy())
+
+        ml = copper.load('tmp/catalog.ml', mmap_mode=None)
+        self.assertNotIsInstance(ml.X_test, np.memmap)
+        self.assertEqual(ml.predict(), self.ml.predict())
+        shutil.rmtree(folder)
+
+        # Arrays of the models: the support vectors are shared, the arrays of
+        # the trees (single or ensembles) are copied by scikit-learn
+        from copper.core.io import _save_ml, _load_ml
+        _save_ml(self.ml, folder, min_bytes=1024, keep_data=False)
+        ml = _load_ml(folder)
+        self.assertEqual(ml.X_train, None)
+        self.assertEqual(ml.X_test, None)
+        self.assertIsInstance(ml._clfs['SVM'].support_vectors_, np.memmap)
+        self.assertIsInstance(ml._clfs['SVM'].dual_coef_, np.memmap)
+        self.assertNotIsInstance(ml._clfs['DT'].tree_.value, np.memmap)
+        self.assertNotIsInstance(ml._clfs['GB'].estimators_[0, 0].tree_.value, np.memmap)
+        self.assertEqual(ml.predict(self.test), self.ml.predict(self.test))
+
+        # Saving a loaded MachineLearning keeps the memory-mapped arrays apart
+        other = os.path.join(copper.project.data, 'tmp', 'other.ml')
+        _save_ml(ml, other, min_bytes=1024)
+        self.assertIsInstance(_load_ml(other)._clfs['SVM'].support_vectors_, np.memmap)
+        shutil.rmtree(folder)
+        shutil.rmtree(other)
+
+    def test_fit_stream(self):
+        '''
+        Tests the incremental training by chunks with partial_fit
+        '''
+        self.setup()
+        from sklearn.naive_bayes import GaussianNB
+        from sklearn.linear_model import SGDClassifier
+        from sklearn import tree
+
+        ml = copper.MachineLearning()
+        ml.add_clf(GaussianNB(), 'GNB')
+        ml.add_clf(SGDClassifier(random_state=0), 'SGD')
+        ml.add_clf(tree.DecisionTreeClassifier(), 'DT')
+        report = ml.fit_stream(self.train, chunksize=500, epochs=2,
+                                                    holdout=self.test)
+        self.assertEqual(len(report), 4)
+        self.assertEqual(set(report['Classifier']), set(['GNB', 'SGD']))
+        self.assertEqual(report['Rows'].values, np.array([len(self.train)] * 4))
+
+        # Same as fitting all the data at once: GaussianNB is exact
+        ml.test = self.test
+        report = report.set_index(['Epoch', 'Classifier'])
+        accuracy = self.ml.accuracy()['GNB']
+        self.assertEqual(report['Holdout accuracy'][(1, 'GNB')], accuracy, digits=4)
+        self.assertEqual(ml.predict(clfs=['GNB']).values,
+                         self.ml.predict(clfs=['GNB']).values)
+        self.assertTrue(report['Holdout accuracy'][(1, 'SGD')] > 0.5)
+
+        # From the chunks of a ChunkedDataset
+        import shutil
+        import tempfile
+        folder = tempfile.mkdtemp()
+        chunked = copper.to_chunks(self.train, os.path.join(folder, 'train'),
+                                                            chunksize=1000)
+        ml = copper.MachineLearning()
+        ml.add_clf(GaussianNB(), 'GNB')
+        report = ml.fit_stream(chunked, holdout=self.test)
+        self.assertEqual(report['Holdout accuracy'][0], accuracy, digits=4)
+        shutil.rmtree(folder)
+
+        # Target encoded inputs are trained out of fold
+        rng = np.random.RandomState(0)
+        df = pd.DataFrame({'Cat': rng.choice(['u%d' % i for i in range(300)], 1000),
+                           'Target': rng.randint(2, size=1000)})
+        ds = copper.Dataset(df)
+        ds.role['Target'] = ds.TARGET
+        ds.type['Target'] = ds.CATEGORY
+        ds.set_encoding('Cat', method='target')
+        recorder = PartialFitRecorder()
+        ml = copper.MachineLearning()
+        ml.add_clf(recorder, 'Recorder')
+        ml.fit_stream(ds, chunksize=300)
+        oof = copper.transform.category2target(df['Cat'], df['Target'].values)
+        position = ml._columns.tolist().index('Cat [target]')
+        self.assertEqual(np.vstack(recorder.X)[:, position], oof.values[:, 0], digits=10)
+        # New data uses the encoding learned on all the rows
+        learned = copper.transform.category2encoding(df['Cat'], ml._encoding['Cat'])
+        self.assertEqual(ml._encode(ds)[:, position], learned.values[:, 0], digits=10)
+
+
 if __name__ == '__main__':
     suite = ML_1().suite()
     unittest.TextTestRunner(verbosity=2).run(suite)
@@ -0,0 +1,202 @@
+import os
+import pickle
+import copper
+import numpy as np
+import pandas as pd
+
+import unittest
+from copper.tests.CopperTest import CopperTest
+
+class Pipeline(CopperTest):
+
+    def suite(self):
+        suite = unittest.TestSuite()
+        suite.addTest(Pipeline('test_replay'))
+        suite.addTest(Pipeline('test_change'))
+        suite.addTest(Pipeline('test_replay_chunks'))
+        suite.addTest(Pipeline('test_replay_fillna'))
+        suite.addTest(Pipeline('test_names'))
+        suite.addTest(Pipeline('test_cache'))
+        return suite
+
+    def record(self):
+        self.setUpData()
+        self.fnc = lambda x: 12*(2007 - int(str(x)[0:4])) - int(str(x)[4:6]) + 2
+        self.train = copper.Dataset('ml/1/train.csv')
+        pipeline = self.train.record()
+        self.train.set_role('CustomerID', self.train.ID)
+        self.train.set_role('Order', self.train.TARGET)
+        self.train.apply('LASD', self.fnc)
+        self.train.apply('RAMN', np.log, to='Log RAMN', vectorized=True)
+        self.train.fillna(method='mean')
+        return pipeline
+
+    def test_replay(self):
+        '''
+        Tests that replaying on new data is the same as repeating the steps
+        by hand, with the values learned on the recorded Dataset
+        '''
+        pipeline = self.record()
+        self.assertEqual(len(pipeline), 5)
+
+        raw = copper.read_csv('ml/1/test.csv')
+        raw.loc[0:9, 'NGIF'] = np.nan
+        test = pipeline.replay(raw)
+
+        sol = copper.Dataset(raw.copy())
+        sol.role['CustomerID'] = sol.ID
+        sol.role['Order'] = sol.TARGET
+        sol['LASD'] = sol['LASD'].apply(self.fnc)
+        self.assertEqual(test['LASD'].values, sol['LASD'].values)
+        self.assertEqual(test['Log RAMN'].values, np.log(raw['RAMN'].values), digits=8)
+        self.assertEqual(test.role['CustomerID'], test.ID)
+        self.assertEqual(test.role['Order'], test.TARGET)
+        self.assertEqual(test.role['Log RAMN'], test.INPUT)
+        self.assertEqual(test.type['Log RAMN'], test.NUMBER)
+        mean = copper.read_csv('ml/1/train.csv')['NGIF'].mean()
+        self.assertEqual(test['NGIF'][0], mean, digits=8)
+        # The new data is not modified
+        self.assertTrue(np.isnan(raw['NGIF'][0]))
+
+        # Same as training
+        train = pipeline.replay(copper.read_csv('ml/1/train.csv'))
+        self.assertEqual(train, self.train)
+
+    def test_change(self):
+        '''
+        Tests that only the steps that depend on a changed step run again
+        '''
+        pipeline = self.record()
+        raw = copper.read_csv('ml/1/test.csv')
+        calls = []
+        def log(series):
+            calls.append(series.name)
+            return np.log(series)
+        pipeline.change('apply Log RAMN', fnc=log)
+        pipeline.replay(raw)
+        self.assertEqual(calls, ['RAMN'])
+
+        # Same data and no changes: everything is cached
+        pipeline.replay(raw)
+        self.assertEqual(calls, ['RAMN'])
+
+        def lasd(series):
+            calls.append(series.name)
+            return series.apply(self.fnc) + 1
+        pipeline.change('apply LASD', fnc=lasd, vectorized=True)
+        ans = pipeline.replay(raw)
+        self.assertEqual(calls, ['RAMN', 'LASD'])
+        self.assertEqual(ans['LASD'].values, raw['LASD'].apply(self.fnc).values + 1)
+        self.assertEqual(ans['Log RAMN'].values, np.log(raw['RAMN'].values), digits=8)
+
+    def test_replay_chunks(self):
+        '''
+        Tests that replaying by chunks is the same as replaying at once
+        '''
+        pipeline = self.record()
+        sol = pipeline.replay(copper.read_csv('ml/1/test.csv'))
+        chunks = list(pipeline.replay_chunks('ml/1/test.csv', chunksize=300))
+        self.assertEqual(len(chunks), int(np.ceil(len(sol) / 300)))
+        self.assertEqual(pd.concat([c.frame for c in chunks]), sol.frame)
+
+        # MachineLearning replays the pipeline of its training Dataset
+        ml = copper.MachineLearning()
+        ml.set_train(self.train)
+        ml.set_test(sol)
+        self.assertEqual(ml._encode(ml._prepare(copper.read_csv('ml/1/test.csv'))),
+                         ml.X_test)
+
+    def test_replay_fillna(self):
+        '''
+        Tests that the group statistics and the neighbors of fillna are
+        learned on the recorded Dataset, not on the replayed chunk
+        '''
+        train = pd.DataFrame({ 'Region': ['N', 'N', 'N', 'S', 'S', 'S'],
+                               'Sales': [1, 3, np.nan, 10, 20, np.nan],
+                               'Product': ['a', 'a', np.nan, 'b', 'b', np.nan],
+                               })
+        ds = copper.Dataset(train)
+        pipeline = ds.record()
+        ds.fillna(method='mean', by='Region')
+        self.assertEqual(ds['Sales'][2], 2, digits=8)
+
+        new = pd.DataFrame({ 'Region': ['N', 'N', 'S', 'E'],
+                             'Sales': [100, np.nan, np.nan, np.nan],
+                             'Product': ['c', np.nan, np.nan, np.nan],
+                             })
+        ans = pipeline.replay(new)
+        self.assertEqual(ans['Sales'].values, np.array([100, 2, 15, 8.5]), digits=8)
+        self.assertEqual(ans['Product'].tolist(), ['c', 'a', 'b', 'a'])
+        chunks = list(pipeline.replay_chunks(new, chunksize=1))
+        self.assertEqual(pd.concat([c.frame for c in chunks]), ans.frame)
+
+        train = pd.DataFrame({ 'x': [1, 2, 3, 10, 11, 12, 2.1],
+                               'y': [1, 2, 3, 10, 11, 12, np.nan],
+                               })
+        ds = copper.Dataset(train)
+        pipeline = ds.record()
+        ds.fillna(method='knn', k=2)
+        self.assertEqual(ds['y'][6], 2.5, digits=8)
+
+        # The chunk has no complete rows of its own
+        new = pd.DataFrame({'x': [10.9, 1.1], 'y': [np.nan, np.nan]})
+        ans = pipeline.replay(new)
+        self.assertEqual(ans['y'].values, np.array([10.5, 1.5]), digits=8)
+        chunks = list(pipeline.replay_chunks(new, chunksize=1))
+        self.assertEqual(pd.concat([c.frame for c in chunks]), ans.frame)
+
+        # The learned values are pickled with the pipeline
+        loaded = pickle.loads(pickle.dumps(pipeline))
+        self.assertEqual(loaded._outputs, {})
+        self.assertEqual(loaded.replay(new).frame, ans.frame)
+
+    def test_names(self):
+        '''
+        Tests that the steps on the same column get different names
+        '''
+        ds = copper.Dataset(pd.DataFrame({'x': [1., 2., 3.]}))
+        pipeline = ds.record()
+        ds.apply('x', np.log, vectorized=True)
+        ds.apply('x', np.exp, vectorized=True)
+        ds.apply('x', np.sqrt, vectorized=True)
+        self.assertEqual([step.name for step in pipeline.steps],
+                         ['apply x', 'apply x 1', 'apply x 2'])
+        self.assertEqual(pipeline.replay(pd.DataFrame({'x': [4.]}))['x'][0], 2, digits=8)
+
+        pipeline.change('apply x 1', fnc=lambda x: x + 1)
+        self.assertEqual(pipeline.replay(pd.DataFrame({'x': [np.e]}))['x'][0], np.sqrt(2), digits=8)
+        self.assertEqual(pipeline.steps[0].fnc, np.log)
+
+    def test_cache(self):
+        '''
+        Tests that the pipeline does not keep the replayed data alive
+        '''
+        import gc
+        import weakref
+        pipeline = self.record()
+        raw = copper.read_csv('ml/1/test.csv')
+        pipeline.replay(raw)
+        ref = weakref.ref(raw)
+        del raw
+        gc.collect()
+        self.assertTrue(ref() is None)
+
+        # Another frame is not taken for the collected one
+        calls = []
+        def log(series):
+            calls.append(series.name)
+            return np.log(series)
+        pipeline.change('apply Log RAMN', fnc=log)
+        raw = copper.read_csv('ml/1/test.csv')
+        pipeline.replay(raw)
+        pipeline.replay(raw)
+        self.assertEqual(calls, ['RAMN'])
+        pipeline.clear_cache()
+        pipeline.replay(raw)
+        self.assertEqual(calls, ['RAMN', 'RAMN'])
+
+
+
+if __name__ == '__main__':
+    suite = Pipeline().suite()
+    unittest.TextTestRunner(verbosity=2).run(suite)
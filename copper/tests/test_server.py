@@ -0,0 +1,116 @@
+import json
+import copper
+import numpy as np
+import pandas as pd
+
+import unittest
+from tornado.testing import AsyncHTTPTestCase, gen_test
+from copper.core import server
+from copper.tests.CopperTest import CopperTest
+
+class Server(AsyncHTTPTestCase, CopperTest):
+
+    def suite(self):
+        suite = unittest.TestSuite()
+        suite.addTest(Server('test_predict'))
+        suite.addTest(Server('test_batch_errors'))
+        suite.addTest(Server('test_score_fails'))
+        suite.addTest(Server('test_stats'))
+        return suite
+
+    def get_app(self):
+        from sklearn.naive_bayes import GaussianNB
+        rng = np.random.RandomState(0)
+        df = pd.DataFrame({'A': rng.randn(200), 'B': rng.randn(200)})
+        df['Target'] = (df['A'] + df['B'] > 0).astype(int)
+        ds = copper.Dataset(df)
+        ds.role['Target'] = ds.TARGET
+
+        self.ml = copper.MachineLearning()
+        self.ml.train = ds
+        self.ml.add_clf(GaussianNB(), 'GNB')
+        self.ml.fit()
+        return server.application(self.ml, max_batch=100,
+                                                max_latency=0.05)
+
+    def post(self, rows, **args):
+        return self.http_client.fetch(self.get_url('/predict'), method='POST',
+                        body=json.dumps(rows), raise_error=False, **args)
+
+    @gen_test
+    def test_predict(self):
+        '''
+        Tests that the service gives the same predictions as the
+        MachineLearning
+        '''
+        rows = [{'A': 1.0, 'B': 2.0}, {'A': -1.0, 'B': -3.0}]
+        response = yield self.post(rows)
+        self.assertEqual(response.code, 200)
+        ans = json.loads(response.body.decode('utf-8'))
+        expected = self.ml.predict(copper.Dataset(pd.DataFrame(rows)))
+        self.assertEqual(ans['predictions']['GNB'], expected['GNB'].tolist())
+        self.assertEqual(len(ans['probabilities']['GNB [1]']), 2)
+
+        # Unknown classifier
+        response = yield self.http_client.fetch(self.get_url('/predict?clfs=SVM'),
+                        method='POST', body=json.dumps(rows), raise_error=False)
+        self.assertEqual(response.code, 400)
+
+    @gen_test
+    def test_batch_errors(self):
+        '''
+        Tests that the requests are batched together and a bad request does
+        not fail the other requests of its batch
+        '''
+        good = [{'A': 1.0, 'B': 2.0}]
+        bad = [{'A': 'abc', 'B': 2.0}]
+        responses = yield [self.post(good), self.post(bad), self.post(good)]
+        self.assertEqual([r.code for r in responses], [200, 400, 200])
+
+        stats = yield self.http_client.fetch(self.get_url('/stats'))
+        stats = json.loads(stats.body.decode('utf-8'))
+        self.assertEqual(stats['batches'], 1)
+        self.assertEqual(stats['requests'], 2)
+        self.assertEqual(stats['errors'], 1)
+
+    @gen_test
+    def test_score_fails(self):
+        '''
+        Tests that the requests of a batch get an error if scoring the batch
+        fails unexpectedly, instead of waiting forever
+        '''
+        def score(batcher, clfs, frames):
+            raise RuntimeError('Unexpected')
+        original = server.Batcher.score
+        server.Batcher.score = score
+        try:
+            rows = [{'A': 1.0, 'B': 2.0}]
+            responses = yield [self.post(rows), self.post(rows)]
+        finally:
+            server.Batcher.score = original
+        self.assertEqual([r.code for r in responses], [400, 400])
+        self.assertIn('Unexpected', responses[0].body.decode('utf-8'))
+
+        stats = yield self.http_client.fetch(self.get_url('/stats'))
+        self.assertEqual(json.loads(stats.body.decode('utf-8'))['errors'], 2)
+
+    @gen_test
+    def test_stats(self):
+        '''
+        Tests the counters of the service
+        '''
+        rows = [{'A': 1.0, 'B': 2.0}] * 150
+        responses = yield [self.post(rows), self.post(rows[:10])]
+        self.assertEqual([r.code for r in responses], [200, 200])
+
+        response = yield self.http_client.fetch(self.get_url('/stats'))
+        stats = json.loads(response.body.decode('utf-8'))
+        self.assertEqual(stats['requests'], 2)
+        self.assertEqual(stats['rows'], 160)
+        self.assertEqual(stats['batches'], 2)
+        self.assertEqual(stats['errors'], 0)
+
+
+if __name__ == '__main__':
+    suite = Server().suite()
+    unittest.TextTestRunner(verbosity=2).run(suite)
@@ -1,5 +1,6 @@
 import os
 import copper
+import numpy as np
 import pandas as pd
 
 import unittest
@@ -10,6 +11,9 @@ class Transforms_ML(CopperTest):
     def suite(self):
         suite = unittest.TestSuite()
         suite.addTest(Transforms_ML('test_1'))
+        suite.addTest(Transforms_ML('test_dtypes'))
+        suite.addTest(Transforms_ML('test_hashing'))
+        suite.addTest(Transforms_ML('test_encoding'))
         return suite
 
     def test_1(self):
@@ -42,6 +46,121 @@ class Transforms_ML(CopperTest):
         ds.role['Target.Cat'] = ds.TARGET
         self.assertEqual(copper.transform.target2ml(ds), sol)
 
+    def test_dtypes(self):
+        '''
+        Tests that every numerical width, bool and categorical columns are
+        typed and converted
+        '''
+        cat = ['b', 'a', 'c', 'a', 'b', 'a']
+        df = pd.DataFrame({ 'int32': np.arange(6, dtype=np.int32),
+                            'float32': np.arange(6, dtype=np.float32) / 2,
+                            'uint8': np.arange(6, dtype=np.uint8),
+                            'bool': np.arange(6) % 2 == 0,
+                            'object': cat,
+                            'category': pd.Series(cat).astype('category'),
+                            })
+        ds = copper.Dataset(df)
+        for col in ['int32', 'float32', 'uint8', 'bool']:
+            self.assertEqual(ds.type[col], ds.NUMBER)
+        self.assertEqual(ds.type['object'], ds.CATEGORY)
+        self.assertEqual(ds.type['category'], ds.CATEGORY)
+        self.assertEqual(len(ds.corr(cols='all')), 4)
+
+        ml = copper.transform.inputs2ml(ds)
+        self.assertEqual(ml['float32'].values, df['float32'].values)
+        self.assertEqual(ml['bool'].values, df['bool'].values.astype(np.uint8))
+        self.assertEqual(ml[['category [a]', 'category [b]', 'category [c]']].values,
+                         ml[['object [a]', 'object [b]', 'object [c]']].values)
+        self.assertEqual(ml['category [a]'].tolist(), [0, 1, 0, 1, 0, 1])
+
+        # Numerical matrix for scikit-learn, also with compacted columns
+        ds.compact()
+        ds.role['uint8'] = ds.TARGET
+        ml = copper.MachineLearning()
+        ml.train = ds
+        self.assertEqual(ml.X_train.dtype.kind, 'f')
+        self.assertEqual(copper.transform.inputs2ml(ds).values.dtype.kind, 'f')
+
+        # Fixed categories: unknown values are all zeros
+        ans = copper.transform.category2ml(df['object'], categories=['a', 'z'])
+        self.assertEqual(ans.columns.tolist(), ['object [a]', 'object [z]'])
+        self.assertEqual(ans['object [a]'].tolist(), [0, 1, 0, 1, 0, 1])
+        self.assertEqual(ans['object [z]'].sum(), 0)
+
+    def test_hashing(self):
+        '''
+        Tests the hashing trick: fixed columns, same bucket for the same
+        value on different data and categoricals
+        '''
+        values = ['u%d' % i for i in range(1000)] + [np.nan]
+        series = pd.Series(values, name='User')
+        ans = copper.transform.category2hash(series, buckets=16)
+        self.assertEqual(ans.shape, (1001, 16))
+        self.assertEqual(ans.columns[0], 'User [#0]')
+        self.assertEqual(np.abs(ans.values).sum(axis=1).tolist(), [1] * 1000 + [0])
+        self.assertTrue((ans.values == -1).any())
+
+        part = copper.transform.category2hash(series[500:510], buckets=16)
+        self.assertEqual(part.values, ans.values[500:510])
+        cat = copper.transform.category2hash(series.astype('category'), buckets=16)
+        self.assertEqual(cat.values, ans.values)
+
+        # Integers with missing values are read as floats: same buckets
+        ints = copper.transform.category2hash(pd.Series([1, 2, 30], name='N'), buckets=16)
+        floats = copper.transform.category2hash(pd.Series([1, 2, 30, np.nan], name='N'), buckets=16)
+        mixed = copper.transform.category2hash(pd.Series([1, 2.0, '30'], name='N'), buckets=16)
+        self.assertEqual(floats.values[:3], ints.values)
+        self.assertEqual(floats.values[3].tolist(), [0] * 16)
+        self.assertEqual(mixed.values, ints.values)
+        half = copper.transform.category2hash(pd.Series([1.5, 1.5]), buckets=16)
+        self.assertEqual(half.values[0], half.values[1])
+
+        df = pd.DataFrame({'User': values[:-1], 'Number': np.arange(1000)})
+        ds = copper.Dataset(df)
+        ds.set_hashing('User', buckets=8)
+        ml = copper.transform.inputs2ml(ds)
+        self.assertEqual(len(ml.columns), 9)
+        ds.set_hashing('User', buckets=None)
+        self.assertEqual(len(copper.transform.inputs2ml(ds).columns), 1001)
+
+    def test_encoding(self):
+        '''
+        Tests frequency and out of fold target encoding
+        '''
+        rng = np.random.RandomState(0)
+        cat = pd.Series(rng.choice(['a', 'b', 'c'], 1000), name='Cat')
+        target = (cat == 'a') * 0.6 + rng.rand(1000) * 0.2
+
+        ans = copper.transform.category2frequency(cat)
+        self.assertEqual(ans.columns.tolist(), ['Cat [frequency]'])
+        self.assertEqual(ans['Cat [frequency]'][cat == 'b'].iloc[0], (cat == 'b').mean(), digits=10)
+
+        # Out of fold: same as target_encoding learned without the fold
+        ans = copper.transform.category2target(cat, target, folds=4, seed=1)
+        fold = np.random.RandomState(1).permutation(1000) % 4
+        means, prior = copper.transform.target_encoding(cat[fold != 2], target[fold != 2])
+        self.assertEqual(ans['Cat [target]'][fold == 2].values,
+                         means[cat[fold == 2]].values, digits=10)
+        self.assertTrue(ans['Cat [target]'][cat == 'a'].min() > 0.6)
+
+        # No leak: unique categories get the prior, not their target
+        ids = pd.Series(np.arange(1000), name='ID')
+        ans = copper.transform.category2target(ids, target)['ID [target]']
+        self.assertEqual(ans.std() < 0.05, True)
+        means, prior = copper.transform.target_encoding(ids, target, smoothing=0)
+        self.assertEqual(means.values, target.values, digits=10)
+
+        # New data uses the values learned on training
+        df = pd.DataFrame({'Cat': cat, 'Target': target})
+        ds = copper.Dataset(df)
+        ds.role['Target'] = ds.TARGET
+        ds.set_encoding('Cat', method='frequency')
+        self.assertEqual(copper.transform.inputs2ml(ds).columns.tolist(), ['Cat [frequency]'])
+        learned = copper.transform.learn_encodings(ds)
+        new = pd.Series(['c', 'z'], name='Cat')
+        ans = copper.transform.category2encoding(new, learned['Cat'])
+        self.assertEqual(ans['Cat [frequency]'].tolist(), [(cat == 'c').mean(), 0])
+
 
 if __name__ == '__main__':
     suite = Transforms_ML().suite()
@@ -12,6 +12,7 @@ class UtilsFrame(CopperTest):
         suite = unittest.TestSuite()
         suite.addTest(UtilsFrame('test_percent_missing'))
         suite.addTest(UtilsFrame('test_unique_values'))
+        suite.addTest(UtilsFrame('test_parallel_stats'))
         return suite
 
     def test_percent_missing(self):
@@ -50,6 +51,50 @@ class UtilsFrame(CopperTest):
         
 
 
+    def test_parallel_stats(self):
+        '''
+        Tests that the statistics by blocks of columns on processes are the
+        same as on one process
+        '''
+        rng = np.random.RandomState(0)
+        frame = pd.DataFrame(rng.randint(10, size=(200, 60)).astype(float))
+        frame.columns = ['Col.%d' % i for i in range(60)]
+        frame[frame > 7] = np.nan
+        frame['Col.3'] = 'a'
+        frame.loc[0:50, 'Col.3'] = np.nan
+
+        for fnc in (copper.utils.frame.percent_missing,
+                    copper.utils.frame.unique_values):
+            serial = fnc(frame, n_jobs=1)
+            parallel = fnc(frame, n_jobs=3)
+            self.assertEqual(parallel.index.tolist(), serial.index.tolist())
+            self.assertEqual(parallel.values, serial.values)
+
+        # Automatic switch on wide frames
+        min_columns = copper.utils.parallel.MIN_COLUMNS
+        copper.utils.parallel.MIN_COLUMNS = 50
+        try:
+            ds = copper.Dataset(frame)
+            self.assertEqual(ds.percent_missing(), ds.percent_missing(n_jobs=1))
+        finally:
+            copper.utils.parallel.MIN_COLUMNS = min_columns
+
+        # Concurrent callers get the statistics of their own frame
+        frames = [frame, frame.iloc[:100, 10:]]
+        percent_missing = lambda f: copper.utils.frame.percent_missing(f, n_jobs=3)
+        ans = copper.utils.parallel.pmap(percent_missing, frames, n_jobs=2)
+        for parallel, f in zip(ans, frames):
+            self.assertEqual(parallel, copper.utils.frame.percent_missing(f, n_jobs=1))
+        self.assertIs(copper.utils.parallel._frame, None)
+        # Not forked with other threads running, but still on processes
+        method = lambda i: copper.utils.parallel._context().get_start_method()
+        self.assertNotIn('fork', copper.utils.parallel.pmap(method, range(2), n_jobs=2))
+        unique_values = lambda f: copper.utils.frame.unique_values(f, n_jobs=3)
+        ans = copper.utils.parallel.pmap(unique_values, frames, n_jobs=2)
+        for parallel, f in zip(ans, frames):
+            self.assertEqual(parallel, copper.utils.frame.unique_values(f, n_jobs=1))
+
+
 if __name__ == '__main__':
     suite = UtilsFrame().suite()
     unittest.TextTestRunner(verbosity=2).run(suite)
@@ -13,6 +13,7 @@ class UtilsML(CopperTest):
     def suite(self):
         suite = unittest.TestSuite()
         suite.addTest(UtilsML('test_bootstrap'))
+        suite.addTest(UtilsML('test_stacking'))
         return suite
 
     def setup(self):
@@ -50,6 +51,49 @@ class UtilsML(CopperTest):
         self.ml.add_clfs(bootstraped, 'GNB')
         self.assertEqual(len(self.ml.clfs), 10)
 
+    def test_stacking(self):
+        '''
+        Tests the stacking of classifiers and that changing the meta
+        classifier does not fit the base classifiers again
+        '''
+        self.setup()
+        from sklearn import tree
+        from sklearn.naive_bayes import GaussianNB
+        from sklearn.linear_model import LogisticRegression
+
+        ml = copper.MachineLearning()
+        ml.train = self.train
+        ml.test = self.test
+        ml.add_clf(tree.DecisionTreeClassifier(max_depth=6, random_state=0), 'DT')
+        ml.add_clf(GaussianNB(), 'GNB')
+
+        stack = copper.utils.ml.Stacking(ml.clfs, k=4, n_jobs=2)
+        ml.add_clf(stack, 'Stacking')
+        ml.fit()
+        features = stack.base_features(ml.X_train, ml.y_train)
+        self.assertEqual(features.shape, (len(ml.X_train), 2))
+        self.assertEqual(stack.transform(ml.X_test).shape, (len(ml.X_test), 2))
+        accuracy = ml.accuracy()
+        self.assertTrue(accuracy['Stacking'] > 0.6)
+
+        # Out of fold: the fold of a row does not use the row
+        folds = copper.utils.ml.kfold(ml.y_train, k=4)
+        train_index, test_index = folds[0]
+        gnb = GaussianNB().fit(ml.X_train[train_index], ml.y_train[train_index])
+        self.assertEqual(features[test_index, 1],
+                         gnb.predict_proba(ml.X_train[test_index])[:, 1], digits=6)
+
+        # Same features with one worker
+        serial = copper.utils.ml.Stacking(ml.clfs[['DT', 'GNB']], k=4)
+        self.assertEqual(serial.base_features(ml.X_train, ml.y_train), features, digits=6)
+
+        fitted = stack._fitted
+        stack.set_meta(tree.DecisionTreeClassifier(max_depth=2))
+        ml.fit()
+        self.assertTrue(stack._fitted is fitted)
+        self.assertTrue(stack.base_features(ml.X_train, ml.y_train) is features)
+        self.assertEqual(len(stack.predict(ml.X_test)), len(ml.X_test))
+
 
 if __name__ == '__main__':
     suite = UtilsML().suite()
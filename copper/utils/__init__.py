@@ -0,0 +1,31 @@
+import sys
+import types
+import importlib
+
+_submodules = ['frame', 'instrument', 'ml', 'parallel', 'transforms']
+
+def _load(name):
+    if name not in _submodules:
+        raise AttributeError("module 'copper.utils' has no attribute '%s'" % name)
+    return importlib.import_module('copper.utils.' + name)
+
+def _dir():
+    return sorted(list(globals().keys()) + _submodules)
+
+# Module attributes on python >= 3.7 (PEP 562)
+__getattr__ = _load
+__dir__ = _dir
+
+class _LazyModule(types.ModuleType):
+    '''
+    Module with the lazy submodules for python < 3.7, see copper._LazyModule
+    '''
+
+    def __getattr__(self, name):
+        return _load(name)
+
+    def __dir__(self):
+        return _dir()
+
+if sys.version_info < (3, 7):
+    sys.modules[__name__].__class__ = _LazyModule
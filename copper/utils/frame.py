@@ -1,5 +1,7 @@
 # coding=utf-8
 from __future__ import division
+import warnings
+import copper
 import numpy as np
 import pandas as pd
 
@@ -7,21 +9,30 @@ import pandas as pd
 Util for a pandas Dataframe
 '''
 
-def percent_missing(frame, ascending=False):
+def _percent_missing(frame):
+    return 1 - (frame.count() / len(frame))
+
+def _unique_values(frame):
+    return frame.apply(lambda series: len(series.dropna().unique()))
+
+def percent_missing(frame, ascending=False, n_jobs=None):
     '''
     Generetas a Series with the percent of missing values of each column
 
     Parameters
     ----------
         ascending: boolean, sort the returned Series on this direction
+        n_jobs: int, number of processes, default is parallel only for wide
+                     frames, see copper.utils.parallel.map_columns
 
     Returns
     -------
         pandas.Series
     '''
-    return (1 - (frame.count() / len(frame))).order(ascending=ascending)
+    ans = copper.utils.parallel.map_columns(_percent_missing, frame, n_jobs=n_jobs)
+    return ans.order(ascending=ascending)
 
-def unique_values(frame, ascending=False):
+def unique_values(frame, ascending=False, n_jobs=None):
     '''
     Generetas a Series with the number of unique values of each column.
     Note: Excludes NA
@@ -29,12 +40,429 @@ def unique_values(frame, ascending=False):
     Parameters
     ----------
         ascending: boolean, sort the returned Series on this direction
+        n_jobs: int, number of processes, default is parallel only for wide
+                     frames, see copper.utils.parallel.map_columns
+
+    Returns
+    -------
+        pandas.Series
+    '''
+    ans = copper.utils.parallel.map_columns(_unique_values, frame, n_jobs=n_jobs)
+    return ans.order(ascending=ascending)
+
+def _is_number(series):
+    return series.dtype.kind in 'biuf'
+
+def _knn_neighbors(Q, R, R2, k, block):
+    '''
+    Finds the k nearest neighbors of the rows of Q (with NaN for missing
+    values) on the complete rows R. Only the observed coordinates of each
+    query row are used on the distance.
+    The reference rows are processed by blocks so the memory used is
+    len(Q) * block floats regardless of the size of R.
+    '''
+    M = ~np.isnan(Q)
+    Q0 = np.where(M, Q, 0)
+    Mf = M.astype(float)
+    q2 = np.square(Q0).sum(axis=1)[:, np.newaxis]
+
+    best_d = np.empty((len(Q), 0))
+    best_i = np.empty((len(Q), 0), dtype=int)
+    for start in range(0, len(R), block):
+        Rb = R[start:start + block]
+        d = q2 - 2 * np.dot(Q0, Rb.T) + np.dot(Mf, R2[start:start + block].T)
+        d = np.hstack((best_d, d))
+        i = np.hstack((best_i, np.arange(start, start + len(Rb))[np.newaxis, :].repeat(len(Q), axis=0)))
+        if d.shape[1] > k:
+            keep = np.argpartition(d, k - 1, axis=1)[:, :k]
+            rows = np.arange(len(Q))[:, np.newaxis]
+            d, i = d[rows, keep], i[rows, keep]
+        best_d, best_i = d, i
+
+    # Nearest first, used to break ties on the categorical mode
+    order = np.argsort(best_d, axis=1)
+    rows = np.arange(len(Q))[:, np.newaxis]
+    return best_i[rows, order], M.any(axis=1)
+
+def knn_reference(frame, cols, features):
+    '''
+    Rows with all the features, the neighbors used by knn_impute. The
+    imputed columns can be missing: each column uses the rows where it is
+    known. Saved by the recorded pipelines so new data is imputed with the
+    neighbors of the training data.
+
+    Returns
+    -------
+        pandas.DataFrame
+    '''
+    needed = list(features) + [c for c in cols if c not in features]
+    complete = frame[list(features)].notnull().all(axis=1).values
+    return frame[needed][complete]
+
+def knn_impute(frame, cols=None, features=None, k=5, chunksize=1000,
+               block=50000, n_jobs=1, reference=None):
+    '''
+    Imputes missing values using the k nearest neighbors on the complete rows.
+    Numerical columns are filled with the mean of the neighbors and
+    categorical columns with the most repeated value of the neighbors.
+
+    The neighbors of a column are the rows with all the features and that
+    column. The columns known on the same rows share one neighbor index (the
+    standardized rows) and are imputed on a single pass over the incomplete
+    rows. The incomplete rows are processed by chunks (in parallel if
+    n_jobs != 1) so the memory used is bounded by chunksize * block, the
+    block is divided among the workers so the bound is the same with any
+    n_jobs. Columns without neighbors are not imputed and a warning is
+    raised.
+
+    Parameters
+    ----------
+        cols: list, columns to impute, default all the columns with missing values
+        features: list, numerical columns to use on the distance,
+                        default all the numerical columns
+        k: int, number of neighbors
+        chunksize: int, number of incomplete rows processed at once
+        block: int, number of complete rows compared at once by all the
+                    workers
+        n_jobs: int, number of workers
+        reference: pandas.DataFrame, rows to take the neighbors from, see
+                   knn_reference. Default the rows of frame with all the
+                   features
+
+    Returns
+    -------
+        pandas.DataFrame with the imputed columns
+    '''
+    if cols is None:
+        cols = frame.columns[frame.isnull().any().values].tolist()
+    if features is None:
+        features = [c for c in frame.columns if _is_number(frame[c])]
+    cols = list(cols)
+    features = [c for c in features if _is_number(frame[c])]
+    ans = frame[cols].copy()
+    if reference is None:
+        reference = knn_reference(frame, cols, features)
+    if len(features) == 0 or not frame[cols].isnull().values.any():
+        return ans
+
+    # Columns known on the same reference rows share the neighbors
+    indexes = {}
+    for col in cols:
+        known = reference[col].notnull().values
+        if not frame[col].isnull().any():
+            continue
+        if not known.any():
+            warnings.warn('knn_impute: no rows with all the features and %s, '
+                          'it is not imputed' % col)
+            continue
+        indexes.setdefault(known.tobytes(), (known, []))[1].append(col)
+
+    X = frame[features].values.astype(float)
+    workers = copper.utils.parallel.n_workers(n_jobs)
+    for known, group in indexes.values():
+        _knn_impute_group(ans, X, reference[known], features, group,
+                          k, chunksize, max(k, block // workers), n_jobs)
+    return ans
+
+def _knn_impute_group(ans, X, reference, features, cols, k, chunksize, block,
+                      n_jobs):
+    '''
+    Imputes inplace the columns of ans with the neighbors on the reference
+    rows, that have all the features and the columns
+    '''
+    missing = np.where(ans[cols].isnull().any(axis=1).values)[0]
+    k = min(k, len(reference))
+    block = max(k, block)
+
+    # Neighbor index: standardized reference rows
+    R = reference[features].values.astype(float)
+    mean = R.mean(axis=0)
+    std = R.std(axis=0)
+    std[std == 0] = 1
+    R = (R - mean) / std
+    R2 = np.square(R)
+
+    # Values of the reference rows: numbers as floats, categories as codes
+    refs = {}
+    for col in cols:
+        if _is_number(reference[col]):
+            refs[col] = (reference[col].values.astype(float), None)
+        else:
+            codes, levels = pd.factorize(reference[col].values)
+            refs[col] = (codes, levels)
+
+    def impute_chunk(rows):
+        Q = (X[rows] - mean) / std
+        neighbors, informed = _knn_neighbors(Q, R, R2, k, block)
+        filled = {}
+        for col in cols:
+            values, levels = refs[col]
+            near = values[neighbors]
+            if levels is None:
+                fill = near.mean(axis=1)
+                fill[~informed] = values.mean()
+            else:
+                counts = (near[:, :, np.newaxis] == near[:, np.newaxis, :]).sum(axis=2)
+                fill = near[np.arange(len(near)), counts.argmax(axis=1)]
+                fill[~informed] = np.bincount(values).argmax()
+                fill = levels.take(fill)
+            filled[col] = fill
+        return rows, filled
+
+    out = {}
+    for col in cols:
+        out[col] = ans[col].values.copy() if refs[col][1] is None \
+                                        else ans[col].values.astype(object)
+    chunks = [missing[i:i + chunksize] for i in range(0, len(missing), chunksize)]
+    for rows, filled in copper.utils.parallel.pmap(impute_chunk, chunks, n_jobs=n_jobs):
+        for col in cols:
+            nulls = pd.isnull(out[col][rows])
+            out[col][rows[nulls]] = filled[col][nulls]
+
+    for col in cols:
+        ans[col] = out[col]
+
+def _group_ids(frame, by):
+    '''
+    Integer id of the group of each row, -1 if any of the keys is missing.
+
+    Returns
+    -------
+        (numpy.array, number of groups)
+    '''
+    ids = np.zeros(len(frame), dtype=np.int64)
+    n_groups = 1
+    for key in by:
+        codes, levels = pd.factorize(frame[key].values)
+        missing = (ids < 0) | (codes < 0)
+        ids, uniques = pd.factorize(ids * len(levels) + codes)
+        ids[missing] = -1
+        n_groups = len(uniques)
+    return ids, n_groups
+
+def _group_index(frame, by):
+    '''
+    Index of the keys of each row, used to look up the group statistics
+    '''
+    keys = [frame[key].values for key in by]
+    return pd.Index(keys[0]) if len(by) == 1 else pd.MultiIndex.from_arrays(keys)
+
+def group_stats(frame, by, cols, method='mean'):
+    '''
+    Statistic of each group used by group_fill. Numerical columns use the
+    mean or median and categorical columns the most repeated value.
+
+    The statistics of all the numerical columns are computed on one grouped
+    aggregation, so it is fast with lots of groups.
+
+    Parameters
+    ----------
+        by: str or list, columns that define the groups
+        cols: list, columns
+        method: str, 'mean', 'median' or 'mode'. For numerical columns 'mode'
+                     is the same as 'mean'
+
+    Returns
+    -------
+        dict of column: (pandas.Series with the statistic of each group
+        indexed by the keys, statistic of the whole column). Categorical
+        columns without values are not included.
+    '''
+    if type(by) is str:
+        by = [by]
+    ids, n_groups = _group_ids(frame, by)
+    valid = ids >= 0
+    groups, first = np.unique(ids[valid], return_index=True)
+    index = _group_index(frame[valid].iloc[first], by)
+    ans = {}
+
+    numbers = [c for c in cols if _is_number(frame[c])]
+    categories = [c for c in cols if not _is_number(frame[c])]
+
+    if len(numbers) > 0:
+        values = frame[numbers]
+        stat = 'median' if method == 'median' else 'mean'
+        overall = getattr(values, stat)()
+        grouped = getattr(values[valid].groupby(ids[valid]), stat)()
+        table = grouped.reindex(groups)
+        table.index = index
+        for col in numbers:
+            ans[col] = (table[col].dropna(), overall[col])
+
+    for col in categories:
+        codes, levels = pd.factorize(frame[col].values)
+        if len(levels) == 0:
+            continue # Nothing known to fill with
+        present = valid & (codes >= 0)
+        overall = np.bincount(codes[codes >= 0]).argmax()
+
+        # Count (group, level) pairs, the first pair of each group is the mode
+        pairs = pd.Series(ids[present] * len(levels) + codes[present]).value_counts()
+        pair_groups = pairs.index.values // len(levels)
+        first = ~pd.Series(pair_groups).duplicated().values
+        modes = np.empty(n_groups, dtype=np.int64)
+        modes.fill(-1)
+        modes[pair_groups[first]] = pairs.index.values[first] % len(levels)
+
+        modes = modes.take(groups)
+        known = modes >= 0
+        table = pd.Series(levels.take(modes[known]), index=index[known])
+        ans[col] = (table, levels[overall])
+    return ans
+
+def group_apply(frame, by, stats):
+    '''
+    Fills the missing values with the group statistics of group_stats.
+    Groups without a statistic (and rows with a missing key) use the
+    statistic of the whole column.
+
+    Parameters
+    ----------
+        by: str or list, columns that define the groups
+        stats: dict, see group_stats
+
+    Returns
+    -------
+        pandas.DataFrame with the filled columns
+    '''
+    if type(by) is str:
+        by = [by]
+    cols = [col for col in stats if col in frame.columns]
+    ans = frame[cols].copy()
+    index = _group_index(frame, by)
+    for col in cols:
+        nulls = frame[col].isnull().values
+        if not nulls.any():
+            continue
+        table, overall = stats[col]
+        if len(table) > 0:
+            pos = table.index.get_indexer(index[nulls])
+            fill = table.values.take(np.maximum(pos, 0)).astype(object)
+            fill[pos < 0] = overall
+        else:
+            fill = np.empty(nulls.sum(), dtype=object)
+            fill.fill(overall)
+        if _is_number(frame[col]):
+            filled = frame[col].values.astype(float)
+        else:
+            filled = frame[col].values.astype(object)
+        filled[nulls] = fill
+        ans[col] = filled
+    return ans
+
+def group_fill(frame, by, cols, method='mean'):
+    '''
+    Fills the missing values of each group with a statistic of the group,
+    see group_stats and group_apply.
+
+    Parameters
+    ----------
+        by: str or list, columns that define the groups
+        cols: list, columns to fill
+        method: str, 'mean', 'median' or 'mode'. For numerical columns 'mode'
+                     is the same as 'mean'
+
+    Returns
+    -------
+        pandas.DataFrame with the filled columns
+    '''
+    ans = frame[cols].copy()
+    filled = group_apply(frame, by, group_stats(frame, by, cols, method=method))
+    for col in filled.columns:
+        ans[col] = filled[col]
+    return ans
+
+# -----------------------------------------------------------------------------
+#                                COMPACT
+# -----------------------------------------------------------------------------
+
+def _nbytes(series):
+    '''
+    Memory used by a Series, including the python strings of object columns
+    '''
+    return series.memory_usage(index=False, deep=True)
+
+def _smallest_int(values, unsigned=False):
+    '''
+    Smallest integer dtype that holds all the values, unsigned only if asked
+    '''
+    low, high = values.min(), values.max()
+    if unsigned and low >= 0:
+        dtypes = (np.uint8, np.uint16, np.uint32)
+    else:
+        dtypes = (np.int8, np.int16, np.int32)
+    for dtype in dtypes:
+        info = np.iinfo(dtype)
+        if info.min <= low and high <= info.max:
+            return dtype
+    return values.dtype
+
+def compact_series(series, max_unique=0.5, lossy=False, unsigned=False):
+    '''
+    Downcasts a Series to the smallest dtype that holds its values:
+        * integers to the smallest signed integer (or unsigned if asked)
+        * floats to float32 if no value changes (or always if lossy)
+        * objects to categorical if they have few unique values
+
+    Parameters
+    ----------
+        max_unique: float, maximum ratio of unique values to rows to convert
+                           an object column to categorical
+        lossy: boolean, True to always convert float64 to float32
+        unsigned: boolean, True to use unsigned integers for non-negative
+                           columns. Subtracting or negating them wraps around
+                           (e.g. target - 1)
 
     Returns
     -------
         pandas.Series
     '''
-    ans = pd.Series(index=frame.columns)
-    for col in frame.columns:
-        ans[col] = len(frame[col].value_counts())
-    return ans.order(ascending=ascending)
\ No newline at end of file
+    kind = series.dtype.kind
+    if len(series) == 0:
+        return series
+    if kind in 'iu':
+        dtype = np.dtype(_smallest_int(series.values, unsigned=unsigned))
+        if dtype.itemsize < series.dtype.itemsize:
+            return series.astype(dtype)
+    elif kind == 'f' and series.dtype.itemsize > 4:
+        values = series.values
+        small = values.astype(np.float32)
+        if lossy or np.allclose(small, values, rtol=0, atol=0, equal_nan=True):
+            return pd.Series(small, index=series.index, name=series.name)
+    elif kind == 'O':
+        uniques = series.nunique()
+        if uniques <= max_unique * len(series):
+            return series.astype('category')
+    return series
+
+def compact_frame(frame, cols=None, max_unique=0.5, lossy=False, unsigned=False):
+    '''
+    Downcasts the columns of a DataFrame, see compact_series. The frame is
+    modified inplace.
+
+    Parameters
+    ----------
+        cols: list, columns to compact, default all
+        max_unique: float, see compact_series
+        lossy: boolean, see compact_series
+        unsigned: boolean, see compact_series
+
+    Returns
+    -------
+        pandas.DataFrame with the dtype and the bytes before and after of
+        each column
+    '''
+    cols = frame.columns if cols is None else cols
+    rows = []
+    for col in cols:
+        before = frame[col]
+        after = compact_series(before, max_unique=max_unique, lossy=lossy,
+                               unsigned=unsigned)
+        if after is not before:
+            frame[col] = after
+        rows.append([before.dtype.name, after.dtype.name,
+                     _nbytes(before), _nbytes(after)])
+    cols_report = ['Dtype before', 'Dtype after', 'Bytes before', 'Bytes after']
+    ans = pd.DataFrame(rows, index=cols, columns=cols_report)
+    ans['Reduction'] = 1 - ans['Bytes after'] / ans['Bytes before'].clip(lower=1)
+    return ans
@@ -0,0 +1,190 @@
+# coding=utf-8
+from __future__ import division
+import time
+import threading
+import functools
+import numpy as np
+import pandas as pd
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+'''
+Opt-in instrumentation of the hot paths of copper: call counts, wall time,
+rows and columns processed and allocated bytes of the decorated functions.
+
+Usage:
+    copper.instrument.enable()
+    ... pipeline ...
+    copper.instrument.stats()
+
+When disabled (the default) the decorated functions only pay for one check
+of a global flag.
+'''
+
+_enabled = False
+_memory = False
+_registry = {}
+_lock = threading.Lock()
+# Stack of the memory peaks of the nested calls of each thread
+_local = threading.local()
+
+def enable(memory=False):
+    '''
+    Starts recording
+
+    Parameters
+    ----------
+        memory: boolean, True to also record the allocated bytes (peak) using
+                         tracemalloc, slows down the instrumented functions.
+                         tracemalloc counts the whole process: calls running
+                         at the same time on other threads add to the peak.
+                         Before python 3.9 (no tracemalloc.reset_peak) a
+                         call below the highest earlier peak records its net
+                         allocation instead of its peak
+    '''
+    global _enabled, _memory
+    if memory and tracemalloc is None:
+        raise ValueError('memory instrumentation needs tracemalloc')
+    if memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    _memory = memory
+    _enabled = True
+
+def disable():
+    '''
+    Stops recording, the registry is kept until reset
+    '''
+    global _enabled, _memory
+    if _memory and tracemalloc.is_tracing():
+        tracemalloc.stop()
+    _enabled = False
+    _memory = False
+
+def is_enabled():
+    return _enabled
+
+def reset():
+    '''
+    Clears the registry
+    '''
+    with _lock:
+        _registry.clear()
+
+def _shape(obj):
+    '''
+    Returns
+    -------
+        (rows, columns) of a Dataset, DataFrame, Series or array; None for
+        anything else
+    '''
+    frame = getattr(obj, 'frame', None)
+    if isinstance(frame, pd.DataFrame):
+        obj = frame
+    if isinstance(obj, (pd.DataFrame, np.ndarray)) and obj.ndim == 2:
+        return obj.shape
+    if isinstance(obj, (pd.Series, np.ndarray)):
+        return len(obj), 1
+    return None
+
+def _record(name, seconds, shape, allocated):
+    with _lock:
+        entry = _registry.setdefault(name, [0, 0.0, 0, 0, 0])
+        entry[0] += 1
+        entry[1] += seconds
+        if shape is not None:
+            entry[2] += shape[0]
+            entry[3] = max(entry[3], shape[1])
+        if allocated is not None:
+            entry[4] = max(entry[4], allocated)
+
+def _stack():
+    if not hasattr(_local, 'peaks'):
+        _local.peaks = []
+    return _local.peaks
+
+def _start_memory():
+    peaks = _stack()
+    current, peak = tracemalloc.get_traced_memory()
+    if not hasattr(tracemalloc, 'reset_peak'):
+        # python < 3.9: the peak can not be reset, keep the peak at the start
+        peaks.append([current, current, peak])
+        return
+    if len(peaks) > 0:
+        # The peak of the enclosing call is reset below, keep it
+        peaks[-1][1] = max(peaks[-1][1], peak)
+    tracemalloc.reset_peak()
+    peaks.append([current, current, None])
+
+def _stop_memory():
+    peaks = _stack()
+    current, peak = tracemalloc.get_traced_memory()
+    start, inner, before = peaks.pop()
+    if before is not None:
+        # The peak is of this call only if it was reached after the start,
+        # if not (an earlier call had a higher peak) the net allocation of
+        # the call is the only known value
+        return max(0, (peak if peak > before else current) - start)
+    peak = max(peak, inner)
+    if len(peaks) > 0:
+        peaks[-1][1] = max(peaks[-1][1], peak)
+    return peak - start
+
+def timed(name, data=None):
+    '''
+    Decorator that records the calls of a function on the registry
+
+    Parameters
+    ----------
+        name: str, name on the registry, e.g. 'Dataset.fillna'
+        data: function, of (args, result) that returns the object used to
+                count the rows and columns processed; default is the result
+                or the first argument with a shape (Dataset, DataFrame, ...)
+    '''
+    def decorator(fnc):
+        @functools.wraps(fnc)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return fnc(*args, **kwargs)
+
+            memory = _memory and tracemalloc.is_tracing()
+            if memory:
+                _start_memory()
+            start = time.time()
+            try:
+                ans = fnc(*args, **kwargs)
+            finally:
+                seconds = time.time() - start
+                allocated = _stop_memory() if memory else None
+
+            if data is not None:
+                shape = _shape(data(args, ans))
+            else:
+                shape = _shape(ans)
+                for arg in args:
+                    if shape is not None:
+                        break
+                    shape = _shape(arg)
+            _record(name, seconds, shape, allocated)
+            return ans
+        return wrapper
+    return decorator
+
+def stats(ascending=False):
+    '''
+    Returns
+    -------
+        pandas.DataFrame with the Calls, Seconds, Seconds per call, Rows,
+        Columns (maximum) and Bytes (peak allocated on a call) of each
+        instrumented function, sorted by Seconds
+    '''
+    with _lock:
+        names = sorted(_registry.keys())
+        values = [_registry[name] for name in names]
+    cols = ['Calls', 'Seconds', 'Rows', 'Columns', 'Bytes']
+    ans = pd.DataFrame(values, index=names, columns=cols)
+    ans.insert(2, 'Seconds per call', ans['Seconds'] / ans['Calls'])
+    ans.index.name = 'Function'
+    return ans.sort_index(by='Seconds', ascending=ascending)
@@ -1,9 +1,12 @@
 # coding=utf-8
 from __future__ import division
+import copy
+import itertools
 import copper
 import numpy as np
 import pandas as pd
 
+from sklearn.base import clone
 from sklearn.metrics import accuracy_score
 from sklearn import cross_validation
 
@@ -63,6 +66,143 @@ class Bagging(Ensemble):
         probas[:,1] = 1 - probas[:,0]
         return probas
 
+class Stacking(Ensemble):
+    '''
+    Ensemble that trains a meta classifier on the out-of-fold predictions
+    (probabilities) of the base classifiers.
+
+    The base classifiers are fitted once per fold and once on all the
+    training data on a pool of workers. The out-of-fold predictions are
+    cached: fitting again on the same data or changing the meta classifier
+    (set_meta) only fits the meta classifier.
+
+        stack = copper.utils.ml.Stacking(ml.clfs, n_jobs=-1)
+        ml.add_clf(stack, 'Stacking')
+        ml.fit()
+        stack.set_meta(RandomForestClassifier())
+    '''
+
+    def __init__(self, clfs=None, meta=None, k=5, stratified=True,
+                 random_state=0, n_jobs=1):
+        '''
+        Parameters
+        ----------
+            clfs: pandas.Series (e.g. ml.clfs) or list, base classifiers
+            meta: classifier, default LogisticRegression
+            k: int, number of folds
+            stratified: boolean, see kfold
+            random_state: int, seed of the folds
+            n_jobs: int, number of workers, -1 to use all the cpus
+        '''
+        if type(clfs) is pd.Series:
+            # Comes from ml.clfs
+            self.clfs = list(clfs.values)
+        elif type(clfs) is list:
+            self.clfs = clfs
+        else:
+            self.clfs = []
+        if meta is None:
+            from sklearn.linear_model import LogisticRegression
+            meta = LogisticRegression()
+        self.meta = meta
+        self.k = k
+        self.stratified = stratified
+        self.random_state = random_state
+        self.n_jobs = n_jobs
+        self._X, self._y = None, None
+        self._features = None
+        self._fitted = None
+        self._meta = None
+
+    def add_clf(self, new):
+        self.clfs.append(new)
+        self._features = None
+
+    def _predict_features(self, clf, X):
+        '''
+        Probabilities of every class but the first (they add up to one), or
+        the prediction for classifiers without predict_proba
+        '''
+        if hasattr(clf, 'predict_proba'):
+            return clf.predict_proba(X)[:, 1:]
+        return clf.predict(X).reshape(-1, 1).astype(float)
+
+    def base_features(self, X_train, y_train):
+        '''
+        Fits the base classifiers on each fold and on all the data
+
+        Returns
+        -------
+            np.array, out-of-fold predictions of the base classifiers on the
+            training data, one or more columns per classifier
+        '''
+        if self._features is not None and X_train is self._X and y_train is self._y:
+            return self._features
+
+        folds = kfold(y_train, k=self.k, stratified=self.stratified,
+                                            random_state=self.random_state)
+        def run(task):
+            i, fold = task
+            clf = clone_clf(self.clfs[i])
+            if fold is None:
+                return clf.fit(X_train, y_train)
+            train_index, test_index = folds[fold]
+            clf.fit(X_train[train_index], y_train[train_index])
+            return self._predict_features(clf, X_train[test_index])
+
+        n = len(self.clfs)
+        tasks = [(i, fold) for i in range(n) for fold in range(self.k)]
+        tasks += [(i, None) for i in range(n)]
+        results = copper.utils.parallel.pmap(run, tasks, n_jobs=self.n_jobs)
+
+        columns = []
+        for i in range(n):
+            parts = results[i * self.k:(i + 1) * self.k]
+            values = np.empty((len(X_train), parts[0].shape[1]))
+            for (train_index, test_index), part in zip(folds, parts):
+                values[test_index] = part
+            columns.append(values)
+        self._features = np.hstack(columns)
+        self._fitted = results[n * self.k:]
+        self._X, self._y = X_train, y_train
+        return self._features
+
+    def fit(self, X_train, y_train):
+        features = self.base_features(X_train, y_train)
+        self._meta = clone_clf(self.meta)
+        self._meta.fit(features, y_train)
+        return self
+
+    def set_meta(self, meta):
+        '''
+        Changes the meta classifier, if the Stacking was fitted the new one
+        is fitted on the cached predictions (the base classifiers are not
+        fitted again)
+        '''
+        self.meta = meta
+        if self._features is not None:
+            self.fit(self._X, self._y)
+
+    def transform(self, X_test):
+        '''
+        Returns
+        -------
+            np.array, predictions of the base classifiers fitted on all the
+            training data, input of the meta classifier
+        '''
+        if self._fitted is None:
+            raise ValueError('Stacking is not fitted')
+        return np.hstack([self._predict_features(clf, X_test) for clf in self._fitted])
+
+    def score(self, X_test, y_test):
+        return accuracy_score(y_test, self.predict(X_test))
+
+    def predict(self, X_test):
+        return self._meta.predict(self.transform(X_test))
+
+    def predict_proba(self, X_test):
+        return self._meta.predict_proba(self.transform(X_test))
+
 def bootstrap(clf_class, n, ds, **args):
     '''
     Use bootstrap cross validation to create classifiers
@@ -94,4 +234,193 @@ def bootstrap(clf_class, n, ds, **args):
         clf.fit(_X_train, _y_train)
         ans.append(clf)
     return ans
-    
\ No newline at end of file
+
+def clone_clf(clf):
+    '''
+    Returns an unfitted copy of a classifier with the same parameters.
+    Objects that do not follow the scikit-learn API (e.g. copper ensembles)
+    are deep copied.
+    '''
+    try:
+        return clone(clf)
+    except:
+        return copy.deepcopy(clf)
+
+def kfold(y, k=5, stratified=True, random_state=0):
+    '''
+    Generates the indexes for k-fold cross validation
+
+    Parameters
+    ----------
+        y: np.array, targets
+        k: int, number of folds
+        stratified: boolean, True to keep the proportion of each target value
+                             on every fold
+        random_state: int, seed of the shuffle
+
+    Returns
+    -------
+        list of (train_index, test_index) tuples of np.arrays
+    '''
+    rng = np.random.RandomState(random_state)
+    folds = np.empty(len(y), dtype=int)
+    if stratified:
+        offset = 0
+        for value in np.unique(y):
+            index = np.where(y == value)[0]
+            rng.shuffle(index)
+            folds[index] = (np.arange(len(index)) + offset) % k
+            offset += len(index)
+    else:
+        folds[rng.permutation(len(y))] = np.arange(len(y)) % k
+    return [(np.where(folds != i)[0], np.where(folds == i)[0]) for i in range(k)]
+
+def param_candidates(params, n_iter=None, random_state=0):
+    '''
+    Generates the combinations of parameters for a search
+
+    Parameters
+    ----------
+        params: dict, parameter name -> list of values or a distribution with
+                      a rvs method (e.g. scipy.stats.uniform(0, 1))
+        n_iter: int, number of random combinations, default all the grid.
+                     Required if there is any distribution.
+        random_state: int, seed for the sampling
+
+    Returns
+    -------
+        list of dicts
+    '''
+    names = sorted(params.keys())
+    if n_iter is None:
+        grid = itertools.product(*[params[name] for name in names])
+        return [dict(zip(names, values)) for values in grid]
+
+    rng = np.random.RandomState(random_state)
+    ans = []
+    for i in range(n_iter):
+        candidate = {}
+        for name in names:
+            values = params[name]
+            if hasattr(values, 'rvs'):
+                candidate[name] = values.rvs(random_state=rng)
+            else:
+                candidate[name] = values[rng.randint(len(values))]
+        ans.append(candidate)
+    return ans
+
+class BinnedROC(object):
+    '''
+    Approximate ROC curve and Area Under the Curve calculated from fixed
+    histograms of the scores (probabilities in [0, 1]) of each class.
+    Histograms can be updated chunk by chunk and merged, so very big test sets
+    can be processed in parallel with bounded memory and the curve has at
+    most bins + 1 points.
+
+    The error of the AUC is bounded by error(): only the pairs of positive
+    and negative rows that fall in the same bin are not ordered.
+    '''
+
+    def __init__(self, bins=1000):
+        self.bins = bins
+        self.positives = np.zeros(bins, dtype=np.int64)
+        self.negatives = np.zeros(bins, dtype=np.int64)
+
+    def update(self, y_true, scores, value=1):
+        '''
+        Adds the scores of a chunk
+
+        Parameters
+        ----------
+            y_true: np.array, targets
+            scores: np.array, probabilities of value
+            value: target value considered positive
+
+        Returns
+        -------
+            self
+        '''
+        index = np.clip((np.asarray(scores) * self.bins).astype(int), 0, self.bins - 1)
+        positive = np.asarray(y_true) == value
+        self.positives += np.bincount(index[positive], minlength=self.bins)
+        self.negatives += np.bincount(index[~positive], minlength=self.bins)
+        return self
+
+    def merge(self, other):
+        '''
+        Adds the histograms of other BinnedROC with the same number of bins
+
+        Returns
+        -------
+            self
+        '''
+        if other.bins != self.bins:
+            raise ValueError('Cannot merge histograms with different bins')
+        self.positives += other.positives
+        self.negatives += other.negatives
+        return self
+
+    def _check(self):
+        if self.positives.sum() == 0 or self.negatives.sum() == 0:
+            raise ValueError('The ROC curve needs positive and negative rows, '
+                             'there are %d positive and %d negative' %
+                             (self.positives.sum(), self.negatives.sum()))
+
+    def curve(self):
+        '''
+        Raises a ValueError if there are only rows of one class, e.g. one
+        shard: merge the shards first
+
+        Returns
+        -------
+            (fpr, tpr, thresholds) np.arrays of bins + 1 points
+        '''
+        self._check()
+        tp = np.concatenate(([0], self.positives[::-1].cumsum()))
+        fp = np.concatenate(([0], self.negatives[::-1].cumsum()))
+        thresholds = np.arange(self.bins, -1, -1) / self.bins
+        return fp / fp[-1], tp / tp[-1], thresholds
+
+    def auc(self):
+        '''
+        Area Under the Curve, pairs on the same bin count as ties
+        '''
+        self._check()
+        below = np.concatenate(([0], self.negatives.cumsum()[:-1]))
+        pairs = self.positives.sum() * self.negatives.sum()
+        return ((self.positives * below).sum() +
+                            0.5 * (self.positives * self.negatives).sum()) / pairs
+
+    def error(self):
+        '''
+        Maximum difference between auc() and the exact Area Under the Curve
+        '''
+        self._check()
+        pairs = self.positives.sum() * self.negatives.sum()
+        return 0.5 * (self.positives * self.negatives).sum() / pairs
+
+def binned_roc(clf, X_test, y_test, bins=1000, chunksize=100000, n_jobs=1):
+    '''
+    Calculates a BinnedROC of a classifier predicting the test data by chunks,
+    the chunks are processed on a pool of workers and the results merged.
+
+    Parameters
+    ----------
+        clf: classifier with predict_proba
+        bins: int, number of bins of the histograms
+        chunksize: int, number of rows predicted at once
+        n_jobs: int, number of workers
+
+    Returns
+    -------
+        copper.utils.ml.BinnedROC
+    '''
+    def run(start):
+        probas = clf.predict_proba(X_test[start:start + chunksize])
+        return BinnedROC(bins).update(y_test[start:start + chunksize], probas[:, 1])
+
+    starts = range(0, len(X_test), chunksize)
+    ans = BinnedROC(bins)
+    for part in copper.utils.parallel.pmap(run, starts, n_jobs=n_jobs):
+        ans.merge(part)
+    return ans
@@ -0,0 +1,133 @@
+# coding=utf-8
+from __future__ import division
+import threading
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import numpy as np
+import pandas as pd
+
+'''
+Utils for running work on a pool of workers
+'''
+
+def n_workers(n_jobs=1):
+    '''
+    Number of workers to use, follows the scikit-learn convention:
+    n_jobs=-1 uses all the cpus, n_jobs=-2 all but one, ...
+
+    Parameters
+    ----------
+        n_jobs: int
+
+    Returns
+    -------
+        int
+    '''
+    if n_jobs is None:
+        return 1
+    if n_jobs < 0:
+        n_jobs = multiprocessing.cpu_count() + 1 + n_jobs
+    return max(1, n_jobs)
+
+def pmap(fnc, items, n_jobs=1, processes=False):
+    '''
+    Parallel version of map. Uses a pool of threads by default: most of the
+    numpy/scikit-learn heavy work releases the GIL and threads share memory
+    so there is no need to copy the arrays to the workers.
+
+    Parameters
+    ----------
+        fnc: function, of one argument
+        items: iterable, arguments for fnc
+        n_jobs: int, number of workers, see n_workers
+        processes: boolean, True to use a pool of processes instead of threads,
+                            fnc and items have to be picklable
+
+    Returns
+    -------
+        list, the results in the same order as items
+    '''
+    items = list(items)
+    workers = min(n_workers(n_jobs), len(items))
+    if workers <= 1:
+        return [fnc(item) for item in items]
+
+    pool = multiprocessing.Pool(workers) if processes else ThreadPool(workers)
+    try:
+        return pool.map(fnc, items)
+    finally:
+        pool.close()
+        pool.join()
+
+# -----------------------------------------------------------------------------
+#                                 COLUMNS
+# -----------------------------------------------------------------------------
+
+# Frames with at least this number of columns use map_columns in parallel
+# when n_jobs is not given
+MIN_COLUMNS = 2000
+
+# Frame of the workers of map_columns, set on each worker
+_frame = None
+
+def _init_worker(frame):
+    global _frame
+    _frame = frame
+
+def _map_block(args):
+    fnc, positions = args
+    return fnc(_frame.iloc[:, positions])
+
+def _context():
+    '''
+    Start method of the map_columns workers, see map_columns
+    '''
+    methods = multiprocessing.get_all_start_methods()
+    if 'fork' in methods and threading.active_count() == 1:
+        return multiprocessing.get_context('fork')
+    if 'forkserver' in methods:
+        return multiprocessing.get_context('forkserver')
+    return multiprocessing.get_context('spawn')
+
+def map_columns(fnc, frame, n_jobs=None, blocks_per_worker=4):
+    '''
+    Computes a per-column statistic by blocks of columns on a pool of
+    processes. The workers are forked so they read the frame from the memory
+    of the parent without copying it or pickling it; only the results are
+    sent back.
+
+    Forking a process with other threads running (e.g. Jupyter, the scoring
+    server or a pool of threads) can deadlock the workers, in that case the
+    workers are started by a forkserver (spawn without it, e.g. Windows) and
+    the frame is pickled once for each worker.
+
+    Parameters
+    ----------
+        fnc: function, of a DataFrame that returns a Series indexed by its
+                       columns, has to be picklable (module level)
+        frame: pandas.DataFrame
+        n_jobs: int, number of processes (see n_workers), default all the
+                     cpus if the frame has at least MIN_COLUMNS columns, one if
+                     not
+        blocks_per_worker: int, number of blocks of columns of each worker
+
+    Returns
+    -------
+        pandas.Series, same as fnc(frame)
+    '''
+    if n_jobs is None:
+        n_jobs = -1 if len(frame.columns) >= MIN_COLUMNS else 1
+    workers = min(n_workers(n_jobs), len(frame.columns))
+    if workers <= 1:
+        return fnc(frame)
+
+    n_blocks = min(workers * blocks_per_worker, len(frame.columns))
+    blocks = np.array_split(np.arange(len(frame.columns)), n_blocks)
+    # The forked workers inherit the initargs, the frame is not pickled
+    pool = _context().Pool(workers, _init_worker, (frame,))
+    try:
+        results = pool.map(_map_block, [(fnc, positions) for positions in blocks])
+    finally:
+        pool.close()
+        pool.join()
+    return pd.concat(results)
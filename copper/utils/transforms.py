@@ -1,10 +1,11 @@
 # coding=utf-8
 from __future__ import division
 import re
+import hashlib
 import numpy as np
 import pandas as pd
 from datetime import datetime
-from sklearn import preprocessing
+from copper.utils.instrument import timed
 
 
 # -----------------------------------------------------------------------------
@@ -36,7 +37,8 @@ def date_to_number(x):
 
 # -----------------------------------------------------------------------------
 
-def category2ml(series):
+@timed('transform.category2ml')
+def category2ml(series, categories=None):
     '''
     Converts a Series with category format to a format for machine learning
     Represents the same information on different columns of ones and zeros
@@ -46,19 +48,228 @@ def category2ml(series):
     Parameters
     ----------
         series: pandas.Series, target to convert
+        categories: list, categories to use as columns, values not on the list
+                    are all zeros. Default is the sorted unique values or the
+                    categories of a pandas categorical
 
     Returns
     -------
         pandas.DataFrame with the converted data
     '''
-    ans = pd.DataFrame(index=series.index)
-    categories = list(set(series))
-    categories.sort()
-    for category in categories:
-        n_col = pd.Series(np.zeros(len(series)), index=series.index, dtype=int)
-        n_col.name = '%s [%s]' % (series.name, category)
-        n_col[series == category] = 1
-        ans = ans.join(n_col)
+    if categories is None and series.dtype.name == 'category':
+        # Use the integer codes of the categorical directly
+        categories = series.cat.categories
+        codes = series.cat.codes.values
+    else:
+        if categories is None:
+            categories = list(set(series))
+            categories.sort()
+        codes = pd.Index(categories).get_indexer(series.values)
+
+    values = np.zeros((len(series), len(categories)), dtype=int)
+    rows = np.flatnonzero(codes >= 0)
+    values[rows, codes[rows]] = 1
+    cols = ['%s [%s]' % (series.name, category) for category in categories]
+    return pd.DataFrame(values, index=series.index, columns=cols)
+
+def _hash_keys(values):
+    '''
+    Canonical str of each value for the hashing trick: integral floats are
+    written as ints, so 1 and 1.0 (e.g. an int column with missing values
+    read as float) get the same bucket.
+    '''
+    values = np.asarray(values)
+    if values.dtype.kind == 'f':
+        integral = np.isfinite(values) & (values == np.floor(values))
+        keys = values.astype(object)
+        keys[integral] = values[integral].astype(np.int64)
+        return keys.astype(str)
+    elif values.dtype.kind == 'O':
+        return np.array([str(int(v)) if isinstance(v, (float, np.floating))
+                                and np.isfinite(v) and float(v).is_integer()
+                                else str(v) for v in values], dtype=object)
+    return values.astype(str)
+
+def _hash(key):
+    '''
+    Stable 64 bits hash of a str (the same on every process and version,
+    unlike hash())
+    '''
+    return int(hashlib.md5(key.encode('utf-8')).hexdigest()[:16], 16)
+
+@timed('transform.category2hash')
+def category2hash(series, buckets=64, signed=True):
+    '''
+    Converts a Series with category format to a fixed number of columns using
+    the hashing trick: each value is hashed to one column (bucket). There is
+    no list of categories to keep and values not seen before still get a
+    column, at the cost of collisions between values on the same bucket.
+
+    Values are hashed as str (integral floats as ints), missing values are
+    all zeros.
+
+    Parameters
+    ----------
+        series: pandas.Series, target to convert
+        buckets: int, number of columns
+        signed: boolean, True to use -1 or 1 (from another bit of the hash) so
+                         collisions tend to cancel out on linear models
+
+    Returns
+    -------
+        pandas.DataFrame with the converted data
+    '''
+    # Hash only the unique values, codes are -1 for missing values
+    codes, uniques = pd.factorize(series.values)
+    hashes = np.array([_hash(key) for key in _hash_keys(uniques)], dtype=np.uint64)
+    bucket = (hashes % np.uint64(buckets)).astype(np.intp)
+    sign = np.ones(len(uniques), dtype=np.int8)
+    if signed:
+        sign[(hashes >> np.uint64(63)) == 1] = -1
+
+    values = np.zeros((len(series), buckets), dtype=np.int8)
+    rows = np.flatnonzero(codes >= 0)
+    values[rows, bucket[codes[rows]]] = sign[codes[rows]]
+    cols = ['%s [#%d]' % (series.name, i) for i in range(buckets)]
+    return pd.DataFrame(values, index=series.index, columns=cols)
+
+def frequency_encoding(series):
+    '''
+    Learns the frequency of each category, see category2encoding
+
+    Returns
+    -------
+        (pandas.Series, float), frequency of each category and value for
+        categories not seen
+    '''
+    counts = series.value_counts()
+    ans = pd.Series(counts.values / len(series), index=counts.index, name='frequency')
+    return ans, 0.0
+
+def target_encoding(series, target, smoothing=10):
+    '''
+    Learns the mean of the target of each category, smoothed towards the
+    mean of all the target: (sum + smoothing * prior) / (count + smoothing)
+
+    Parameters
+    ----------
+        series: pandas.Series, categories
+        target: pandas.Series or np.array, numerical or binary target
+        smoothing: float, weight of the prior, categories with few values
+                          get values close to the prior
+
+    Returns
+    -------
+        (pandas.Series, float), mean of each category and prior for
+        categories not seen
+    '''
+    y = np.asarray(target, dtype=float)
+    valid = ~np.isnan(y)
+    prior = y[valid].mean()
+    grouped = pd.Series(y[valid]).groupby(np.asarray(series.values)[valid])
+    sums, counts = grouped.sum(), grouped.count()
+    ans = (sums + smoothing * prior) / (counts + smoothing)
+    ans.name = 'target'
+    return ans, prior
+
+@timed('transform.category2encoding')
+def category2encoding(series, encoding):
+    '''
+    Converts a Series with category format to one column of numbers using a
+    learned encoding (see frequency_encoding and target_encoding)
+
+    Parameters
+    ----------
+        series: pandas.Series, target to convert
+        encoding: (pandas.Series, float), value of each category and value
+                  for missing and not seen categories
+
+    Returns
+    -------
+        pandas.DataFrame with the converted data
+    '''
+    mapping, default = encoding
+    codes = pd.Index(mapping.index).get_indexer(series.values)
+    values = np.where(codes >= 0, mapping.values.astype(float)[codes], default)
+    col = '%s [%s]' % (series.name, mapping.name)
+    return pd.DataFrame({col: values}, index=series.index)
+
+def category2frequency(series):
+    '''
+    Converts a Series with category format to the frequency of each
+    category on the Series
+
+    Returns
+    -------
+        pandas.DataFrame with the converted data
+    '''
+    return category2encoding(series, frequency_encoding(series))
+
+@timed('transform.category2target')
+def category2target(series, target, folds=5, smoothing=10, seed=0):
+    '''
+    Converts a Series with category format to the mean of the target of each
+    category (see target_encoding) computed out of fold: the rows are split
+    on folds and the value of each row is learned only from the other folds,
+    so the target of a row does not leak into its own input.
+
+    Parameters
+    ----------
+        series: pandas.Series, target to convert
+        target: pandas.Series or np.array, numerical or binary target
+        folds: int, number of folds
+        smoothing: float, see target_encoding
+        seed: int, seed of the random split on folds
+
+    Returns
+    -------
+        pandas.DataFrame with the converted data
+    '''
+    codes, uniques = pd.factorize(series.values)
+    y = np.asarray(target, dtype=float)
+    n, k = len(series), len(uniques)
+    fold = np.random.RandomState(seed).permutation(n) % folds
+
+    # Sums and counts of each category on each fold, the values out of a
+    # fold are the totals minus the fold
+    known = ~np.isnan(y)
+    valid = known & (codes >= 0)
+    group = fold[valid] * k + codes[valid]
+    sums = np.bincount(group, weights=y[valid], minlength=folds * k).reshape(folds, k)
+    counts = np.bincount(group, minlength=folds * k).reshape(folds, k)
+    fold_sums = np.bincount(fold[known], weights=y[known], minlength=folds)
+    fold_counts = np.bincount(fold[known], minlength=folds)
+    prior = (fold_sums.sum() - fold_sums) / np.maximum(fold_counts.sum() - fold_counts, 1)
+    means = (sums.sum(axis=0) - sums + smoothing * prior[:, np.newaxis]) / \
+                            (counts.sum(axis=0) - counts + smoothing)
+
+    values = prior[fold]
+    rows = np.flatnonzero(codes >= 0)
+    values[rows] = means[fold[rows], codes[rows]]
+    return pd.DataFrame({'%s [target]' % series.name: values}, index=series.index)
+
+def learn_encodings(ds, encoding=None):
+    '''
+    Learns on all the rows of a Dataset the encodings of its columns
+    converted by target or frequency (see Dataset.set_encoding), used to
+    convert new data with the values learned on training
+
+    Returns
+    -------
+        dict, column: (pandas.Series, float)
+    '''
+    if encoding is None:
+        encoding = getattr(ds, 'encoding', None) or {}
+    ans = {}
+    for col, method in encoding.items():
+        if type(method) is tuple:
+            ans[col] = method
+        elif method == 'frequency':
+            ans[col] = frequency_encoding(ds.frame[col])
+        elif method == 'target':
+            ans[col] = target_encoding(ds.frame[col], target2ml(ds).values)
+        else:
+            raise ValueError('Unknown encoding: %s' % method)
     return ans
 
 def category2number(series):
@@ -74,6 +285,7 @@ def category2number(series):
     -------
         pandas.Series with the converted data
     '''
+    from sklearn import preprocessing
     le = preprocessing.LabelEncoder()
     le.fit(series.values)
     vals = le.transform(series.values)
@@ -91,35 +303,73 @@ def category_labels(series):
     -------
         list, labels of the series
     '''
+    from sklearn import preprocessing
     le = preprocessing.LabelEncoder()
     le.fit(series.values)
     return le.classes_
 
-def inputs2ml(ds):
+@timed('transform.inputs2ml')
+def inputs2ml(ds, categories=None, hashing=None, encoding=None):
+    '''
+    Converts the inputs of a Dataset to a format for machine learning
+
+    Parameters
+    ----------
+        ds: copper.Dataset
+        categories: dict, column: list of categories, fixes the columns of
+                    the categorical inputs (see category2ml), e.g. to convert
+                    chunks of a Dataset with the same columns
+        hashing: dict, column: number of buckets, categorical inputs converted
+                    with category2hash. Default is ds.hashing (see
+                    Dataset.set_hashing)
+        encoding: dict, column: 'target', 'frequency' or learned encoding (see
+                    learn_encodings), categorical inputs converted to one
+                    column of numbers. Target is computed out of fold (see
+                    category2target). Default is ds.encoding (see
+                    Dataset.set_encoding)
+
+    Returns
+    -------
+        pandas.DataFrame
+    '''
+    categories = {} if categories is None else categories
+    if hashing is None:
+        hashing = getattr(ds, 'hashing', None) or {}
+    if encoding is None:
+        encoding = getattr(ds, 'encoding', None) or {}
     ans = pd.DataFrame(index=ds.frame.index)
 
     for col in ds.filter(role=ds.INPUT, ret_cols=True):
-        if ds.type[col] == ds.NUMBER and \
-                          ds.frame[col].dtype in (np.int64, np.float64):
+        kind = ds.frame[col].dtype.kind
+        categorical = ds.frame[col].dtype.name == 'category'
+        if ds.type[col] == ds.NUMBER and kind == 'b':
+            # bool joined to numbers gives object arrays
+            ans = ans.join(ds.frame[col].astype(np.uint8))
+        elif ds.type[col] == ds.NUMBER and kind in 'iuf':
             ans = ans.join(ds.frame[col])
-        elif ds.type[col] == ds.NUMBER and \
-                                        ds.frame[col].dtype == object:
+        elif ds.type[col] == ds.NUMBER and kind == 'O':
             ans = ans.join(ds.frame[col].apply(to_number))
-        elif ds.type[col] == ds.CATEGORY and \
-                        ds.frame[col].dtype in (np.int64, np.float64):
-            # new_cols = category2number(ds.frame[col])
-            new_cols = category2ml(ds.frame[col])
-            ans = ans.join(new_cols)
-        elif ds.type[col] == ds.CATEGORY and \
-                                        ds.frame[col].dtype == object:
+        elif ds.type[col] == ds.NUMBER and categorical:
+            ans = ans.join(ds.frame[col].astype(object).apply(to_number))
+        elif ds.type[col] == ds.CATEGORY and (kind in 'biufO' or categorical):
             # new_cols = category2number(ds.frame[col])
-            new_cols = category2ml(ds.frame[col])
+            if type(encoding.get(col)) is tuple:
+                new_cols = category2encoding(ds.frame[col], encoding[col])
+            elif encoding.get(col) == 'frequency':
+                new_cols = category2frequency(ds.frame[col])
+            elif encoding.get(col) == 'target':
+                new_cols = category2target(ds.frame[col], target2ml(ds).values)
+            elif col in hashing:
+                new_cols = category2hash(ds.frame[col], buckets=hashing[col])
+            else:
+                new_cols = category2ml(ds.frame[col], categories=categories.get(col))
             ans = ans.join(new_cols)
         else:
             # Crazy stuff TODO: generate error
             pass
     return ans
 
+@timed('transform.target2ml')
 def target2ml(ds, which=0):
     col = ds.filter(role=ds.TARGET, ret_cols=True)[which]
     if ds.type[col] == ds.CATEGORY: